@@ -1,42 +1,27 @@
 
 import rasterio
-from rasterio.merge import merge
 import numpy as np
 from matplotlib import pyplot as plt
 import pandas as pd 
 import geopandas as gpd
 
+from satellite_images_nso_extractor._manipulation.mosaic import build_mosaic
+
 def merge_tif_files(tiff_lst, out_fp):
     """ 
         Function for merging .tif files into one .tif file.
         Good for first downloading a wider region for different shapes, cropping them for each  shapes and then merging them again with this function.
 
+        Deprecated: use mosaic.build_mosaic, which this function calls. The merge is done block by block and the
+        output keeps the CRS of the input files. Where files overlap the first file is kept.
+
         @oaram tiff_lst: A python list of .tif files to be merged.
         @param out_fp: The .tif file to write to.
     """    
-    src_files_to_mosaic = []
-    for tiff in tiff_lst:
-        src = rasterio.open(tiff)
-        src_files_to_mosaic.append(src)
-        src.close()
-
-    # Merge
-    mosaic, out_trans = merge(src_files_to_mosaic)
+    with rasterio.open(tiff_lst[0]) as src:
+        resolution = src.res[0]
 
-    # Copy the metadata
-    out_meta = src.meta.copy()
-        
-    # Update the metadata
-    out_meta.update({"driver": "GTiff",
-        "height": mosaic.shape[1],
-        "width": mosaic.shape[2],
-        "transform": out_trans,
-        "crs": "+proj=utm +zone=35 +ellps=GRS80 +units=m +no_defs" })
-        
-    # Write the mosaic raster to disk
-    with rasterio.open(out_fp, "w", **out_meta) as dest:
-        dest.write(mosaic)
-        dest.close()
+    return build_mosaic(tiff_lst, out_fp, rule="first", resolution=resolution)
 
     
 def plot_tif_file(path_to_tif_file):
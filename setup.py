@@ -29,4 +29,14 @@ setup(
         "rasterio>=1.3.9",
         "Shapely>=2.0.3",
     ],
+    extras_require={
+        "parquet": ["pyarrow>=16.1.0"],
+        "datacube": ["zarr>=2.18.2"],
+    },
+    entry_points={
+        "console_scripts": [
+            "nso-batch=satellite_images_nso_extractor.api.batch_runner:main",
+            "nso-load-test=satellite_images_nso_extractor.api.load_test:main",
+        ],
+    },
 )
@@ -1,3 +1,4 @@
+import ast
 import logging
 
 import earthpy.plot as ep
@@ -21,12 +22,178 @@ from rasterio.io import DatasetReader
 def aggregate_ndvi_habitat(ndvi_geo_df: gpd.geodataframe.GeoDataFrame) -> pd.Series:
     """
     Calculate the aggregated statistics for NDVI
+
+    For large crops use zonal_statistics in _manipulation.zonal_statistics, which does not need a row per pixel.
     @param ndvi_geo_df: geopandas dataframe, with ndvi values for each pixel
     @return pandas series: with 'mean', 'std', 'min', 'max', 'count' in the row axis
     """
     return ndvi_geo_df["ndvi"].agg(["mean", "std", "min", "max", "count"])
 
 
+# Band numbers (1 based) of the names which can be used in index expressions, "i" is the near infra red of RGBI.
+BAND_NAMES = {"r": 1, "g": 2, "b": 3, "n": 4, "i": 4, "e": 5, "d": 6}
+
+# Functions which can be used in index expressions.
+EXPRESSION_FUNCTIONS = {"sqrt": np.sqrt, "abs": np.abs, "log": np.log}
+
+_ALLOWED_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Constant,
+    ast.Name,
+    ast.Load,
+    ast.Call,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.Pow,
+    ast.USub,
+    ast.UAdd,
+)
+
+
+class index_channel:
+    """
+    A index channel declared as a expression over named bands, compiled once into a vectorized numpy kernel.
+    """
+
+    def __init__(self, name: str, expression: str, dtype=np.float32):
+        """
+        Init of the index channel, validates and compiles the expression.
+
+        @param name: the name of the index channel, used as band description.
+        @param expression: a expression over the band names r, g, b, n (or i), e and d, i.e. "(n - r) / (n + r)".
+        @param dtype: the numpy dtype in which the index is calculated.
+        """
+        tree = ast.parse(expression, mode="eval")
+        for node in ast.walk(tree):
+            if not isinstance(node, _ALLOWED_NODES):
+                raise ValueError(
+                    f"Not allowed in index expression {expression}: {type(node).__name__}"
+                )
+            if isinstance(node, ast.Name) and (
+                node.id not in BAND_NAMES and node.id not in EXPRESSION_FUNCTIONS
+            ):
+                raise ValueError(
+                    f"Unknown name in index expression {expression}: {node.id}"
+                )
+            if isinstance(node, ast.Call) and (
+                not isinstance(node.func, ast.Name)
+                or node.func.id not in EXPRESSION_FUNCTIONS
+                or len(node.keywords) > 0
+            ):
+                raise ValueError(
+                    f"Not allowed function call in index expression {expression}"
+                )
+            if isinstance(node, ast.Constant) and not isinstance(
+                node.value, (int, float)
+            ):
+                raise ValueError(
+                    f"Not allowed constant in index expression {expression}"
+                )
+
+        self.name = name
+        self.expression = expression
+        self.dtype = np.dtype(dtype)
+        self.bands = sorted(
+            {
+                node.id
+                for node in ast.walk(tree)
+                if isinstance(node, ast.Name) and node.id in BAND_NAMES
+            }
+        )
+        self.kernel = compile(tree, f"<index channel {name}>", "eval")
+
+    def required_band_count(self):
+        """
+        The number of bands a raster needs for this index channel.
+        """
+        return max([BAND_NAMES[band] for band in self.bands], default=0)
+
+    def __call__(self, data: np.array) -> np.array:
+        """
+        Calculate the index channel for an array of bands.
+
+        @param data: numpy array with shape (bands, height, width) in the band order of the .tif file.
+        @return numpy array with shape (height, width) in the dtype of the index channel, nan and inf are 0.
+        """
+        if data.shape[0] < self.required_band_count():
+            raise ValueError(
+                f"{self.name} needs {self.required_band_count()} bands, got {data.shape[0]}"
+            )
+
+        # Only the bands used in the expression are converted, once.
+        namespace = {
+            band: data[BAND_NAMES[band] - 1].astype(self.dtype, copy=False)
+            for band in self.bands
+        }
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            index = eval(
+                self.kernel, {"__builtins__": {}, **EXPRESSION_FUNCTIONS}, namespace
+            )
+
+        index = np.asarray(index, dtype=self.dtype)
+        if index.ndim == 0:
+            index = np.full(data.shape[1:], index, dtype=self.dtype)
+        return np.nan_to_num(index, nan=0, posinf=0, neginf=0)
+
+
+# The registry of index channels. The indices are scaled as (index * 100 + 100), so they lie between 0 and 200 and
+# fit in the uint16 bands of the .tif files. EVI and SAVI assume the bands are reflectance times 10000.
+INDEX_CHANNELS = {}
+
+
+def register_index_channel(name: str, expression: str, dtype=np.float32):
+    """
+    Add a index channel to the registry, after which it can be used by add_index_channels and zonal_statistics.
+
+    @param name: the name of the index channel.
+    @param expression: a expression over the band names r, g, b, n (or i), e and d, i.e. "(n - e) / (n + e) * 100 + 100".
+    @param dtype: the numpy dtype in which the index is calculated.
+    @return: the compiled index_channel.
+    """
+    INDEX_CHANNELS[name] = index_channel(name, expression, dtype)
+    return INDEX_CHANNELS[name]
+
+
+def get_index_channel(name: str) -> index_channel:
+    """
+    Get a index channel from the registry.
+
+    @param name: the name of the index channel.
+    """
+    if name not in INDEX_CHANNELS:
+        raise ValueError(
+            f"Unknown channel type: {name}, registered are: {list(INDEX_CHANNELS)}"
+        )
+    return INDEX_CHANNELS[name]
+
+
+# The indices which existed before the registry are calculated in float64 like before, so their uint16 bands stay
+# the same, float32 rounds some values just below a whole number.
+register_index_channel("ndvi", "(n - r) / (n + r) * 100 + 100", dtype=np.float64)
+register_index_channel("re_ndvi", "(e - r) / (e + r) * 100 + 100", dtype=np.float64)
+register_index_channel("ndwi", "(g - n) / (g + n) * 100 + 100", dtype=np.float64)
+register_index_channel("ndre", "(n - e) / (n + e) * 100 + 100")
+register_index_channel(
+    "evi", "2.5 * (n - r) / (n + 6 * r - 7.5 * b + 10000) * 100 + 100"
+)
+register_index_channel("savi", "1.5 * (n - r) / (n + r + 5000) * 100 + 100")
+
+
+def generate_index_channel_from_array(channel_type: str, data: np.array) -> np.array:
+    """
+    Generate a index channel from an array of bands, which can be a block of a raster.
+
+    @param channel_type: the name of a registered index channel, i.e. "ndvi", "re_ndvi", "ndwi", "ndre", "evi" or "savi".
+    @param data: numpy array with shape (bands, height, width) in the band order of the .tif file.
+    @return numpy array with shape (height, width) with the index values, in the dtype of the index channel: float64 for ndvi, re_ndvi and ndwi and float32 for the others unless registered otherwise.
+    """
+    return get_index_channel(channel_type)(data)
+
+
 def generate_ndvi_channel(dataset: DatasetReader) -> np.array:
     """
     Generate ndvi channel from near infra red and red band.
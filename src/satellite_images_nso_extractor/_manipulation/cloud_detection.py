@@ -0,0 +1,286 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+
+try:
+    from cloud_recognition.api import detect_clouds
+
+    CLOUD_DETECTION_AVAILABLE = True
+except ImportError:
+    CLOUD_DETECTION_AVAILABLE = False
+
+"""
+    Cloud detection on cropped satellite images with a model which is loaded once per process.
+
+    The model of a path is unpickled once and shared by all georegions in the process, also by the georegions which
+    are made to fill a missing part of a image. A cloud_detector decides per cropped file if it contains clouds,
+    optionally on a overview which is decimated by a factor, and keeps the verdict next to the cropped file so a
+    repeated run never detects the same file again.
+
+    There are two methods:
+    - "detect_clouds": the detect_clouds of the cloud_recognition package, which works on one file at a time.
+    - "pixels": the model classifies the pixels of many files in one predict call, the bands of a pixel are the
+      features and a file has clouds when more than a fraction of its pixels is classified as cloud.
+
+    Batches only form when many files are passed at once, i.e. to nso_georegion.detect_clouds with the crops of many
+    links. nso_georegion.execute_link classifies the single crop of its link, before the index bands are added.
+
+    @author: Michael de Winter, Pieter Kouyzer
+"""
+
+# The suffix of the file next to a cropped file in which the verdicts are kept.
+VERDICT_FILE_SUFFIX = ".clouds.json"
+
+METHODS = ["detect_clouds", "pixels"]
+
+# The models and detectors of this process by the path of the model.
+_models = {}
+_detectors = {}
+_lock = threading.Lock()
+
+
+def get_cloud_model(model_path: str):
+    """
+    Get the cloud detection model of a path, which is unpickled on first use.
+
+    @param model_path: the path to a .sav of a cloud detection model.
+    @return: the model.
+    """
+    key = os.path.realpath(model_path)
+    with _lock:
+        if key not in _models:
+            logging.info(f"Loading cloud detection model {model_path}")
+            with open(model_path, "rb") as model_file:
+                _models[key] = pickle.load(model_file)
+        return _models[key]
+
+
+def get_model_hash(model_path: str):
+    """
+    Get a hash of a model file, so verdicts of a other model are not used.
+
+    @param model_path: the path to a .sav of a cloud detection model.
+    @return: a hex string.
+    """
+    stat = os.stat(model_path)
+    model = f"{os.path.basename(model_path)}|{stat.st_size}|{stat.st_mtime}"
+    return hashlib.sha1(model.encode()).hexdigest()[:12]
+
+
+def read_overview(filepath: str, overview_factor: int = 1):
+    """
+    Read a satellite image decimated by a factor, GDAL uses the overviews of the file when it has them.
+
+    @param filepath: path to a .tif file.
+    @param overview_factor: the factor by which the width and height are decimated, 1 reads the full resolution.
+    @return: the data as a numpy array (bands, rows, columns) and the profile of the decimated image.
+    """
+    with rasterio.open(filepath, "r") as src:
+        height = max(1, src.height // overview_factor)
+        width = max(1, src.width // overview_factor)
+        data = src.read(
+            out_shape=(src.count, height, width), resampling=Resampling.average
+        )
+        profile = src.profile.copy()
+        profile.update(
+            height=height,
+            width=width,
+            transform=src.transform
+            * src.transform.scale(src.width / width, src.height / height),
+        )
+        for key in ["blockxsize", "blockysize", "tiled"]:
+            profile.pop(key, None)
+    return data, profile
+
+
+class cloud_detector:
+    """
+    Detects clouds in cropped files in batches and caches the verdict per file.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        method: str = "detect_clouds",
+        overview_factor: int = 1,
+        batch_size: int = 16,
+        cloud_label=1,
+        cloud_fraction: float = 0.01,
+    ):
+        """
+        Init of the cloud detector, the model is shared with the other detectors of the same path.
+
+        @param model_path: the path to a .sav of a cloud detection model.
+        @param method: "detect_clouds" or "pixels", see the module docstring.
+        @param overview_factor: detect on a overview decimated by this factor, 1 detects on the full resolution.
+        @param batch_size: the number of files which are classified in one predict call with the "pixels" method.
+        @param cloud_label: the class of a cloud pixel with the "pixels" method.
+        @param cloud_fraction: the fraction of cloud pixels above which a file has clouds with the "pixels" method.
+        """
+        if method not in METHODS:
+            raise ValueError(f"Unknown cloud detection method {method}, use {METHODS}")
+        if overview_factor < 1:
+            raise ValueError("The overview factor has to be 1 or more")
+
+        self.model_path = model_path
+        self.model = get_cloud_model(model_path)
+        self.method = method
+        self.overview_factor = int(overview_factor)
+        self.batch_size = batch_size
+        self.cloud_label = cloud_label
+        self.cloud_fraction = cloud_fraction
+        self.lock = threading.Lock()
+
+        settings = (
+            f"{get_model_hash(model_path)}|{method}|{self.overview_factor}|"
+            f"{cloud_label}|{cloud_fraction}"
+        )
+        self.settings_key = hashlib.sha1(settings.encode()).hexdigest()[:16]
+
+    def __get_file_key(self, filepath):
+        """
+        Get the key of the verdict of a file, which changes when the file or the settings change.
+        """
+        stat = os.stat(filepath)
+        return f"{self.settings_key}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    def get_cached_verdict(self, filepath: str):
+        """
+        Get the cached verdict of a cropped file.
+
+        @param filepath: path to a cropped .tif file.
+        @return: True or False when the file was detected before with the same model and settings, otherwise None.
+        """
+        verdict_path = filepath + VERDICT_FILE_SUFFIX
+        if not os.path.isfile(verdict_path):
+            return None
+        try:
+            with open(verdict_path, "r") as verdict_file:
+                verdicts = json.load(verdict_file)
+        except (OSError, ValueError):
+            return None
+        return verdicts.get(self.__get_file_key(filepath))
+
+    def __save_verdict(self, filepath, clouds):
+        """
+        Save the verdict of a cropped file, the file is replaced at once so a crash never leaves half a file.
+        """
+        verdict_path = filepath + VERDICT_FILE_SUFFIX
+        with self.lock:
+            verdicts = {}
+            if os.path.isfile(verdict_path):
+                try:
+                    with open(verdict_path, "r") as verdict_file:
+                        verdicts = json.load(verdict_file)
+                except (OSError, ValueError):
+                    verdicts = {}
+            verdicts[self.__get_file_key(filepath)] = bool(clouds)
+            with open(verdict_path + ".part", "w") as verdict_file:
+                json.dump(verdicts, verdict_file)
+            os.replace(verdict_path + ".part", verdict_path)
+
+    def __detect_clouds(self, filepath):
+        """
+        Detect clouds in one file with detect_clouds of the cloud_recognition package.
+        """
+        if self.overview_factor == 1:
+            return bool(detect_clouds(model=self.model, filepath=filepath))
+
+        data, profile = read_overview(filepath, self.overview_factor)
+        with tempfile.TemporaryDirectory() as folder:
+            overview_path = os.path.join(folder, os.path.basename(filepath))
+            with rasterio.open(overview_path, "w", **profile) as dst:
+                dst.write(data)
+            return bool(detect_clouds(model=self.model, filepath=overview_path))
+
+    def __detect_pixels(self, filepaths):
+        """
+        Classify the pixels of files in one predict call.
+        """
+        pixels = []
+        for filepath in filepaths:
+            data, profile = read_overview(filepath, self.overview_factor)
+            data = data.reshape(data.shape[0], -1).T
+            # Pixels outside of the crop are nodata in every band.
+            nodata = profile.get("nodata")
+            nodata = 0 if nodata is None else nodata
+            pixels.append(data[~np.all(data == nodata, axis=1)])
+
+        labels = (
+            self.model.predict(np.concatenate(pixels))
+            if sum(len(file_pixels) for file_pixels in pixels) > 0
+            else np.array([])
+        )
+
+        verdicts = {}
+        start = 0
+        for filepath, file_pixels in zip(filepaths, pixels):
+            file_labels = labels[start : start + len(file_pixels)]
+            start += len(file_pixels)
+            fraction = (
+                np.mean(file_labels == self.cloud_label) if len(file_labels) else 0
+            )
+            logging.info(f"{filepath} has a cloud fraction of {fraction:.3f}")
+            verdicts[filepath] = bool(fraction > self.cloud_fraction)
+        return verdicts
+
+    def detect(self, filepaths: list):
+        """
+        Detect clouds in cropped files, files which were detected before are not detected again.
+
+        @param filepaths: paths to cropped .tif files.
+        @return: a dictionary with for every file path True when it has clouds.
+        """
+        verdicts = {}
+        to_detect = []
+        for filepath in filepaths:
+            verdict = self.get_cached_verdict(filepath)
+            if verdict is None:
+                to_detect.append(filepath)
+            else:
+                logging.info(f"Using cached cloud verdict of {filepath}")
+                verdicts[filepath] = verdict
+
+        if len(to_detect) > 0 and self.method == "detect_clouds":
+            if not CLOUD_DETECTION_AVAILABLE:
+                raise Exception(
+                    "Cloud detection requested but cloud_recognition module is not available."
+                )
+            for filepath in to_detect:
+                verdicts[filepath] = self.__detect_clouds(filepath)
+                self.__save_verdict(filepath, verdicts[filepath])
+        elif len(to_detect) > 0:
+            for start in range(0, len(to_detect), self.batch_size):
+                batch = self.__detect_pixels(to_detect[start : start + self.batch_size])
+                for filepath, clouds in batch.items():
+                    verdicts[filepath] = clouds
+                    self.__save_verdict(filepath, clouds)
+
+        return {filepath: verdicts[filepath] for filepath in filepaths}
+
+
+def get_cloud_detector(model_path: str, **kwargs):
+    """
+    Get the shared cloud detector of a model path and settings, made on first use.
+
+    @param model_path: the path to a .sav of a cloud detection model.
+    @param kwargs: other parameters of the cloud_detector, like method and overview_factor.
+    @return: a cloud_detector.
+    """
+    key = (os.path.realpath(model_path), tuple(sorted(kwargs.items())))
+    with _lock:
+        detector = _detectors.get(key)
+    if detector is None:
+        # get_cloud_model takes the lock itself.
+        detector = cloud_detector(model_path, **kwargs)
+        with _lock:
+            detector = _detectors.setdefault(key, detector)
+    return detector
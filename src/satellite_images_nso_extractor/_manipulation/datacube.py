@@ -0,0 +1,395 @@
+import logging
+import math
+import os
+from datetime import datetime
+
+import numpy as np
+import rasterio
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import Resampling, transform_bounds
+from rasterio.windows import Window
+
+try:
+    import zarr
+
+    ZARR_AVAILABLE = True
+except ImportError:
+    ZARR_AVAILABLE = False
+
+"""
+    A time series datacube of all the crops of a region.
+
+    The crops are snapped to one common grid and resolution and stored in one chunked and compressed zarr array
+    with the dimensions (time, band, y, x). New dates can be appended and time series of a pixel window are read
+    without opening any .tif file.
+
+    A append first grows the time axis, then writes the crop and at last adds the date to the attributes. The dates
+    decide which time indexes are complete, so when a append was interrupted the time axis is trimmed to the number
+    of dates the next time the datacube is opened, and the next append overwrites the unfinished time index.
+
+    @author: Michael de Winter, Pieter Kouyzer
+"""
+
+
+def get_acquisition_datetime(tif_file):
+    """
+    Get the acquisition date and time from the file name of a NSO .tif file, for example 20230513_104139_PNEO-03...
+
+    @param tif_file: path to a .tif file.
+    @return: a datetime.
+    """
+    name_parts = os.path.basename(tif_file).split("_")
+    try:
+        return datetime.strptime(name_parts[0] + name_parts[1], "%Y%m%d%H%M%S")
+    except (ValueError, IndexError):
+        return datetime.strptime(name_parts[0], "%Y%m%d")
+
+
+def get_common_grid(tif_files, resolution=None):
+    """
+    Calculate a grid which covers all the .tif files, snapped to whole pixels of the resolution from the first file.
+
+    @param tif_files: a list of paths to .tif files of the same region.
+    @param resolution: the resolution of the grid in the unit of the crs, defaults to the coarsest resolution of the files.
+    @return: the crs, transform, width and height of the grid.
+    """
+    bounds, resolutions, crs = [], [], None
+
+    for tif_file in tif_files:
+        with rasterio.open(tif_file, "r") as src:
+            if crs is None:
+                crs = src.crs
+            elif src.crs != crs:
+                raise ValueError(f"CRS mismatch for {tif_file}: {src.crs} and {crs}")
+            bounds.append(src.bounds)
+            resolutions.append(src.res[0])
+
+    resolution = resolution if resolution else max(resolutions)
+
+    # Anchor the grid on the first file, so crops on the same grid are not resampled.
+    # A small tolerance keeps floating point noise from adding a pixel.
+    origin_x, origin_y = bounds[0].left, bounds[0].top
+
+    def snap(value, origin, rounding, tolerance):
+        return origin + rounding((value - origin) / resolution + tolerance) * resolution
+
+    left = snap(min(b.left for b in bounds), origin_x, math.floor, 1e-6)
+    bottom = snap(min(b.bottom for b in bounds), origin_y, math.floor, 1e-6)
+    right = snap(max(b.right for b in bounds), origin_x, math.ceil, -1e-6)
+    top = snap(max(b.top for b in bounds), origin_y, math.ceil, -1e-6)
+
+    transform = rasterio.transform.from_origin(left, top, resolution, resolution)
+    width = int(round((right - left) / resolution))
+    height = int(round((top - bottom) / resolution))
+
+    return crs, transform, width, height
+
+
+class region_datacube:
+    """
+    A datacube with dimensions (time, band, y, x) stored as a zarr array on disk.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open an existing datacube, use build_datacube or region_datacube.create to make a new one.
+
+        @param path: path to the zarr store of the datacube.
+        """
+        if not ZARR_AVAILABLE:
+            raise ImportError("The datacube requires zarr, pip install zarr")
+
+        self.path = path
+        self.array = zarr.open_array(path, mode="r+")
+        self.band_names = list(self.array.attrs["band_names"])
+        self.crs = rasterio.crs.CRS.from_wkt(self.array.attrs["crs"])
+        self.transform = rasterio.Affine(*self.array.attrs["transform"])
+        self.nodata = self.array.attrs["nodata"]
+        # Time indexes below this one and from the number of dates may hold data of a interrupted append.
+        self.unfinished_until = 0
+        self.__trim()
+
+    def __trim(self):
+        """
+        Trim the time axis to the number of dates, a longer time axis is left by a interrupted append.
+        """
+        time_length, bands, height, width = self.array.shape
+        dates = len(self.array.attrs["dates"])
+        if time_length > dates:
+            logging.warning(
+                f"Datacube {self.path} has {time_length - dates} unfinished time indexes, trimming them"
+            )
+            print(f"Trimming {time_length - dates} unfinished time indexes")
+            self.array.resize((dates, bands, height, width))
+            self.unfinished_until = max(self.unfinished_until, time_length)
+
+    @classmethod
+    def create(
+        cls,
+        path: str,
+        crs,
+        transform,
+        width: int,
+        height: int,
+        band_names: list,
+        dtype: str = "uint16",
+        nodata=0,
+        chunks: tuple = (8, 1, 256, 256),
+    ):
+        """
+        Create a new empty datacube on a grid.
+
+        @param path: path where the zarr store will be made.
+        @param crs: the crs of the grid.
+        @param transform: the affine transform of the grid.
+        @param width: the width of the grid in pixels.
+        @param height: the height of the grid in pixels.
+        @param band_names: the names of the bands, for example ("r", "g", "b", "n", "e", "d").
+        @param dtype: the dtype of the stored pixels.
+        @param nodata: the value for pixels without data.
+        @param chunks: the chunk size as (time, band, y, x), a larger time chunk makes time series reads faster.
+        @return: the datacube.
+        """
+        if not ZARR_AVAILABLE:
+            raise ImportError("The datacube requires zarr, pip install zarr")
+
+        array = zarr.open_array(
+            path,
+            mode="w",
+            shape=(0, len(band_names), height, width),
+            chunks=chunks,
+            dtype=dtype,
+            fill_value=nodata,
+        )
+        array.attrs.update(
+            {
+                "band_names": list(band_names),
+                "crs": rasterio.crs.CRS.from_user_input(crs).to_wkt(),
+                "transform": list(transform)[:6],
+                "nodata": nodata,
+                "dates": [],
+                "sources": [],
+            }
+        )
+        logging.info(f"Created datacube {path} with shape {array.shape}")
+
+        return cls(path)
+
+    @property
+    def dates(self):
+        """
+        The acquisition datetimes of the stored crops, in the order in which they are stored.
+        """
+        return [datetime.fromisoformat(d) for d in self.array.attrs["dates"]]
+
+    @property
+    def sources(self):
+        """
+        The file names of the stored crops, in the order in which they are stored.
+        """
+        return list(self.array.attrs["sources"])
+
+    def __band_indexes(self, src):
+        """
+        Map the bands of the datacube to the bands of a .tif file by their description, or by position without descriptions.
+        """
+        descriptions = list(src.descriptions)
+        indexes = []
+        for i, band_name in enumerate(self.band_names):
+            if band_name in descriptions:
+                indexes.append(descriptions.index(band_name) + 1)
+            elif not any(descriptions) and i < src.count:
+                indexes.append(i + 1)
+            else:
+                indexes.append(None)
+        return indexes
+
+    def append(self, tif_file: str, resampling=Resampling.nearest):
+        """
+        Snap a .tif file to the grid of the datacube and add it as a new date.
+
+        Files which are already in the datacube are skipped. A file which extends past the grid of the datacube is
+        not clipped, a error is raised, build a new datacube on a larger grid for it.
+
+        @param tif_file: path to a cropped .tif file.
+        @param resampling: the rasterio resampling method used to snap to the grid.
+        @return: the time index of the file in the datacube.
+        """
+        source_name = os.path.basename(tif_file)
+        sources = self.sources
+        if source_name in sources:
+            print(f"{source_name} is already in the datacube")
+            return sources.index(source_name)
+
+        self.__trim()
+        time_index, bands, height, width = self.array.shape
+        chunk_height, chunk_width = self.array.chunks[2], self.array.chunks[3]
+        # Blocks without data are only skipped when no interrupted append left data at this time index.
+        skip_empty = time_index >= self.unfinished_until
+
+        with rasterio.open(tif_file, "r") as src:
+            left, bottom, right, top = transform_bounds(src.crs, self.crs, *src.bounds)
+            grid_left, grid_bottom, grid_right, grid_top = (
+                rasterio.transform.array_bounds(height, width, self.transform)
+            )
+            # Half a pixel of tolerance for the snapping to the grid.
+            tolerance = abs(self.transform.a) / 2
+            if (
+                left < grid_left - tolerance
+                or bottom < grid_bottom - tolerance
+                or right > grid_right + tolerance
+                or top > grid_top + tolerance
+            ):
+                raise ValueError(
+                    f"{tif_file} extends past the grid of the datacube {self.path}, "
+                    "build a new datacube which covers it"
+                )
+
+            self.array.resize((time_index + 1, bands, height, width))
+            band_indexes = self.__band_indexes(src)
+            with WarpedVRT(
+                src,
+                crs=self.crs,
+                transform=self.transform,
+                width=width,
+                height=height,
+                resampling=resampling,
+                nodata=self.nodata,
+            ) as vrt:
+                # Write per chunk, so memory stays bounded and untouched chunks stay empty.
+                for row_off in range(0, height, chunk_height):
+                    for col_off in range(0, width, chunk_width):
+                        window = Window(
+                            col_off,
+                            row_off,
+                            min(chunk_width, width - col_off),
+                            min(chunk_height, height - row_off),
+                        )
+                        block = np.full(
+                            (bands, int(window.height), int(window.width)),
+                            self.nodata,
+                            dtype=self.array.dtype,
+                        )
+                        for i, band_index in enumerate(band_indexes):
+                            if band_index is not None:
+                                block[i] = vrt.read(band_index, window=window)
+
+                        if skip_empty and np.all(block == self.nodata):
+                            continue
+
+                        self.array[
+                            time_index,
+                            :,
+                            row_off : row_off + block.shape[1],
+                            col_off : col_off + block.shape[2],
+                        ] = block
+
+        self.array.attrs.update(
+            {
+                "dates": self.array.attrs["dates"]
+                + [get_acquisition_datetime(tif_file).isoformat()],
+                "sources": sources + [source_name],
+            }
+        )
+        logging.info(f"Appended {tif_file} to datacube {self.path}")
+        print(f"Appended {tif_file} to the datacube")
+
+        return time_index
+
+    def read_timeseries(
+        self,
+        row_off: int,
+        col_off: int,
+        height: int = 1,
+        width: int = 1,
+        bands: list = None,
+    ):
+        """
+        Read the time series of a pixel window, sorted on date.
+
+        @param row_off: the first row of the window in the grid of the datacube.
+        @param col_off: the first column of the window in the grid of the datacube.
+        @param height: the number of rows of the window.
+        @param width: the number of columns of the window.
+        @param bands: the names of the bands to read, defaults to all bands.
+        @return: the sorted dates and a numpy array with shape (time, band, height, width).
+        """
+        band_indexes = (
+            [self.band_names.index(band) for band in bands]
+            if bands
+            else list(range(len(self.band_names)))
+        )
+        data = self.array[:, :, row_off : row_off + height, col_off : col_off + width][
+            :, band_indexes
+        ]
+
+        dates = self.dates
+        # Only the time indexes with a date are complete.
+        data = data[: len(dates)]
+        order = np.argsort(dates, kind="stable")
+
+        return [dates[i] for i in order], data[order]
+
+    def read_timeseries_xy(self, x: float, y: float, bands: list = None):
+        """
+        Read the time series of the pixel at a coordinate in the crs of the datacube.
+
+        @param x: the x coordinate.
+        @param y: the y coordinate.
+        @param bands: the names of the bands to read, defaults to all bands.
+        @return: the sorted dates and a numpy array with shape (time, band).
+        """
+        row, col = rasterio.transform.rowcol(self.transform, x, y)
+        dates, data = self.read_timeseries(row, col, bands=bands)
+
+        return dates, data[:, :, 0, 0]
+
+
+def build_datacube(
+    tif_files: list,
+    path: str,
+    resolution: float = None,
+    band_names: list = None,
+    chunks: tuple = (8, 1, 256, 256),
+):
+    """
+    Build a datacube of all the crops of a region, or append the new crops when the datacube already exists.
+
+    @param tif_files: paths to the cropped .tif files of a region, for example from nso_georegion.check_already_downloaded_links.
+    @param path: path of the zarr store.
+    @param resolution: the resolution of the common grid, defaults to the coarsest resolution of the files.
+    @param band_names: the bands to store, defaults to the descriptions of the first file.
+    @param chunks: the chunk size as (time, band, y, x).
+    @return: the datacube.
+    """
+    tif_files = sorted(tif_files, key=get_acquisition_datetime)
+
+    if os.path.exists(path):
+        datacube = region_datacube(path)
+    else:
+        crs, transform, width, height = get_common_grid(tif_files, resolution)
+        with rasterio.open(tif_files[0], "r") as src:
+            if band_names is None:
+                band_names = [
+                    description if description else f"band_{i + 1}"
+                    for i, description in enumerate(src.descriptions)
+                ]
+            dtype = src.dtypes[0]
+            nodata = src.nodata if src.nodata is not None else 0
+
+        datacube = region_datacube.create(
+            path,
+            crs,
+            transform,
+            width,
+            height,
+            band_names,
+            dtype=dtype,
+            nodata=nodata,
+            chunks=chunks,
+        )
+
+    for tif_file in tif_files:
+        datacube.append(tif_file)
+
+    return datacube
@@ -0,0 +1,296 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import Resampling, transform_bounds
+from rasterio.windows import from_bounds
+from shapely.geometry import box
+from shapely.strtree import STRtree
+
+"""
+    A height source over a folder of AHN tiles.
+
+    The AHN covers the Netherlands in thousands of tiles. The bounds of the tiles are kept in a spatial index, so for
+    a crop only the tiles which intersect it are opened, and of those only the window which covers the crop is read
+    and resampled onto the grid of the satellite image. The index is saved next to the tiles, so the tiles are only
+    opened once to build it.
+
+    The height grid of a satellite grid is cached by the grid (crs, transform, width and height) in memory within a
+    byte budget and, when a cache folder is given, on disk. Grids from the cache folder are memory mapped, so they do
+    not count against the budget. Different dates of the same region share their grid, so the height is only
+    resampled the first time.
+
+    @author: Michael de Winter, Pieter Kouyzer
+"""
+
+TILE_INDEX_FILE_NAME = "ahn_tile_index.json"
+
+# The number of bytes of height grids kept in memory, a float32 grid of 30 cm over 10 by 10 km is about 4.4 GB.
+DEFAULT_MAX_BYTES = 1024**3
+
+# The number of height grids kept open, also memory mapped grids.
+MAX_CACHED_GRIDS = 64
+
+# One height source per folder for callers which pass a folder.
+_sources = {}
+_sources_lock = threading.Lock()
+
+
+def get_grid_key(crs, transform, width, height, resampling=Resampling.nearest):
+    """
+    Get the cache key of a grid.
+
+    @param crs: the crs of the grid.
+    @param transform: the affine transform of the grid.
+    @param width: the width of the grid in pixels.
+    @param height: the height of the grid in pixels.
+    @param resampling: the resampling used for the grid.
+    @return: a hex string.
+    """
+    grid = (
+        f"{rasterio.crs.CRS.from_user_input(crs).to_wkt()}|"
+        f"{tuple(round(value, 9) for value in tuple(transform)[:6])}|"
+        f"{width}|{height}|{Resampling(resampling).name}"
+    )
+    return hashlib.sha1(grid.encode()).hexdigest()[:20]
+
+
+class ahn_height_source:
+    """
+    Height data of a folder of AHN tiles with a spatial index and a cache of resampled height grids.
+    """
+
+    def __init__(
+        self,
+        tile_folder: str,
+        cache_folder: str = None,
+        pattern: str = "**/*.tif",
+        resampling=Resampling.nearest,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        """
+        Init of the height source, the tile index is loaded or built.
+
+        @param tile_folder: the folder with the AHN .tif tiles.
+        @param cache_folder: optional folder where resampled height grids are kept between runs.
+        @param pattern: the glob pattern of the tiles in the tile folder.
+        @param resampling: the resampling of the height onto the satellite grid.
+        @param max_bytes: the number of bytes of height grids kept in memory, grids which are memory mapped from the cache folder do not count.
+        """
+        if not os.path.isdir(tile_folder):
+            raise ValueError(f"AHN tile folder {tile_folder} does not exist")
+
+        self.tile_folder = tile_folder
+        self.cache_folder = cache_folder
+        self.pattern = pattern
+        self.resampling = resampling
+        self.max_bytes = max_bytes
+        self.grids = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+        if cache_folder is not None:
+            os.makedirs(cache_folder, exist_ok=True)
+
+        self.tiles = self.__load_index()
+        if len(self.tiles) == 0:
+            raise ValueError(f"No AHN tiles found in {tile_folder}")
+
+        self.crs = rasterio.crs.CRS.from_user_input(self.tiles[0]["crs"])
+        self.tree = STRtree([box(*tile["bounds"]) for tile in self.tiles])
+
+    def __load_index(self):
+        """
+        Load the tile index, tiles which are new or changed since the index was saved are opened again.
+        """
+        index_path = os.path.join(self.tile_folder, TILE_INDEX_FILE_NAME)
+        saved = {}
+        if os.path.isfile(index_path):
+            with open(index_path, "r") as index_file:
+                saved = {tile["path"]: tile for tile in json.load(index_file)}
+
+        tiles = []
+        changed = False
+        for path in sorted(
+            glob.glob(os.path.join(self.tile_folder, self.pattern), recursive=True)
+        ):
+            relative_path = os.path.relpath(path, self.tile_folder).replace("\\", "/")
+            stat = os.stat(path)
+            tile = saved.get(relative_path)
+            if (
+                tile is None
+                or tile["size"] != stat.st_size
+                or tile["mtime"] != stat.st_mtime
+            ):
+                with rasterio.open(path, "r") as src:
+                    tile = {
+                        "path": relative_path,
+                        "size": stat.st_size,
+                        "mtime": stat.st_mtime,
+                        "bounds": list(src.bounds),
+                        "crs": src.crs.to_string(),
+                        "res": list(src.res),
+                    }
+                changed = True
+            tiles.append(tile)
+
+        if changed or len(tiles) != len(saved):
+            try:
+                with open(index_path + ".part", "w") as index_file:
+                    json.dump(tiles, index_file)
+                os.replace(index_path + ".part", index_path)
+            except OSError as e:
+                logging.info(f"Could not save the AHN tile index: {e}")
+
+        logging.info(f"Loaded the index of {len(tiles)} AHN tiles")
+        return tiles
+
+    def get_tiles(self, bounds, crs=None):
+        """
+        Get the tiles which intersect bounds.
+
+        @param bounds: left, bottom, right, top.
+        @param crs: the crs of the bounds, defaults to the crs of the tiles.
+        @return: a list of paths to the tiles.
+        """
+        if crs is not None and rasterio.crs.CRS.from_user_input(crs) != self.crs:
+            bounds = transform_bounds(crs, self.crs, *bounds)
+
+        indices = sorted(self.tree.query(box(*bounds), predicate="intersects"))
+        return [
+            os.path.join(self.tile_folder, *self.tiles[i]["path"].split("/"))
+            for i in indices
+        ]
+
+    def __resample(self, crs, transform, width, height):
+        """
+        Read the height of the intersecting tiles resampled onto a grid.
+        """
+        grid = np.zeros((height, width), dtype=np.float32)
+        filled = np.zeros((height, width), dtype=bool)
+        grid_bounds = rasterio.transform.array_bounds(height, width, transform)
+
+        for tile_path in self.get_tiles(grid_bounds, crs):
+            with rasterio.open(tile_path, "r") as src, WarpedVRT(
+                src,
+                crs=crs,
+                transform=transform,
+                width=width,
+                height=height,
+                resampling=self.resampling,
+            ) as vrt:
+                # Only the part of the grid which the tile covers is read.
+                tile_bounds = transform_bounds(src.crs, crs, *src.bounds)
+                # Pixels which the tile only partly covers are read as well, the mask of the tile decides.
+                tile_window = from_bounds(*tile_bounds, transform=transform)
+                row_start = int(np.floor(tile_window.row_off))
+                col_start = int(np.floor(tile_window.col_off))
+                try:
+                    window = rasterio.windows.Window(
+                        col_start,
+                        row_start,
+                        int(np.ceil(tile_window.col_off + tile_window.width))
+                        - col_start,
+                        int(np.ceil(tile_window.row_off + tile_window.height))
+                        - row_start,
+                    ).intersection(rasterio.windows.Window(0, 0, width, height))
+                except rasterio.errors.WindowError:
+                    continue
+                rows, cols = window.toslices()
+                data = vrt.read(1, window=window, masked=True)
+                fill = ~np.ma.getmaskarray(data) & ~filled[rows, cols]
+                grid[rows, cols][fill] = data.data[fill]
+                filled[rows, cols] |= fill
+
+        return grid
+
+    def get_height(self, crs, transform, width, height):
+        """
+        Get the height resampled onto a grid, from the cache when the grid was seen before.
+
+        @param crs: the crs of the grid, i.e. of the satellite image.
+        @param transform: the affine transform of the grid.
+        @param width: the width of the grid in pixels.
+        @param height: the height of the grid in pixels.
+        @return: a 2d float32 numpy array, 0 where no tile has data.
+        """
+        key = get_grid_key(crs, transform, width, height, self.resampling)
+
+        with self.lock:
+            if key in self.grids:
+                self.grids.move_to_end(key)
+                return self.grids[key][0]
+
+        cache_path = (
+            os.path.join(self.cache_folder, f"height_{key}.npy")
+            if self.cache_folder is not None
+            else None
+        )
+        if cache_path is not None and not os.path.isfile(cache_path):
+            grid = self.__resample(crs, transform, width, height)
+            np.save(cache_path + ".part.npy", grid)
+            os.replace(cache_path + ".part.npy", cache_path)
+            del grid
+
+        if cache_path is not None:
+            # Memory mapped, the operating system keeps only the parts which are read in memory.
+            logging.info(f"Using cached height grid {cache_path}")
+            grid = np.load(cache_path, mmap_mode="r")
+            nbytes = 0
+        else:
+            grid = self.__resample(crs, transform, width, height)
+            # The grid is shared by all users of the cache.
+            grid.flags.writeable = False
+            nbytes = grid.nbytes
+
+        with self.lock:
+            if key not in self.grids:
+                self.grids[key] = (grid, nbytes)
+                self.nbytes += nbytes
+            while (
+                self.nbytes > self.max_bytes or len(self.grids) > MAX_CACHED_GRIDS
+            ) and len(self.grids) > 1:
+                _, (_, old_nbytes) = self.grids.popitem(last=False)
+                self.nbytes -= old_nbytes
+
+        return grid
+
+    def read_bounds(self, bounds, resolution=None):
+        """
+        Read the height of bounds on a grid in the crs of the tiles.
+
+        @param bounds: left, bottom, right, top in the crs of the tiles.
+        @param resolution: the resolution of the grid, defaults to the resolution of the first tile.
+        @return: the height as a 2d numpy array and its transform.
+        """
+        resolution = resolution if resolution else self.tiles[0]["res"][0]
+        left, bottom, right, top = bounds
+        width = max(1, int(round((right - left) / resolution)))
+        height = max(1, int(round((top - bottom) / resolution)))
+        transform = from_origin(left, top, resolution, resolution)
+
+        return self.get_height(self.crs, transform, width, height), transform
+
+
+def get_height_source(tile_folder: str, cache_folder: str = None):
+    """
+    Get the shared height source of a folder of AHN tiles, made on first use.
+
+    @param tile_folder: the folder with the AHN .tif tiles.
+    @param cache_folder: optional folder where resampled height grids are kept between runs.
+    @return: a ahn_height_source.
+    """
+    with _sources_lock:
+        if (tile_folder, cache_folder) not in _sources:
+            _sources[(tile_folder, cache_folder)] = ahn_height_source(
+                tile_folder, cache_folder
+            )
+        return _sources[(tile_folder, cache_folder)]
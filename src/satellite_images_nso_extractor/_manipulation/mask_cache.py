@@ -0,0 +1,194 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.windows import Window
+
+"""
+    A cache of crop windows and rasterized crop masks per grid.
+
+    Cropping a region rasterizes its geometry on the grid of the satellite image. The satellite images of a region
+    over many dates mostly share the same grid, so the crop window and the mask are cached by the grid (crs,
+    transform, width and height) and a hash of the geometry. Masks are kept bit packed, in memory within a byte budget
+    and, when a cache folder is given, on disk so other runs share them.
+
+    @author: Michael de Winter, Pieter Kouyzer
+"""
+
+# The number of bytes of packed masks kept in memory.
+DEFAULT_MAX_BYTES = 256 * 1024**2
+
+# The shared in memory cache for callers which do not pass a cache.
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_geometry_hash(shapes):
+    """
+    Get a hash of shapely geometries.
+
+    @param shapes: a list of shapely geometries.
+    @return: a hex string.
+    """
+    geometry_hash = hashlib.sha1()
+    for shape in shapes:
+        geometry_hash.update(shape.wkb)
+    return geometry_hash.hexdigest()
+
+
+def get_mask_key(dataset, shapes):
+    """
+    Get the cache key of the crop of shapes on the grid of a dataset.
+
+    @param dataset: an opened rasterio dataset.
+    @param shapes: a list of shapely geometries in the crs of the dataset.
+    @return: a hex string.
+    """
+    grid = (
+        f"{dataset.crs.to_wkt() if dataset.crs else ''}|"
+        f"{tuple(round(value, 9) for value in tuple(dataset.transform)[:6])}|"
+        f"{dataset.width}|{dataset.height}|{get_geometry_hash(shapes)}"
+    )
+    return hashlib.sha1(grid.encode()).hexdigest()[:20]
+
+
+class crop_mask:
+    """
+    The crop window of shapes on a grid and the bit packed mask of the pixels outside the shapes.
+    """
+
+    def __init__(self, window: Window, packed: np.ndarray):
+        """
+        Init of the crop mask.
+
+        @param window: the crop window on the grid of the satellite image.
+        @param packed: the mask of the crop window, packed along the rows with np.packbits.
+        """
+        self.window = window
+        self.packed = packed
+        self.nbytes = packed.nbytes
+
+    def outside(self, window: Window):
+        """
+        Get the mask of a window of the crop.
+
+        @param window: a window relative to the crop window.
+        @return: a boolean array which is True outside of the shapes.
+        """
+        rows = self.packed[int(window.row_off) : int(window.row_off + window.height)]
+        columns = np.unpackbits(rows, axis=1, count=int(self.window.width))
+        return columns[
+            :, int(window.col_off) : int(window.col_off + window.width)
+        ].astype(bool)
+
+
+class mask_cache:
+    """
+    Crop masks by grid and geometry, in memory and optionally on disk.
+    """
+
+    def __init__(self, cache_folder: str = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Init of the cache.
+
+        @param cache_folder: optional folder where masks are kept between runs.
+        @param max_bytes: the number of bytes of packed masks kept in memory.
+        """
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.masks = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+        if cache_folder is not None:
+            os.makedirs(cache_folder, exist_ok=True)
+
+    def __remember(self, key, mask):
+        """
+        Keep a mask in memory, the least recently used masks are dropped.
+        """
+        with self.lock:
+            if key in self.masks:
+                return
+            self.masks[key] = mask
+            self.nbytes += mask.nbytes
+            while self.nbytes > self.max_bytes and len(self.masks) > 1:
+                _, old_mask = self.masks.popitem(last=False)
+                self.nbytes -= old_mask.nbytes
+
+    def get(self, dataset, shapes):
+        """
+        Get the crop window and mask of shapes on the grid of a dataset, rasterized when not cached.
+
+        @param dataset: an opened rasterio dataset.
+        @param shapes: a list of shapely geometries in the crs of the dataset.
+        @return: a crop_mask.
+        """
+        key = get_mask_key(dataset, shapes)
+
+        with self.lock:
+            if key in self.masks:
+                self.masks.move_to_end(key)
+                return self.masks[key]
+
+        cache_path = (
+            os.path.join(self.cache_folder, f"mask_{key}.npz")
+            if self.cache_folder is not None
+            else None
+        )
+        if cache_path is not None and os.path.isfile(cache_path):
+            with np.load(cache_path) as cached:
+                mask = crop_mask(
+                    Window(*[int(value) for value in cached["window"]]),
+                    cached["packed"],
+                )
+            logging.info(f"Using cached crop mask {cache_path}")
+        else:
+            try:
+                window = geometry_window(dataset, shapes)
+            except rasterio.errors.WindowError:
+                raise ValueError("Input shapes do not overlap raster.")
+            outside = geometry_mask(
+                shapes,
+                out_shape=(int(window.height), int(window.width)),
+                transform=dataset.window_transform(window),
+            )
+            mask = crop_mask(window, np.packbits(outside, axis=1))
+
+            if cache_path is not None:
+                with open(cache_path + ".part", "wb") as cache_file:
+                    np.savez(
+                        cache_file,
+                        window=np.array(
+                            [
+                                window.col_off,
+                                window.row_off,
+                                window.width,
+                                window.height,
+                            ],
+                            dtype=np.int64,
+                        ),
+                        packed=mask.packed,
+                    )
+                os.replace(cache_path + ".part", cache_path)
+
+        self.__remember(key, mask)
+        return mask
+
+
+def get_default_cache():
+    """
+    Get the shared in memory mask cache, made on first use.
+
+    @return: a mask_cache.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = mask_cache()
+        return _default_cache
@@ -0,0 +1,218 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import Resampling
+from rasterio.windows import from_bounds
+
+from satellite_images_nso_extractor._manipulation.datacube import get_common_grid
+from satellite_images_nso_extractor._manipulation.window_executor import (
+    window_executor,
+)
+from satellite_images_nso_extractor._manipulation.zonal_statistics import (
+    block_windows,
+)
+
+"""
+    Mosaics of many cropped .tif files, for example all crops of a province.
+
+    The inputs are put on a virtual common grid in the CRS of the inputs, nothing is read up front. The output is
+    written block by block in parallel, per block only the inputs which overlap the block are opened. Memory is
+    bounded by the block size and the number of threads, whatever the number of inputs.
+
+    Overlap rules:
+    - first: where inputs overlap the first input in the list is kept.
+    - last: where inputs overlap the last input in the list is kept.
+    - min_cloud: where inputs overlap the input with the lowest cloud cover is kept.
+
+    @author: Michael de Winter, Pieter Kouyzer
+"""
+
+MOSAIC_RULES = ["first", "last", "min_cloud"]
+
+# The number of inputs every thread keeps open, the least recently used inputs are closed.
+MAX_OPEN_INPUTS = 64
+
+
+def get_input_order(tif_files, rule, cloud_cover=None):
+    """
+    Get the order in which inputs are painted, an input only fills pixels which are still empty.
+
+    @param tif_files: paths to the .tif files.
+    @param rule: one of "first", "last" or "min_cloud".
+    @param cloud_cover: the cloud cover per .tif file, needed for "min_cloud".
+    @return: a list of indices into tif_files.
+    """
+    if rule == "first":
+        return list(range(len(tif_files)))
+    if rule == "last":
+        return list(reversed(range(len(tif_files))))
+    if rule == "min_cloud":
+        if cloud_cover is None or len(cloud_cover) != len(tif_files):
+            raise ValueError("min_cloud needs one cloud_cover value per .tif file")
+        cloud_cover = [100 if value is None else value for value in cloud_cover]
+        return sorted(range(len(tif_files)), key=lambda i: float(cloud_cover[i]))
+
+    raise ValueError(f"Unknown mosaic rule: {rule}")
+
+
+def build_mosaic(
+    tif_files: list,
+    output_file: str,
+    rule: str = "first",
+    cloud_cover: list = None,
+    resolution: float = None,
+    block_size: int = 1024,
+    workers: int = 4,
+    executor=None,
+):
+    """
+    Build a mosaic of .tif files with the same CRS and bands, block by block.
+
+    @param tif_files: paths to the .tif files.
+    @param output_file: path of the resulting .tif file.
+    @param rule: which input is kept where inputs overlap, one of "first", "last" or "min_cloud".
+    @param cloud_cover: the cloud cover per .tif file, needed for "min_cloud", for example the cloudcover of the links.
+    @param resolution: the resolution of the mosaic, defaults to the coarsest resolution of the inputs.
+    @param block_size: the size in pixels of the blocks which are written at once.
+    @param workers: the number of threads which build blocks at the same time.
+    @param executor: optional window_executor with the GDAL settings, overrides workers and block_size.
+    @return: the path of the mosaic.
+    """
+    executor = (
+        executor
+        if executor is not None
+        else window_executor(workers=workers, block_size=block_size)
+    )
+    order = get_input_order(tif_files, rule, cloud_cover)
+    crs, transform, width, height = get_common_grid(tif_files, resolution)
+
+    # The pixel extent of every input on the common grid, to find the inputs of a block without opening them.
+    extents = []
+    for tif_file in tif_files:
+        with rasterio.open(tif_file, "r") as src:
+            window = from_bounds(*src.bounds, transform=transform)
+            extents.append(
+                (
+                    window.row_off,
+                    window.col_off,
+                    window.row_off + window.height,
+                    window.col_off + window.width,
+                )
+            )
+
+    with rasterio.open(tif_files[order[0]], "r") as src:
+        profile = src.profile
+        descriptions = src.descriptions
+        count = src.count
+        nodata = src.nodata if src.nodata is not None else 0
+
+    profile.update(
+        {
+            "driver": "GTiff",
+            "interleave": "band",
+            "tiled": True,
+            "blockxsize": 256,
+            "blockysize": 256,
+            "compress": "deflate",
+            "BIGTIFF": "IF_SAFER",
+            "crs": crs,
+            "transform": transform,
+            "width": width,
+            "height": height,
+            "nodata": nodata,
+        }
+    )
+
+    # Every thread keeps its own opened inputs, rasterio datasets can not be shared between threads.
+    local = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def get_input(i):
+        if not hasattr(local, "inputs"):
+            local.inputs = OrderedDict()
+        if i in local.inputs:
+            local.inputs.move_to_end(i)
+            return local.inputs[i][0]
+
+        if len(local.inputs) >= MAX_OPEN_INPUTS:
+            _, (old_vrt, old_src) = local.inputs.popitem(last=False)
+            old_vrt.close()
+            old_src.close()
+            with lock:
+                opened.remove(old_vrt)
+                opened.remove(old_src)
+
+        src = rasterio.open(tif_files[i], "r")
+        vrt = WarpedVRT(
+            src,
+            crs=crs,
+            transform=transform,
+            width=width,
+            height=height,
+            nodata=nodata,
+            resampling=Resampling.nearest,
+        )
+        local.inputs[i] = (vrt, src)
+        with lock:
+            opened.extend([vrt, src])
+        return vrt
+
+    def mosaic_window(window):
+        block = np.full((count, window.height, window.width), nodata, profile["dtype"])
+        empty = np.ones((window.height, window.width), dtype=bool)
+
+        for i in order:
+            row_start, col_start, row_stop, col_stop = extents[i]
+            if (
+                row_stop <= window.row_off
+                or row_start >= window.row_off + window.height
+                or col_stop <= window.col_off
+                or col_start >= window.col_off + window.width
+            ):
+                continue
+
+            vrt = get_input(i)
+            if vrt.count != count:
+                raise ValueError(f"Band count mismatch for {tif_files[i]}")
+
+            data = vrt.read(window=window)
+            valid = (vrt.read_masks(1, window=window) > 0) & np.any(
+                data != nodata, axis=0
+            )
+            fill = empty & valid
+            block[:, fill] = data[:, fill]
+            empty &= ~fill
+
+            if not empty.any():
+                break
+
+        return block
+
+    print(f"Building a mosaic of {len(tif_files)} files with rule {rule}")
+    windows = list(block_windows(width, height, executor.block_size))
+
+    try:
+        # Written to a .part file first, so a crash never leaves a half written mosaic behind.
+        with executor.env(), rasterio.open(
+            output_file + ".part", "w", **profile
+        ) as dst:
+            executor.run(
+                windows,
+                mosaic_window,
+                lambda window, block: dst.write(block, window=window),
+            )
+            dst.descriptions = descriptions
+        os.replace(output_file + ".part", output_file)
+    finally:
+        for dataset in opened:
+            dataset.close()
+
+    logging.info(f"Built a mosaic of {len(tif_files)} files in {output_file}")
+
+    return output_file
@@ -1,3 +1,4 @@
+import contextlib
 import logging
 import shutil
 import geopandas as gpd
@@ -7,17 +8,27 @@ import rasterio
 import tqdm
 from matplotlib import pyplot as plt
 from rasterio.plot import show
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
 from rasterio.warp import (
     Resampling,
     calculate_default_transform,
     reproject,
     transform_geom,
 )
-from shapely.geometry import box, Polygon
+from shapely.geometry import Polygon
 from satellite_images_nso_extractor._index_channels.calculate_index_channels import (
-    generate_ndvi_channel,
-    generate_ndwi_channel,
-    generate_red_edge_ndvi_channel,
+    get_index_channel,
+)
+from satellite_images_nso_extractor._manipulation.height_source import (
+    ahn_height_source,
+    get_height_source,
+)
+from satellite_images_nso_extractor._manipulation.mask_cache import (
+    get_default_cache,
+)
+from satellite_images_nso_extractor._manipulation.window_executor import (
+    window_executor,
 )
 from shapely.geometry import mapping
 import os
@@ -29,19 +40,14 @@ import os
 """
 
 
-def __make_the_crop(
-    coordinates, raster_path, raster_path_cropped, buffered_georegion, plot
-):
+def get_crop_geometry(coordinates, buffered_georegion):
     """
-    This crops the satellite image with a chosen shape.
+    Make the polygons to crop on in rijks driehoek from the coordinates of a georegion.
 
-    TODO: Make this accept a object of geopandas or shapely and crs independent.
-    @param coordinates: Coordinates of the polygon to make the crop on.
-    @param raster_path: path to the raster .tiff file.
-    @param raster_path_cropped: path were the cropped raster will be stored.
-    @param plot: Plot the results true or false
+    @param coordinates: Coordinates of the polygon to make the crop on, in WGS84.
+    @param buffered_georegion: whether the coordinates are of a multipolygon.
+    @return: a list of shapely polygons in EPSG:28992.
     """
-
     # For polygons.
     if not buffered_georegion:
         geometry = [Polygon(coords) for coords in coordinates]
@@ -55,46 +61,160 @@ def __make_the_crop(
 
     # Change the crs to rijks driehoek, because all the satelliet images are in rijks driehoek
     agdf = gpd.GeoDataFrame(geometry=geometry, crs="EPSG:4326").to_crs(epsg=28992)
-    area_to_crop = agdf["geometry"]
+    return list(agdf["geometry"])
 
-    with rasterio.open(raster_path) as src:
+
+def get_band_descriptions(count):
+    """
+    Get the band descriptions of a satellite image by its number of bands.
+
+    WARNING: we only assume Superview or PNEO satellites here! Change for your specific satellite
+
+    @param count: the number of bands.
+    @return: the descriptions or None for a unknown satellite.
+    """
+    if count == 4:
+        print("Assuming Superview Satellite columns")
+        return ("r", "g", "b", "i")
+    elif count == 6:
+        print("Assuming PNEO Satellite columns")
+        return ("r", "g", "b", "n", "e", "d")
+    return None
+
+
+def __crop_regions(raster_path, crops, executor, masks=None):
+    """
+    Crop one satellite image to several shapes in one pass.
+
+    Only the blocks of the satellite image which overlap a crop are read, every block is read once and cut into the
+    crops which overlap it, so overlapping crops share their reads.
+
+    @param raster_path: path to the raster .tiff file.
+    @param crops: a dictionary of the path of a cropped raster to the shapes to crop on, in the crs of the raster.
+    @param executor: a window_executor.
+    @param masks: optional mask_cache with the crop windows and masks, defaults to the shared in memory cache.
+    """
+    masks = masks if masks is not None else get_default_cache()
+    plans = {}
+    with executor.env(), rasterio.open(raster_path) as src:
         print("raster path opened")
+        nodata = src.nodata if src.nodata is not None else 0
+        descriptions = get_band_descriptions(src.count)
+
+        for raster_path_cropped, shapes in crops.items():
+            try:
+                mask = masks.get(src, shapes)
+            except ValueError:
+                raise ValueError(
+                    f"Input shapes of {raster_path_cropped} do not overlap raster."
+                )
+            crop_window = mask.window
+            out_profile = src.profile
+            out_profile.update(
+                {
+                    "driver": "GTiff",
+                    "interleave": "band",
+                    "tiled": True,
+                    "height": int(crop_window.height),
+                    "width": int(crop_window.width),
+                    "transform": src.window_transform(crop_window),
+                }
+            )
+            plans[raster_path_cropped] = (crop_window, out_profile, mask)
+
+        # Only the blocks which overlap a crop are read.
+        source_windows = [
+            window
+            for window in executor.windows(src)
+            if any(
+                rasterio.windows.intersect(window, crop_window)
+                for crop_window, _, _ in plans.values()
+            )
+        ]
 
-        out_image, out_transform = rasterio.mask.mask(
-            src, area_to_crop, crop=True, filled=True
-        )
-        out_profile = src.profile
-
-        out_profile.update(
-            {
-                "driver": "GTiff",
-                "interleave": "band",
-                "tiled": True,
-                "height": out_image.shape[1],
-                "width": out_image.shape[2],
-                "transform": out_transform,
-            }
-        )
+    def crop_block(window):
+        data = executor.dataset(raster_path).read(window=window)
+        pieces = []
+        for raster_path_cropped, (crop_window, _, mask) in plans.items():
+            if not rasterio.windows.intersect(window, crop_window):
+                continue
+            part = window.intersection(crop_window)
+            if part.width <= 0 or part.height <= 0:
+                continue
 
-        # WARNING: we only assume Superview or PNEO satellites here! Change for your specific satellite
-        if src.count == 4:
-            print("Assuming Superview Satellite columns")
-            descriptions = ("r", "g", "b", "i")
-        elif src.count == 6:
-            print("Assuming PNEO Satellite columns")
-            descriptions = ("r", "g", "b", "n", "e", "d")
-    print("convert to RD")
+            row_start = int(part.row_off - window.row_off)
+            col_start = int(part.col_off - window.col_off)
+            piece = data[
+                :,
+                row_start : row_start + int(part.height),
+                col_start : col_start + int(part.width),
+            ].copy()
+            out_window = Window(
+                int(part.col_off - crop_window.col_off),
+                int(part.row_off - crop_window.row_off),
+                int(part.width),
+                int(part.height),
+            )
+            piece[:, mask.outside(out_window)] = nodata
+            pieces.append((raster_path_cropped, out_window, piece))
+        return pieces
+
+    # The crops are written to .part files which are renamed when complete, so a crash never leaves half a crop.
+    with executor.env(), contextlib.ExitStack() as stack:
+        destinations = {
+            raster_path_cropped: stack.enter_context(
+                rasterio.open(raster_path_cropped + ".part", "w", **out_profile)
+            )
+            for raster_path_cropped, (_, out_profile, _) in plans.items()
+        }
 
-    try:
-        with rasterio.open(raster_path_cropped, "w", **out_profile) as dest:
-            dest.write(out_image)
-            dest.descriptions = descriptions
-            dest.close()
-    except:
-        print("Error on making descriptions")
-        with rasterio.open(raster_path_cropped, "w", **out_profile) as dest:
-            dest.write(out_image)
-            dest.close()
+        def write_pieces(window, pieces):
+            for raster_path_cropped, out_window, piece in pieces:
+                destinations[raster_path_cropped].write(piece, window=out_window)
+
+        executor.run(source_windows, crop_block, write_pieces)
+
+        for dest in destinations.values():
+            if descriptions is not None:
+                dest.descriptions = descriptions
+            else:
+                print("Error on making descriptions")
+
+    for raster_path_cropped in plans:
+        os.replace(raster_path_cropped + ".part", raster_path_cropped)
+
+
+def __make_the_crop(
+    coordinates,
+    raster_path,
+    raster_path_cropped,
+    buffered_georegion,
+    plot,
+    executor=None,
+    area_to_crop=None,
+    masks=None,
+):
+    """
+    This crops the satellite image with a chosen shape.
+
+    The crop is read, masked and written window by window on the threads of the executor.
+
+    TODO: Make this accept a object of geopandas or shapely and crs independent.
+    @param coordinates: Coordinates of the polygon to make the crop on.
+    @param raster_path: path to the raster .tiff file.
+    @param raster_path_cropped: path were the cropped raster will be stored.
+    @param plot: Plot the results true or false
+    @param executor: optional window_executor, defaults to one thread per core.
+    @param area_to_crop: optional polygons in rijks driehoek made before with get_crop_geometry, instead of the coordinates.
+    @param masks: optional mask_cache, defaults to the shared in memory cache.
+    """
+    executor = executor if executor is not None else window_executor()
+
+    if area_to_crop is None:
+        area_to_crop = get_crop_geometry(coordinates, buffered_georegion)
+        print("convert to RD")
+
+    __crop_regions(raster_path, {raster_path_cropped: area_to_crop}, executor, masks)
 
     if plot:
         print(
@@ -113,121 +233,168 @@ def __make_the_crop(
         src.close()
 
 
-def add_index_channels(tif_input_file: str, channel_types: list):
+def clip_to_dtype(data: np.array, dtype) -> np.array:
+    """
+    Cast index values to the dtype of a raster.
+
+    For integer dtypes the values are clipped to the range of the dtype first, so a value out of range, like a
+    negative evi, saturates instead of wrapping around, i.e. -6566 would otherwise be stored as 58970 in uint16.
+
+    @param data: numpy array with the index values.
+    @param dtype: the numpy dtype of the raster.
+    @return: numpy array in dtype.
+    """
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        data = np.clip(data, np.iinfo(dtype).min, np.iinfo(dtype).max)
+    return data.astype(dtype)
+
+
+def add_index_channels(
+    tif_input_file: str, channel_types: list, executor=None, delete_input=True
+):
     """
     Add various index channels to a .tif file.
 
+    The .tif file is read once, window by window on the threads of the executor, and all index channels are
+    calculated from the same window.
+
     @param tif_input_file: Path to a .tif file.
-    @param channel_types: Valid channel_types are: ["ndvi", "re_ndvi", "ndwi"]
+    @param channel_types: names of registered index channels, i.e. ["ndvi", "re_ndvi", "ndwi"], see calculate_index_channels.register_index_channel
+    @param executor: optional window_executor, defaults to one thread per core.
+    @param delete_input: whether to delete the .tif file without the index channels.
     """
     if len(channel_types) == 0:
         return tif_input_file
 
     file_to = tif_input_file
+    channels = []
     for channel_type in channel_types:
-        if channel_type not in ["ndvi", "re_ndvi", "ndwi"]:
-            raise ValueError(f"Unknown channel type: {channel_type}")
+        channels.append(get_index_channel(channel_type))
         file_to = file_to.replace(".tif", f"_{channel_type}.tif")
 
+    executor = executor if executor is not None else window_executor()
+
     with rasterio.open(tif_input_file, "r") as dataset:
-        profile = dataset.profile
-        profile.update(count=dataset.count + len(channel_types))
+        count = dataset.count + len(channel_types)
         descriptions = dataset.descriptions + tuple(channel_types)
-        index_channels = []
-
-        for channel_type in channel_types:
-            if channel_type == "ndvi":
-                index_channels += [generate_ndvi_channel(dataset)]
-            if channel_type == "re_ndvi":
-                index_channels += [generate_red_edge_ndvi_channel(dataset)]
-            if channel_type == "ndwi":
-                index_channels += [generate_ndwi_channel(dataset)]
-            print(f"Done with calculating {channel_type} channel")
-
-    with rasterio.open(file_to, "w", **profile) as output_dataset:
-        print(f"Saving to {file_to}")
-        with rasterio.open(tif_input_file, "r") as dataset:
-            for band in range(1, dataset.count + 1):
-                output_dataset.write_band(band, dataset.read(band))
-        for i in range(0, len(index_channels)):
-            output_dataset.write_band(dataset.count + 1 + i, index_channels[i])
-        output_dataset.descriptions = descriptions
-
-    os.remove(tif_input_file)
+        dtype = np.dtype(dataset.dtypes[0])
+
+    def add_index_data(data, window):
+        index_data = [clip_to_dtype(channel(data), dtype) for channel in channels]
+        return np.concatenate([data, np.stack(index_data)])
+
+    print(f"Saving to {file_to}")
+    executor.process(
+        tif_input_file,
+        file_to,
+        add_index_data,
+        profile={"count": count},
+        descriptions=descriptions,
+    )
+
+    for channel_type in channel_types:
+        print(f"Done with calculating {channel_type} channel")
+
+    if delete_input:
+        os.remove(tif_input_file)
     return file_to
 
 
-def add_height(tif_input_file, height_tif_file):
+def add_height(tif_input_file, height_tif_file, executor=None):
     """
 
-    Adds height(From a lidar data source) and Normalized difference vegetation index (NDVI) as extra bands to a .tif file.
+    Adds height(From a lidar data source) as a extra band to a .tif file.
 
-    Exports a new .tif file with _ndvi_height.tif behind it's original file name.
+    Exports a new .tif file with _height.tif behind it's original file name.
+    The height is resampled onto the grid of the .tif file window by window on the threads of the executor.
 
-    @param tif_input_file: The tif file where 2 extra bands need to be added.
-    @param height_tif_file: The tif file in 2d which shall be added to the tif input file.
+    @param tif_input_file: The tif file where the extra band needs to be added.
+    @param height_tif_file: The tif file in 2d which shall be added to the tif input file, a folder of AHN tiles or a ahn_height_source.
+    @param executor: optional window_executor, defaults to one thread per core.
     """
     print("Adding height to tif file")
     output_file_path = tif_input_file.replace(".tif", "_height.tif")
+    executor = executor if executor is not None else window_executor()
 
     with rasterio.open(tif_input_file, "r") as input_src:
-        input_res_x = input_src.res[0]
-        crop_window = box(*input_src.bounds)
-        profile = input_src.profile
-        profile.update(count=profile["count"] + 1)
+        crs = input_src.crs
+        transform = input_src.transform
+        width, height = input_src.width, input_src.height
+        count = input_src.count + 1
+        dtype = np.dtype(input_src.dtypes[0])
         descriptions = input_src.descriptions + ("height",)
 
-    with rasterio.open(height_tif_file, "r") as height_src:
-        height_res_x = height_src.res[0]
+    if isinstance(height_tif_file, str) and os.path.isdir(height_tif_file):
+        height_tif_file = get_height_source(height_tif_file)
 
-        scale = height_res_x / input_res_x
+    if isinstance(height_tif_file, ahn_height_source):
+        # Only the tiles which intersect the .tif file are read, the grid is cached for other dates of the region.
+        height_grid = height_tif_file.get_height(crs, transform, width, height)
 
-        scaled_transform = rasterio.Affine(
-            height_src.transform.a / scale,
-            height_src.transform.b,
-            height_src.transform.c,
-            height_src.transform.d,
-            height_src.transform.e / scale,
-            height_src.transform.f,
-        )
-        scaled_profile = height_src.profile
-        scaled_profile.update(
-            transform=scaled_transform,
-            driver="GTiff",
-            height=height_src.height * scale,
-            width=height_src.width * scale,
-            crs=height_src.crs,
+        def add_height_data(data, window):
+            rows, cols = window.toslices()
+            return np.concatenate([data, height_grid[None, rows, cols].astype(dtype)])
+
+        executor.process(
+            tif_input_file,
+            output_file_path,
+            add_height_data,
+            profile={"count": count},
+            descriptions=descriptions,
         )
-        scaled_data = height_src.read(
-            out_shape=(
-                int(height_src.count),
-                int(height_src.width * scale),
-                int(height_src.height * scale),
-            ),
+        return output_file_path
+
+    def open_height():
+        # The WarpedVRT does not close the .tif file it is made of, the executor does.
+        height_src = executor.track(rasterio.open(height_tif_file, "r"))
+        return WarpedVRT(
+            height_src,
+            crs=crs,
+            transform=transform,
+            width=width,
+            height=height,
             resampling=Resampling.nearest,
         )
 
-    with rasterio.open(output_file_path, "w", **scaled_profile) as destination:
-        destination.write(scaled_data)
-
-    with rasterio.open(output_file_path, "r") as destination:
-        masked_height, _ = rasterio.mask.mask(destination, [crop_window], crop=True)
-
-    with rasterio.open(output_file_path, "w", **profile) as destination:
-        with rasterio.open(tif_input_file, "r") as input_src:
-            for i in range(1, profile["count"]):
-                destination.write_band(i, input_src.read(i))
-        destination.write_band(profile["count"], masked_height.squeeze())
-        destination.descriptions = descriptions
+    def add_height_data(data, window):
+        height_vrt = executor.dataset(height_tif_file, open_height)
+        height_data = height_vrt.read(1, window=window)
+        return np.concatenate([data, height_data[None].astype(dtype)])
+
+    executor.process(
+        tif_input_file,
+        output_file_path,
+        add_height_data,
+        profile={"count": count},
+        descriptions=descriptions,
+    )
     return output_file_path
 
 
-def get_ahn_data(ahn_input_file):
+def get_ahn_data(ahn_input_file, bounds=None):
     """
     This function returns height data from a ahn file.
 
-    @param ahn_input_file
+    @param ahn_input_file: a ahn .tif file, a folder of AHN tiles or a ahn_height_source.
+    @param bounds: left, bottom, right, top to read in the crs of the ahn, the whole file is read when not given.
     """
+    if isinstance(ahn_input_file, str) and os.path.isdir(ahn_input_file):
+        ahn_input_file = get_height_source(ahn_input_file)
+
+    if isinstance(ahn_input_file, ahn_height_source):
+        if bounds is None:
+            raise ValueError("Bounds are needed to read height data of AHN tiles")
+        return ahn_input_file.read_bounds(bounds)
+
+    if bounds is not None:
+        with rasterio.open(ahn_input_file, "r") as inds:
+            window = rasterio.windows.from_bounds(*bounds, transform=inds.transform)
+            window = window.round_offsets().round_lengths()
+            return inds.read(1, window=window, boundless=True), inds.window_transform(
+                window
+            )
+
     inds = rasterio.open(ahn_input_file, "r")
     vegetation_height_data = inds.read(1)
     vegetation_height_transform = inds.meta["transform"]
@@ -288,7 +455,17 @@ def move_tiff(raster_path_cropped, raster_path_cropped_moved):
         logging.error(f"Failed to move tiff to {raster_path_cropped_moved}")
 
 
-def run(raster_path, coordinates, region_name, output_folder, buffered_georegion, plot):
+def run(
+    raster_path,
+    coordinates,
+    region_name,
+    output_folder,
+    buffered_georegion,
+    plot,
+    executor=None,
+    area_to_crop=None,
+    masks=None,
+):
     """
     Main run method, combines the cropping of the file based on the shape.
 
@@ -297,6 +474,9 @@ def run(raster_path, coordinates, region_name, output_folder, buffered_georegion
     @param region_name: the region name of the cropped area to be saved in the file name.
     @param output_folder: Which output folder to store the .tif file.
     @param plot: Whether or not to plot the cropped image.
+    @param executor: optional window_executor, defaults to one thread per core.
+    @param area_to_crop: optional polygons in rijks driehoek made before with get_crop_geometry, instead of the coordinates.
+    @param masks: optional mask_cache, defaults to the shared in memory cache.
     @return: the path where the cropped file is stored or where the nvdi is stored.
     """
     raster_path_cropped_moved = ""
@@ -310,7 +490,14 @@ def run(raster_path, coordinates, region_name, output_folder, buffered_georegion
     print("New cropped filename: " + raster_path_cropped)
     logging.info("New cropped filename: " + raster_path_cropped)
     __make_the_crop(
-        coordinates, raster_path, raster_path_cropped, buffered_georegion, plot
+        coordinates,
+        raster_path,
+        raster_path_cropped,
+        buffered_georegion,
+        plot,
+        executor,
+        area_to_crop,
+        masks,
     )
     print(f"finished cropping {raster_path}")
     logging.info(f"Finished cropping file {raster_path}")
@@ -325,3 +512,57 @@ def run(raster_path, coordinates, region_name, output_folder, buffered_georegion
     move_tiff(raster_path_cropped, raster_path_cropped_moved)
 
     return raster_path_cropped_moved
+
+
+def crop_many(
+    raster_path,
+    regions: dict,
+    output_folder,
+    crs="EPSG:4326",
+    executor=None,
+    masks=None,
+):
+    """
+    Crop one satellite image to many regions in a single pass.
+
+    The satellite image is opened once and every block of it is read at most once, the blocks are cut into all
+    regions which overlap them. Use this instead of run when several regions fall in the same satellite image.
+
+    @param raster_path: path to a raster file.
+    @param regions: a dictionary of region names to shapely geometries, the region name is saved in the file name.
+    @param output_folder: Which output folder to store the .tif files, or a dictionary of region names to folders.
+    @param crs: the crs of the geometries.
+    @param executor: optional window_executor, defaults to one thread per core.
+    @param masks: optional mask_cache, defaults to the shared in memory cache.
+    @return: a dictionary of region names to the paths where the cropped files are stored.
+    """
+    executor = executor if executor is not None else window_executor()
+
+    with rasterio.open(raster_path) as src:
+        raster_crs = src.crs
+    names = list(regions.keys())
+    geometries = gpd.GeoSeries([regions[name] for name in names], crs=crs).to_crs(
+        raster_crs
+    )
+
+    file_name = raster_path.replace("\\", "/").split("/")[-1]
+    cropped_paths = {
+        name: (
+            output_folder[name] if isinstance(output_folder, dict) else output_folder
+        )
+        + "/"
+        + file_name.replace(".tif", "_" + name + "_cropped.tif")
+        for name in names
+    }
+
+    print(f"cropping file {raster_path} to {len(names)} regions")
+    logging.info(f"cropping file {raster_path} to {len(names)} regions")
+    __crop_regions(
+        raster_path,
+        {cropped_paths[name]: [geometry] for name, geometry in zip(names, geometries)},
+        executor,
+        masks,
+    )
+    logging.info(f"Finished cropping file {raster_path} to {len(names)} regions")
+
+    return cropped_paths
@@ -0,0 +1,201 @@
+import glob
+import json
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+from satellite_images_nso_extractor._index_channels.calculate_index_channels import (
+    generate_index_channel_from_array,
+)
+
+"""
+    Export of the pixels of a cropped .tif file to a partitioned parquet dataset.
+
+    The .tif file is streamed in strips of rows, every strip becomes one parquet file, so memory stays bounded
+    whatever the size of the crop. Pixels outside of the polygon (nodata) are dropped.
+
+    The parquet files can be read with pandas.read_parquet or geopandas on the output folder.
+
+    @author: Michael de Winter, Pieter Kouyzer
+"""
+
+
+def __valid_pixels(dataset, data, window):
+    """
+    Get a mask of the pixels which are inside of the cropped polygon.
+
+    @param dataset: the opened rasterio dataset.
+    @param data: the data of the window.
+    @param window: the window which has been read.
+    @return: a boolean numpy array with the shape of the window.
+    """
+    valid = dataset.read_masks(1, window=window) > 0
+
+    # Crops without a nodata value are filled with 0 outside of the polygon.
+    if dataset.nodata is None:
+        valid &= np.any(data != 0, axis=0)
+
+    return valid
+
+
+def __export_strip(
+    raster_path,
+    window,
+    output_file,
+    coordinates,
+    index_channels,
+    compression,
+    local,
+    opened,
+):
+    """
+    Read one strip of rows, turn it into a table and write it to a parquet file.
+
+    @return: the number of pixels written.
+    """
+    # Rasterio datasets can not be shared between threads, so every thread opens its own.
+    if not hasattr(local, "dataset"):
+        local.dataset = rasterio.open(raster_path, "r")
+        opened.append(local.dataset)
+    dataset = local.dataset
+
+    data = dataset.read(window=window)
+    valid = __valid_pixels(dataset, data, window)
+    rows, cols = np.nonzero(valid)
+    if len(rows) == 0:
+        return 0
+
+    rows = (rows + int(window.row_off)).astype(np.int32)
+    cols = (cols + int(window.col_off)).astype(np.int32)
+
+    columns = {}
+    if coordinates == "rowcol":
+        columns["row"] = rows
+        columns["col"] = cols
+    elif coordinates == "xy":
+        xs, ys = rasterio.transform.xy(dataset.transform, rows, cols)
+        columns["x"] = np.asarray(xs, dtype=np.float64)
+        columns["y"] = np.asarray(ys, dtype=np.float64)
+
+    for band in range(dataset.count):
+        name = dataset.descriptions[band] or f"band_{band + 1}"
+        columns[name] = data[band][valid]
+
+    for channel_type in index_channels:
+        columns[channel_type] = generate_index_channel_from_array(channel_type, data)[
+            valid
+        ].astype(np.float32)
+
+    table = pa.table(columns)
+    pq.write_table(table, output_file, compression=compression)
+
+    return len(rows)
+
+
+def export_pixels_to_parquet(
+    raster_path: str,
+    output_folder: str,
+    coordinates: str = "rowcol",
+    index_channels: list = [],
+    rows_per_partition: int = 512,
+    workers: int = 4,
+    compression: str = "zstd",
+):
+    """
+    Export the pixels of a .tif file to a folder of parquet files, one file per strip of rows.
+
+    Parquet files of an earlier export to the same folder are deleted first.
+
+    Band columns keep the dtype of the .tif file, index channels are float32 and row/col are int32.
+
+    @param raster_path: path to a (cropped) .tif file.
+    @param output_folder: folder where the parquet files will be written to.
+    @param coordinates: "rowcol" for pixel row and col columns or "xy" for x and y coordinates in the crs of the .tif file.
+    @param index_channels: names of registered index channels to calculate on the fly, i.e. ["ndvi", "re_ndvi", "ndwi"]
+    @param rows_per_partition: the number of raster rows in one parquet file.
+    @param workers: the number of threads which read and write partitions at the same time.
+    @param compression: the parquet compression codec.
+    @return: the number of pixels written.
+    """
+    if not PYARROW_AVAILABLE:
+        raise ImportError("Exporting to parquet requires pyarrow, pip install pyarrow")
+
+    if coordinates not in ["rowcol", "xy"]:
+        raise ValueError(f"Unknown coordinates: {coordinates}")
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Parts of an earlier export would be read as part of this one, the strips can differ.
+    for stale_part in glob.glob(os.path.join(output_folder, "part-*.parquet")):
+        os.remove(stale_part)
+
+    with rasterio.open(raster_path, "r") as dataset:
+        width, height = dataset.width, dataset.height
+        metadata = {
+            "source": os.path.basename(raster_path),
+            "crs": dataset.crs.to_string() if dataset.crs else None,
+            "transform": list(dataset.transform)[:6],
+            "width": width,
+            "height": height,
+        }
+
+    with open(os.path.join(output_folder, "_metadata.json"), "w") as metadata_file:
+        json.dump(metadata, metadata_file)
+
+    print(f"Exporting {raster_path} to {output_folder}")
+    local = threading.local()
+    opened = []
+    pixels_written = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running = set()
+            for part, row_off in enumerate(range(0, height, rows_per_partition)):
+                window = Window(
+                    0, row_off, width, min(rows_per_partition, height - row_off)
+                )
+                output_file = os.path.join(output_folder, f"part-{part:05d}.parquet")
+
+                # Bound the number of strips in memory.
+                if len(running) >= workers * 2:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    pixels_written += sum(future.result() for future in done)
+
+                running.add(
+                    executor.submit(
+                        __export_strip,
+                        raster_path,
+                        window,
+                        output_file,
+                        coordinates,
+                        index_channels,
+                        compression,
+                        local,
+                        opened,
+                    )
+                )
+
+            pixels_written += sum(future.result() for future in running)
+    finally:
+        for dataset in opened:
+            dataset.close()
+
+    logging.info(
+        f"Exported {pixels_written} pixels of {raster_path} to {output_folder}"
+    )
+    print(f"Exported {pixels_written} pixels")
+
+    return pixels_written
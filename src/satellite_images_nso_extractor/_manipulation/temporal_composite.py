@@ -0,0 +1,194 @@
+import logging
+import os
+import threading
+import warnings
+
+import numpy as np
+import rasterio
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import Resampling
+
+from satellite_images_nso_extractor._index_channels.calculate_index_channels import (
+    generate_index_channel_from_array,
+)
+from satellite_images_nso_extractor._manipulation.datacube import get_common_grid
+from satellite_images_nso_extractor._manipulation.window_executor import (
+    window_executor,
+)
+from satellite_images_nso_extractor._manipulation.zonal_statistics import (
+    block_windows,
+)
+
+"""
+    Temporal compositing of many cropped scenes of a region into one cloud light mosaic.
+
+    All scenes are read at once per spatial block, so memory is bounded by the block size times the number of scenes.
+    Blocks are computed in parallel and written in order.
+
+    Methods:
+    - median: the per pixel median of every band over the scenes which have data.
+    - max_ndvi: per pixel the bands of the scene with the highest ndvi, clouds have a low ndvi.
+    - least_cloudy: per pixel the bands of the scene with the lowest cloud cover, when no cloud cover is given the scene
+      with the lowest blue value is used, since clouds are bright in blue.
+
+    @author: Michael de Winter, Pieter Kouyzer
+"""
+
+COMPOSITE_METHODS = ["median", "max_ndvi", "least_cloudy"]
+
+
+def __composite_block(data, valid, method, cloud_cover, nodata):
+    """
+    Composite a block of all the scenes.
+
+    @param data: numpy array with shape (scenes, bands, height, width).
+    @param valid: boolean numpy array with shape (scenes, height, width).
+    @return: numpy array with shape (bands, height, width).
+    """
+    any_valid = valid.any(axis=0)
+
+    if method == "median":
+        values = np.where(valid[:, None], data, np.nan).astype(np.float32)
+        # Pixels without any data give an "All-NaN slice" warning, they are set to nodata below.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            composite = np.nanmedian(values, axis=0)
+        composite = np.where(any_valid, np.nan_to_num(composite, nan=nodata), nodata)
+        return composite.astype(data.dtype)
+
+    if method == "max_ndvi":
+        score = np.stack(
+            [generate_index_channel_from_array("ndvi", scene) for scene in data]
+        )
+        score = np.where(valid, score, -np.inf)
+        best = np.argmax(score, axis=0)
+    elif method == "least_cloudy":
+        if cloud_cover is not None:
+            score = np.broadcast_to(
+                np.asarray(cloud_cover, dtype=np.float32)[:, None, None], valid.shape
+            )
+        else:
+            # Band 3 is blue for both Superview and PNEO.
+            score = data[:, 2].astype(np.float32)
+        score = np.where(valid, score, np.inf)
+        best = np.argmin(score, axis=0)
+
+    composite = np.take_along_axis(data, best[None, None], axis=0)[0]
+    return np.where(any_valid, composite, nodata).astype(data.dtype)
+
+
+def temporal_composite(
+    tif_files: list,
+    output_file: str,
+    method: str = "median",
+    cloud_cover: list = None,
+    resolution: float = None,
+    block_size: int = 512,
+    workers: int = 4,
+    executor=None,
+):
+    """
+    Composite cropped scenes of a region into one .tif file.
+
+    @param tif_files: paths to cropped .tif files of the same region with the same bands.
+    @param output_file: path of the resulting .tif file.
+    @param method: one of "median", "max_ndvi" or "least_cloudy".
+    @param cloud_cover: optional cloud cover per scene used by "least_cloudy", for example the cloudcover of the links.
+    @param resolution: the resolution of the composite, defaults to the coarsest resolution of the scenes.
+    @param block_size: the size in pixels of the blocks which are composited at once.
+    @param workers: the number of threads which composite blocks at the same time.
+    @param executor: optional window_executor with the GDAL settings, overrides workers and block_size.
+    @return: the path of the composite.
+    """
+    executor = (
+        executor
+        if executor is not None
+        else window_executor(workers=workers, block_size=block_size)
+    )
+    if method not in COMPOSITE_METHODS:
+        raise ValueError(f"Unknown composite method: {method}")
+    if cloud_cover is not None and len(cloud_cover) != len(tif_files):
+        raise ValueError("cloud_cover needs one value per .tif file")
+
+    crs, transform, width, height = get_common_grid(tif_files, resolution)
+
+    with rasterio.open(tif_files[0], "r") as src:
+        profile = src.profile
+        descriptions = src.descriptions
+        count = src.count
+        nodata = src.nodata if src.nodata is not None else 0
+
+    for tif_file in tif_files[1:]:
+        with rasterio.open(tif_file, "r") as src:
+            if src.count != count:
+                raise ValueError(f"Band count mismatch for {tif_file}")
+
+    profile.update(
+        {
+            "driver": "GTiff",
+            "interleave": "band",
+            "tiled": True,
+            "blockxsize": 256,
+            "blockysize": 256,
+            "compress": "deflate",
+            "crs": crs,
+            "transform": transform,
+            "width": width,
+            "height": height,
+            "nodata": nodata,
+        }
+    )
+
+    # Every thread keeps its own opened scenes, rasterio datasets can not be shared between threads.
+    local = threading.local()
+    opened = []
+    lock = threading.Lock()
+
+    def scenes():
+        if not hasattr(local, "vrts"):
+            local.vrts = []
+            for tif_file in tif_files:
+                src = rasterio.open(tif_file, "r")
+                vrt = WarpedVRT(
+                    src,
+                    crs=crs,
+                    transform=transform,
+                    width=width,
+                    height=height,
+                    nodata=nodata,
+                    resampling=Resampling.nearest,
+                )
+                local.vrts.append(vrt)
+                with lock:
+                    opened.extend([vrt, src])
+        return local.vrts
+
+    def composite_window(window):
+        vrts = scenes()
+        data = np.stack([vrt.read(window=window) for vrt in vrts])
+        valid = np.stack([vrt.read_masks(1, window=window) > 0 for vrt in vrts])
+        valid &= np.any(data != nodata, axis=1)
+        return __composite_block(data, valid, method, cloud_cover, nodata)
+
+    print(f"Compositing {len(tif_files)} scenes with {method} to {output_file}")
+    windows = list(block_windows(width, height, executor.block_size))
+
+    try:
+        # Written to a .part file first, so a crash never leaves a half written composite behind.
+        with executor.env(), rasterio.open(
+            output_file + ".part", "w", **profile
+        ) as dst:
+            executor.run(
+                windows,
+                composite_window,
+                lambda window, block: dst.write(block, window=window),
+            )
+            dst.descriptions = descriptions
+        os.replace(output_file + ".part", output_file)
+    finally:
+        for dataset in opened:
+            dataset.close()
+
+    logging.info(f"Composited {len(tif_files)} scenes to {output_file}")
+
+    return output_file
@@ -0,0 +1,237 @@
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import rasterio
+from rasterio.windows import Window
+
+"""
+    A thread parallel executor for rasters which are processed window by window.
+
+    GDAL reads and writes and most numpy operations release the GIL, so one large scene can use all cores when it is
+    split in windows which are read and computed on a thread pool. The windows are aligned to the internal blocks of
+    the input, so no block is decoded twice. The results are written in the order of the windows by the calling
+    thread, rasterio datasets which are written can not be shared between threads. The number of windows in memory is
+    bounded, and the first error of a window stops the run and is raised with the window in the message.
+
+    The GDAL block cache and the number of GDAL threads, used for example for compression, are set with rasterio.Env
+    for the duration of a run. By default GDAL uses one thread per worker thread, and when several processes run
+    executors, like the workers of nso-batch, the cores are divided over the processes.
+
+    @author: Michael de Winter, Pieter Kouyzer
+"""
+
+DEFAULT_BLOCK_SIZE = 1024
+
+# The GDAL block cache in megabytes, shared by all threads.
+DEFAULT_GDAL_CACHE_MB = 512
+
+# The environment variable with the number of processes which run executors at the same time.
+PROCESSES_ENVIRONMENT_VARIABLE = "NSO_EXECUTOR_PROCESSES"
+
+
+def get_default_workers():
+    """
+    Get the default number of threads, the number of cores divided by the number of processes in
+    NSO_EXECUTOR_PROCESSES.
+    """
+    try:
+        processes = max(1, int(os.environ.get(PROCESSES_ENVIRONMENT_VARIABLE, 1)))
+    except ValueError:
+        processes = 1
+    return max(1, (os.cpu_count() or 1) // processes)
+
+
+def aligned_windows(dataset, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Split a raster in windows of about block_size pixels which are aligned to the internal blocks of the raster.
+
+    @param dataset: an opened rasterio dataset.
+    @param block_size: the size of a window in pixels, rounded up to a multiple of the internal block size.
+    @return: a list of rasterio windows.
+    """
+    block_height, block_width = dataset.block_shapes[0]
+    window_height = max(1, -(-block_size // block_height)) * block_height
+    window_width = max(1, -(-block_size // block_width)) * block_width
+
+    return [
+        Window(
+            col_off,
+            row_off,
+            min(window_width, dataset.width - col_off),
+            min(window_height, dataset.height - row_off),
+        )
+        for row_off in range(0, dataset.height, window_height)
+        for col_off in range(0, dataset.width, window_width)
+    ]
+
+
+class window_executor:
+    """
+    Runs a computation per window on a thread pool and writes the results in order.
+    """
+
+    def __init__(
+        self,
+        workers: int = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        gdal_cache_mb: int = DEFAULT_GDAL_CACHE_MB,
+        gdal_threads=1,
+        max_pending: int = None,
+    ):
+        """
+        Init of the executor.
+
+        @param workers: the number of threads, defaults to the number of cores divided by the number of processes.
+        @param block_size: the size in pixels of the windows.
+        @param gdal_cache_mb: the size of the GDAL block cache in megabytes.
+        @param gdal_threads: the number of threads GDAL uses itself per worker thread, for example for compression, or "ALL_CPUS".
+        @param max_pending: the maximum number of computed windows in memory, defaults to twice the number of threads.
+        """
+        self.workers = workers if workers else get_default_workers()
+        self.block_size = block_size
+        self.gdal_cache_mb = gdal_cache_mb
+        self.gdal_threads = gdal_threads
+        self.max_pending = max_pending if max_pending else self.workers * 2
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def env(self):
+        """
+        Get the rasterio.Env with the GDAL settings of the executor.
+        """
+        return rasterio.Env(
+            GDAL_CACHEMAX=self.gdal_cache_mb * 1024**2,
+            GDAL_NUM_THREADS=str(self.gdal_threads),
+        )
+
+    def windows(self, dataset):
+        """
+        Get the windows of a raster, see aligned_windows.
+
+        @param dataset: an opened rasterio dataset.
+        """
+        return aligned_windows(dataset, self.block_size)
+
+    def dataset(self, path, opener=None):
+        """
+        Get a dataset which is opened once per thread, rasterio datasets can not be shared between threads.
+
+        The datasets are closed at the end of the run. Only call this from the compute function of a run.
+
+        @param path: path to the raster, also the key of the dataset.
+        @param opener: optional function which opens the dataset, for example a WarpedVRT, defaults to rasterio.open.
+        @return: the opened dataset of this thread.
+        """
+        if not hasattr(self.local, "datasets"):
+            self.local.datasets = {}
+        if path not in self.local.datasets:
+            dataset = opener() if opener else rasterio.open(path, "r")
+            self.local.datasets[path] = self.track(dataset)
+        return self.local.datasets[path]
+
+    def track(self, dataset):
+        """
+        Close a dataset at the end of the run, for example the source of a WarpedVRT.
+
+        @param dataset: an opened rasterio dataset.
+        @return: the dataset.
+        """
+        with self.lock:
+            self.local.opened.append(dataset)
+        return dataset
+
+    def run(self, windows, compute, write):
+        """
+        Compute every window on the thread pool and write the results in the order of the windows.
+
+        @param windows: the windows to process.
+        @param compute: function of a window which returns its result, runs on the threads.
+        @param write: function of a window and its result, runs on the calling thread in the order of the windows.
+        """
+        windows = list(windows)
+        pending = deque()
+        # The datasets opened by the threads of this run, runs of the same executor can overlap.
+        opened = []
+
+        def compute_window(window):
+            self.local.opened = opened
+            return compute(window)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                try:
+                    for window in windows:
+                        pending.append(
+                            (window, executor.submit(compute_window, window))
+                        )
+                        if len(pending) >= self.max_pending:
+                            self.__write_first(pending, write)
+                    while pending:
+                        self.__write_first(pending, write)
+                except BaseException:
+                    for _, future in pending:
+                        future.cancel()
+                    raise
+        finally:
+            with self.lock:
+                for dataset in reversed(opened):
+                    dataset.close()
+
+    def __write_first(self, pending, write):
+        """
+        Wait for the oldest window and write it.
+        """
+        window, future = pending.popleft()
+        try:
+            result = future.result()
+        except Exception as e:
+            logging.error(f"Failed to process window {window}: {e}")
+            raise Exception(f"Failed to process window {window}: {e}") from e
+        write(window, result)
+
+    def process(
+        self, input_file, output_file, compute, profile=None, descriptions=None
+    ):
+        """
+        Compute a new raster from one input raster, window by window.
+
+        The result is written to a .part file which is renamed when it is complete, so a crash never leaves a half
+        written raster behind. When a window fails the .part file is removed before the error is raised.
+
+        @param input_file: path to the input raster.
+        @param output_file: path of the resulting raster.
+        @param compute: function of the data of a window and the window, returns the data to write for the window.
+        @param profile: optional changes to the profile of the input, like count or dtype.
+        @param descriptions: optional band descriptions of the result.
+        @return: the path of the result.
+        """
+        with self.env():
+            with rasterio.open(input_file, "r") as src:
+                output_profile = src.profile
+                windows = self.windows(src)
+            output_profile.update(profile or {})
+
+            def compute_window(window):
+                return compute(self.dataset(input_file).read(window=window), window)
+
+            try:
+                with rasterio.open(output_file + ".part", "w", **output_profile) as dst:
+                    self.run(
+                        windows,
+                        compute_window,
+                        lambda window, data: dst.write(data, window=window),
+                    )
+                    if descriptions is not None:
+                        dst.descriptions = descriptions
+            except Exception:
+                # A failed run leaves nothing behind, the half written raster is of no use.
+                if os.path.isfile(output_file + ".part"):
+                    os.remove(output_file + ".part")
+                raise
+            os.replace(output_file + ".part", output_file)
+
+        return output_file
@@ -0,0 +1,275 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window
+from shapely.geometry import box
+
+from satellite_images_nso_extractor._index_channels.calculate_index_channels import (
+    generate_index_channel_from_array,
+)
+
+"""
+    Raster native zonal statistics.
+
+    Polygon zones, for example a habitat map, are rasterized onto the grid of a cropped .tif file block by block.
+    Per zone and per band or index channel the mean, std, min, max, count and optionally a histogram are accumulated,
+    so no GeoDataFrame with one row per pixel is needed. The std is the sample std (ddof=1) like pandas, so it is
+    NaN for a zone with one pixel.
+
+    Pixels which are masked in the .tif file or which are nodata in every band are left out, cropped files without
+    a nodata value have 0 outside of the region.
+
+    @author: Michael de Winter, Pieter Kouyzer
+"""
+
+
+def block_windows(width, height, block_size=1024):
+    """
+    Split a raster in square windows of block_size pixels.
+
+    @param width: the width of the raster.
+    @param height: the height of the raster.
+    @param block_size: the size of a window in pixels.
+    @return: a generator of rasterio windows.
+    """
+    for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+            yield Window(
+                col_off,
+                row_off,
+                min(block_size, width - col_off),
+                min(block_size, height - row_off),
+            )
+
+
+class _zone_accumulator:
+    """
+    Running sums per zone for one band or index channel.
+    """
+
+    def __init__(self, number_of_zones, histogram_bins=None, histogram_range=None):
+        size = number_of_zones + 1
+        self.count = np.zeros(size, dtype=np.int64)
+        self.sum = np.zeros(size, dtype=np.float64)
+        self.sum_squared = np.zeros(size, dtype=np.float64)
+        self.min = np.full(size, np.inf, dtype=np.float64)
+        self.max = np.full(size, -np.inf, dtype=np.float64)
+
+        self.histogram_bins = histogram_bins
+        self.histogram_range = histogram_range
+        if histogram_bins:
+            self.histogram = np.zeros((size, histogram_bins), dtype=np.int64)
+
+    def add(self, zone_ids, values):
+        """
+        Add the values of valid pixels with their zone ids.
+
+        @param zone_ids: 1d numpy array with the zone id per pixel.
+        @param values: 1d numpy array with the value per pixel.
+        """
+        size = len(self.count)
+        values = values.astype(np.float64)
+
+        self.count += np.bincount(zone_ids, minlength=size)
+        self.sum += np.bincount(zone_ids, weights=values, minlength=size)
+        self.sum_squared += np.bincount(zone_ids, weights=values**2, minlength=size)
+        np.minimum.at(self.min, zone_ids, values)
+        np.maximum.at(self.max, zone_ids, values)
+
+        if self.histogram_bins:
+            low, high = self.histogram_range
+            bins = np.clip(
+                ((values - low) / (high - low) * self.histogram_bins).astype(np.int64),
+                0,
+                self.histogram_bins - 1,
+            )
+            self.histogram += np.bincount(
+                zone_ids * self.histogram_bins + bins,
+                minlength=size * self.histogram_bins,
+            ).reshape(size, self.histogram_bins)
+
+    def to_frame(self, zone_values, layer_name):
+        """
+        Turn the running sums into a dataframe with one row per zone which has pixels.
+
+        @param zone_values: the zone names, in order of zone id starting at 1.
+        @param layer_name: the name of the band or index channel.
+        """
+        has_pixels = self.count[1:] > 0
+        count = self.count[1:][has_pixels]
+        mean = self.sum[1:][has_pixels] / count
+        # The sample variance, like the std of pandas.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variance = np.where(
+                count > 1,
+                np.maximum(self.sum_squared[1:][has_pixels] - count * mean**2, 0)
+                / (count - 1),
+                np.nan,
+            )
+
+        frame = pd.DataFrame(
+            {
+                "zone": np.asarray(zone_values)[has_pixels],
+                "band": layer_name,
+                "mean": mean.astype(np.float32),
+                "std": np.sqrt(variance).astype(np.float32),
+                "min": self.min[1:][has_pixels].astype(np.float32),
+                "max": self.max[1:][has_pixels].astype(np.float32),
+                "count": count,
+            }
+        )
+        if self.histogram_bins:
+            frame["histogram"] = list(self.histogram[1:][has_pixels])
+
+        return frame
+
+
+def read_zones(zones, crs, zone_column=None):
+    """
+    Read the zones and reproject them to the crs of the raster.
+
+    @param zones: a GeoDataFrame or a path to a vector file with polygons.
+    @param crs: the crs of the raster.
+    @param zone_column: the column with the name of a zone, when not given the index is used.
+    @return: the reprojected zones and the zone names in order of zone id.
+    """
+    if isinstance(zones, str):
+        zones = gpd.read_file(zones)
+
+    zones = zones[~zones.geometry.is_empty & zones.geometry.notna()]
+    if zones.crs is None:
+        raise ValueError("Zones need a crs")
+    if zones.crs != crs:
+        zones = zones.to_crs(crs)
+
+    zone_values = zones[zone_column].values if zone_column else zones.index.values
+    return zones.reset_index(drop=True), zone_values
+
+
+def zonal_statistics(
+    raster_path: str,
+    zones,
+    zone_column: str = None,
+    bands: list = None,
+    index_channels: list = [],
+    histogram_bins: int = None,
+    histogram_range: tuple = (0, 200),
+    block_size: int = 1024,
+) -> pd.DataFrame:
+    """
+    Calculate statistics per zone directly from block wise reads of a .tif file.
+
+    Zones which overlap get the pixels of the zone which comes last. Pixels which are nodata, or 0 when the file
+    has no nodata value, in every band are left out.
+
+    @param raster_path: path to a (cropped) .tif file.
+    @param zones: a GeoDataFrame or path to a vector file with the polygon zones, for example a habitat map.
+    @param zone_column: the column with the name of a zone, when not given the index of the zones is used.
+    @param bands: the band numbers (1 based) to calculate statistics for, defaults to all bands.
+    @param index_channels: names of registered index channels to calculate on the fly, i.e. ["ndvi", "re_ndvi", "ndwi"]
+    @param histogram_bins: the number of histogram bins per zone, no histogram is made when this is None.
+    @param histogram_range: the (min, max) value range of the histogram.
+    @param block_size: the size in pixels of the blocks which are read.
+    @return pandas dataframe: with 'zone', 'band', 'mean', 'std', 'min', 'max', 'count' and optionally 'histogram' columns.
+    """
+    with rasterio.open(raster_path, "r") as dataset:
+        zones, zone_values = read_zones(zones, dataset.crs, zone_column)
+        bands = bands if bands else list(range(1, dataset.count + 1))
+        descriptions = dataset.descriptions
+        nodata = dataset.nodata if dataset.nodata is not None else 0
+
+        layer_names = [
+            descriptions[band - 1] if descriptions[band - 1] else f"band_{band}"
+            for band in bands
+        ] + list(index_channels)
+        accumulators = [
+            _zone_accumulator(len(zones), histogram_bins, histogram_range)
+            for _ in layer_names
+        ]
+
+        # Zone ids start at 1, 0 is used for pixels outside of any zone.
+        zone_shapes = list(zip(zones.geometry, range(1, len(zones) + 1)))
+
+        for window in block_windows(dataset.width, dataset.height, block_size):
+            window_transform = dataset.window_transform(window)
+            # Only rasterize the zones which touch this block.
+            zones_in_block = zones.sindex.query(
+                box(*rasterio.windows.bounds(window, dataset.transform))
+            )
+            if len(zones_in_block) == 0:
+                continue
+
+            zone_ids = rasterize(
+                [zone_shapes[i] for i in sorted(zones_in_block)],
+                out_shape=(int(window.height), int(window.width)),
+                transform=window_transform,
+                fill=0,
+                dtype="int32",
+            )
+            valid = (zone_ids > 0) & (dataset.read_masks(1, window=window) > 0)
+            if not valid.any():
+                continue
+
+            data = dataset.read(window=window)
+            # Pixels outside of the cropped region are nodata in every band.
+            valid &= ~np.all(data == nodata, axis=0)
+            if not valid.any():
+                continue
+
+            valid_zone_ids = zone_ids[valid]
+
+            for i, band in enumerate(bands):
+                accumulators[i].add(valid_zone_ids, data[band - 1][valid])
+
+            for i, channel_type in enumerate(index_channels):
+                index = generate_index_channel_from_array(channel_type, data)
+                accumulators[len(bands) + i].add(valid_zone_ids, index[valid])
+
+    logging.info(f"Calculated zonal statistics for {raster_path}")
+
+    result = pd.concat(
+        [
+            accumulator.to_frame(zone_values, layer_name)
+            for accumulator, layer_name in zip(accumulators, layer_names)
+        ],
+        ignore_index=True,
+    )
+    result["band"] = result["band"].astype("category")
+
+    return result
+
+
+def zonal_statistics_scenes(
+    raster_paths: list, zones, workers: int = 4, **kwargs
+) -> pd.DataFrame:
+    """
+    Calculate zonal statistics for many scenes of the same region in parallel.
+
+    @param raster_paths: a list of paths to (cropped) .tif files.
+    @param zones: a GeoDataFrame or path to a vector file with the polygon zones.
+    @param workers: the number of threads, each thread reads its own scene.
+    @param kwargs: other parameters for zonal_statistics.
+    @return pandas dataframe: the zonal_statistics of all the scenes with an extra 'scene' column.
+    """
+    if isinstance(zones, str):
+        zones = gpd.read_file(zones)
+
+    def scene_statistics(raster_path):
+        statistics = zonal_statistics(raster_path, zones, **kwargs)
+        statistics.insert(0, "scene", os.path.basename(raster_path))
+        return statistics
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(scene_statistics, raster_paths))
+
+    result = pd.concat(results, ignore_index=True)
+    result["scene"] = result["scene"].astype("category")
+    result["band"] = result["band"].astype("category")
+
+    return result
@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import re
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+    Selective extraction of NSO archives driven by a manifest.
+
+    An NSO archive holds the raster next to previews, metadata and sidecar products. The archive is listed once and
+    only the raster members (and the sidecar files with the same name, like .tfw or .aux.xml) which match the
+    requested bands and resolution are extracted, in parallel with large buffered copies. The chosen members are
+    recorded in a manifest in the extracted folder, so the raster can be found without walking the folder again.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+MANIFEST_FILE_NAME = "nso_manifest.json"
+
+# Members with these words in their name are previews or quality layers, not the satellite image itself.
+SKIPPED_RASTER_WORDS = ["preview", "thumbnail", "quicklook", "browse", "ql_"]
+
+
+def is_raster(name):
+    """
+    Check if a archive member is a satellite image.
+
+    @param name: the name of the member.
+    """
+    lower_name = name.lower()
+    return lower_name.endswith((".tif", ".tiff")) and not any(
+        word in os.path.basename(lower_name) for word in SKIPPED_RASTER_WORDS
+    )
+
+
+def select_members(zip_ref, bands=None, resolution=None):
+    """
+    Select the raster members, and their sidecar files, which match the bands and resolution.
+
+    When no raster matches the bands and resolution all rasters are selected, so a unknown naming scheme still works.
+
+    @param zip_ref: an open zipfile.ZipFile.
+    @param bands: optional bands which have to be in the name of a raster, i.e. "RGBNED".
+    @param resolution: optional resolution which has to be in the name of a raster, i.e. "30cm".
+    @return: the names of the selected members and the name of the main raster, the largest selected raster.
+    """
+    infos = [info for info in zip_ref.infolist() if not info.is_dir()]
+    rasters = [info for info in infos if is_raster(info.filename)]
+
+    matching = [
+        info
+        for info in rasters
+        if (bands is None or re.search(rf"{bands}(?![A-Z])", info.filename))
+        and (resolution is None or resolution in info.filename)
+    ]
+    if len(matching) == 0:
+        logging.info(
+            f"No raster matches {bands} and {resolution}, selecting all rasters"
+        )
+        matching = rasters
+    if len(matching) == 0:
+        raise Exception(f"No .tif found in archive {zip_ref.filename}")
+
+    stems = {os.path.splitext(info.filename)[0] for info in matching}
+    members = [
+        info.filename
+        for info in infos
+        if info in matching
+        or any(info.filename.startswith(stem + ".") for stem in stems)
+    ]
+    raster = max(matching, key=lambda info: info.file_size).filename
+
+    return members, raster
+
+
+def extract_member(path, member, folder, buffer_size=16 * 1024**2):
+    """
+    Extract one member of a zip file with a large buffer, a ZipFile is opened per call so it can run in a thread.
+
+    @param path: path to the zip file.
+    @param member: the name of the member.
+    @param folder: the folder to extract to.
+    @param buffer_size: the size of the copy buffer in bytes.
+    @return: the path of the extracted file.
+    """
+    target = os.path.join(folder, *member.split("/"))
+    if not os.path.abspath(target).startswith(os.path.abspath(folder) + os.sep):
+        raise Exception(f"Archive member {member} is outside of the extracted folder")
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    with zipfile.ZipFile(path, "r") as zip_ref:
+        with zip_ref.open(member) as source, open(target, "wb") as destination:
+            shutil.copyfileobj(source, destination, buffer_size)
+
+    return target
+
+
+def extract_selected(path, folder, bands=None, resolution=None, workers=4):
+    """
+    Extract only the needed members of a zip file in parallel and write a manifest.
+
+    @param path: path to the zip file.
+    @param folder: the folder to extract to.
+    @param bands: optional bands which have to be in the name of a raster, i.e. "RGBNED".
+    @param resolution: optional resolution which has to be in the name of a raster, i.e. "30cm".
+    @param workers: the number of members which are extracted at once.
+    @return: the manifest as a dictionary.
+    """
+    with zipfile.ZipFile(path, "r") as zip_ref:
+        members, raster = select_members(zip_ref, bands, resolution)
+        skipped = len(zip_ref.infolist()) - len(members)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(members)))) as executor:
+        list(executor.map(lambda member: extract_member(path, member, folder), members))
+
+    logging.info(f"Extracted {len(members)} members of {path}, skipped {skipped}")
+
+    manifest = {
+        "archive": os.path.basename(path),
+        "members": members,
+        "raster": raster,
+        "bands": bands,
+        "resolution": resolution,
+    }
+    with open(os.path.join(folder, MANIFEST_FILE_NAME), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    return manifest
+
+
+def read_manifest(folder):
+    """
+    Read the manifest of a extracted folder.
+
+    @param folder: the extracted folder.
+    @return: the manifest as a dictionary or None when the folder was extracted without a manifest.
+    """
+    manifest_path = os.path.join(folder, MANIFEST_FILE_NAME)
+    if not os.path.isfile(manifest_path):
+        return None
+
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def get_raster_path(folder):
+    """
+    Get the path of the main raster in a extracted folder from its manifest.
+
+    @param folder: the extracted folder.
+    @return: the path to the .tif file or None when there is no manifest.
+    """
+    manifest = read_manifest(folder)
+    if manifest is None:
+        return None
+
+    return os.path.join(folder, *manifest["raster"].split("/")).replace("\\", "/")
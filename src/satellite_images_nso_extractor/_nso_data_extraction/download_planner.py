@@ -0,0 +1,225 @@
+import glob
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import satellite_images_nso_extractor._nso_data_extraction.nso_client as nso_client
+
+"""
+    Dry run planning of download links before spending bandwidth.
+
+    For every link it estimates the download volume with a HEAD request, checks the local cache (zip file, extracted
+    folder and cropped .tif file) and estimates the crop size from the region area and resolution. From this it reports
+    the total download volume, the peak disk usage and the estimated runtime of a job.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+# Bands in order of preference when product variants of the same scene are deduplicated.
+DEFAULT_PREFERRED_BANDS = ["RGBNED", "RGBI", "RGB"]
+
+
+def get_download_size(link, user_n, pass_n, timeout=30, client=None):
+    """
+    Get the size of a download with a HEAD request.
+
+    @param link: a download link from the NSO.
+    @param user_n: NSO username.
+    @param pass_n: NSO password.
+    @param timeout: timeout of the request in seconds.
+    @param client: optional nso_client, defaults to the shared client of the account.
+    @return: the size in bytes or None when the server does not report it.
+    """
+    client = client if client is not None else nso_client.get_client(user_n, pass_n)
+    try:
+        response = client.head(link, allow_redirects=True, timeout=timeout)
+        response.raise_for_status()
+        if "Content-Length" in response.headers:
+            return int(response.headers["Content-Length"])
+    except Exception as e:
+        logging.error(f"Could not get download size of {link}: {e}")
+
+    return None
+
+
+def deduplicate_product_variants(links, preferred_bands=DEFAULT_PREFERRED_BANDS):
+    """
+    Keep one product variant (RGB, RGBI, RGBNED) per scene.
+
+    @param links: pandas dataframe with a 'link' column.
+    @param preferred_bands: bands in order of preference.
+    @return: the links with one link per scene.
+    """
+    scenes = links["link"].str.split("/").str[-1]
+    bands = links["link"].str.extract(r"(RGBNED|RGBI|RGB)", expand=False)
+    rank = bands.map({band: i for i, band in enumerate(preferred_bands)}).fillna(
+        len(preferred_bands)
+    )
+
+    keep = (
+        pd.DataFrame({"scene": scenes, "rank": rank})
+        .sort_values("rank", kind="stable")
+        .drop_duplicates("scene")
+        .index
+    )
+    return links.loc[links.index.isin(keep)]
+
+
+def plan_downloads(
+    links,
+    output_folder,
+    region_name,
+    region_area,
+    user_n,
+    pass_n,
+    deduplicate=True,
+    preferred_bands=DEFAULT_PREFERRED_BANDS,
+    delete_zip_file=False,
+    extraction_ratio=1.1,
+    download_speed=20 * 1024**2,
+    extraction_speed=100 * 1024**2,
+    crop_speed=20 * 10**6,
+    workers=8,
+    client=None,
+    cache=None,
+):
+    """
+    Make a plan of what execute_link would do for every link, without downloading anything.
+
+    @param links: pandas dataframe as returned by nso_georegion.retrieve_download_links.
+    @param output_folder: the output folder of the georegion where the zip files and crops are stored.
+    @param region_name: the region name of the georegion, used to find existing crops.
+    @param region_area: the area of the region to crop in square meters.
+    @param user_n: NSO username.
+    @param pass_n: NSO password.
+    @param deduplicate: keep only one product variant per scene.
+    @param preferred_bands: the preferred bands when deduplicating product variants.
+    @param delete_zip_file: whether zip files are deleted after extraction, as in execute_link.
+    @param extraction_ratio: the size of the extracted files relative to the zip file.
+    @param download_speed: the expected download speed in bytes per second.
+    @param extraction_speed: the expected extraction speed in bytes per second.
+    @param crop_speed: the expected crop speed in pixels per second.
+    @param workers: the number of concurrent HEAD requests.
+    @param client: optional nso_client, defaults to the shared client of the account.
+    @param cache: optional scene_cache of the georegion, the zip files and extracted folders are then looked up in the cache.
+    @return: a dataframe with the plan per link and a dictionary with the totals.
+    """
+    if deduplicate:
+        links = deduplicate_product_variants(links, preferred_bands)
+
+    plan = pd.DataFrame({"link": list(links["link"])})
+    plan["scene"] = plan["link"].str.split("/").str[-1]
+    plan["product"] = plan["link"].str.split("/").str[-2]
+    plan["bands"] = plan["link"].str.extract(r"(RGBNED|RGBI|RGB)", expand=False)
+    plan["band_count"] = plan["bands"].map({"RGBNED": 6, "RGBI": 4, "RGB": 3})
+    plan["resolution_m"] = (
+        plan["link"].str.extract(r"(\d{2,3})cm", expand=False).astype(float) / 100
+    )
+
+    # The same file names as in nso_georegion.get_archive_path.
+    if cache is not None:
+        plan["zip_file"] = [cache.path(cache.entry_name(link)) for link in plan["link"]]
+    else:
+        plan["zip_file"] = (
+            output_folder + "/" + plan["scene"] + "_" + plan["product"] + ".zip"
+        )
+    plan["cropped"] = [
+        len(
+            glob.glob(
+                os.path.join(output_folder, f"{scene}*{region_name}*cropped*.tif")
+            )
+        )
+        > 0
+        for scene in plan["scene"]
+    ]
+    plan["zip_cached"] = plan["zip_file"].map(os.path.isfile)
+    plan["extracted_cached"] = (
+        plan["zip_file"].str.replace(".zip", "").map(os.path.isdir)
+    )
+
+    needs_download = ~plan["cropped"] & ~plan["zip_cached"] & ~plan["extracted_cached"]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = list(
+            executor.map(
+                lambda link, download: (
+                    get_download_size(link, user_n, pass_n, client=client)
+                    if download
+                    else None
+                ),
+                plan["link"],
+                needs_download,
+            )
+        )
+    plan["archive_bytes"] = [
+        os.path.getsize(zip_file) if cached else size
+        for zip_file, cached, size in zip(plan["zip_file"], plan["zip_cached"], sizes)
+    ]
+    plan["archive_bytes"] = plan["archive_bytes"].astype(float)
+
+    # Links without a known size are estimated with the median size of the same product.
+    plan["archive_bytes"] = plan["archive_bytes"].fillna(
+        plan.groupby("product")["archive_bytes"].transform("median").round()
+    )
+
+    plan["download_bytes"] = plan["archive_bytes"].where(needs_download, 0)
+    plan["crop_pixels"] = (region_area / plan["resolution_m"] ** 2).round()
+    plan["crop_bytes"] = plan["crop_pixels"] * plan["band_count"] * 2
+
+    to_process = ~plan["cropped"]
+    plan["extracted_bytes"] = (plan["archive_bytes"] * extraction_ratio).where(
+        to_process & ~plan["extracted_cached"], 0
+    )
+    plan["estimated_seconds"] = (
+        plan["download_bytes"] / download_speed
+        + plan["extracted_bytes"] / extraction_speed
+        + plan["crop_pixels"].where(to_process, 0) / crop_speed
+    ).astype(float)
+
+    # Links are processed one after another, the extracted folder is deleted after cropping.
+    archive_bytes_to_process = plan["archive_bytes"].where(to_process, 0).fillna(0)
+    kept_zip_bytes = 0 if delete_zip_file else archive_bytes_to_process.sum()
+    working_bytes = (
+        (archive_bytes_to_process + plan["extracted_bytes"].fillna(0)).max()
+        if len(plan) > 0
+        else 0
+    )
+    if cache is not None:
+        # The scene cache keeps zip files and extracted folders until it is over its budget.
+        kept_zip_bytes = min(
+            (archive_bytes_to_process + plan["extracted_bytes"].fillna(0)).sum(),
+            cache.max_bytes,
+        )
+        working_bytes = 0
+    crop_bytes = plan["crop_bytes"].where(to_process, 0).sum()
+
+    totals = {
+        "links": len(plan),
+        "links_to_process": int(to_process.sum()),
+        "links_already_cropped": int(plan["cropped"].sum()),
+        "links_without_size": int(plan["archive_bytes"].isna().sum()),
+        "download_bytes": int(plan["download_bytes"].sum()),
+        "crop_bytes": int(crop_bytes),
+        "peak_disk_bytes": int(kept_zip_bytes + working_bytes + crop_bytes),
+        "estimated_seconds": float(plan["estimated_seconds"].sum()),
+    }
+
+    return plan, totals
+
+
+def print_plan(totals):
+    """
+    Print the totals of a download plan.
+
+    @param totals: the totals as returned by plan_downloads.
+    """
+    print("------------------ NSO download plan ------------------")
+    print(f"Links:                 {totals['links']}")
+    print(f"Already cropped:       {totals['links_already_cropped']}")
+    print(f"To process:            {totals['links_to_process']}")
+    print(f"Without known size:    {totals['links_without_size']}")
+    print(f"Download volume:       {totals['download_bytes'] / 1024**3:.2f} GB")
+    print(f"Cropped output:        {totals['crop_bytes'] / 1024**3:.2f} GB")
+    print(f"Peak disk usage:       {totals['peak_disk_bytes'] / 1024**3:.2f} GB")
+    print(f"Estimated runtime:     {totals['estimated_seconds'] / 3600:.2f} hours")
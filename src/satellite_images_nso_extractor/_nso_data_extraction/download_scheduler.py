@@ -0,0 +1,321 @@
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from urllib.parse import urlparse
+
+import requests
+
+import satellite_images_nso_extractor._nso_data_extraction.nso_api as nso_api
+import satellite_images_nso_extractor._nso_data_extraction.nso_client as nso_client
+
+"""
+    A scheduler for many downloads at once, which keeps the uplink and the NSO portal healthy.
+
+    - Downloads run on a fixed number of threads with a global and a per host concurrency cap.
+    - A token bucket limits the total bandwidth of all downloads together.
+    - The concurrency adapts to the server: it is halved when the server answers with 429 or responds slowly, and it
+      grows by one again after a round of downloads without problems (additive increase, multiplicative decrease).
+    - Every download has a priority, a lower number goes first, so small urgent jobs overtake bulk backfills which
+      are already queued.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+# Priorities for submit, any number can be used.
+HIGH_PRIORITY = 0
+NORMAL_PRIORITY = 10
+BACKFILL_PRIORITY = 20
+
+
+class token_bucket:
+    """
+    A token bucket which limits the number of bytes per second over all threads.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        """
+        Init of the token bucket.
+
+        @param rate: the number of bytes per second.
+        @param burst: the number of bytes which can be used at once, defaults to one second of rate.
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst) if burst else self.rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int):
+        """
+        Take tokens for a number of bytes, sleeps when the bucket is in debt.
+
+        @param amount: the number of bytes.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.last) * self.rate
+            )
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+def is_throttled(exception):
+    """
+    Check if a exception, or one of its causes, is a 429 Too Many Requests response.
+
+    @param exception: the exception of a failed download.
+    @return: True when the server throttled the download.
+    """
+    while exception is not None:
+        if (
+            isinstance(exception, requests.exceptions.HTTPError)
+            and exception.response is not None
+            and exception.response.status_code == 429
+        ):
+            return True
+        exception = exception.__cause__
+    return False
+
+
+class download_scheduler:
+    """
+    Runs downloads by priority with concurrency caps, a bandwidth limit and backoff on throttling.
+    """
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        max_concurrent: int = 4,
+        max_per_host: int = 2,
+        bandwidth: float = None,
+        min_concurrent: int = 1,
+        slow_response_seconds: float = 10,
+        throttle_backoff: float = 30,
+        max_requeues: int = 5,
+        client: nso_client.nso_client = None,
+    ):
+        """
+        Init of the scheduler, the download threads are started right away.
+
+        @param username: the username of the nso account.
+        @param password: the password of the nso account.
+        @param max_concurrent: the maximum number of downloads at once.
+        @param max_per_host: the maximum number of downloads at once from the same host.
+        @param bandwidth: optional limit of all downloads together in bytes per second.
+        @param min_concurrent: the concurrency never backs off below this number.
+        @param slow_response_seconds: a response which takes longer than this lowers the concurrency.
+        @param throttle_backoff: seconds to wait before a throttled download is queued again.
+        @param max_requeues: how many times a throttled download is queued again before it fails.
+        @param client: optional nso_client, defaults to the shared client of the account.
+        """
+        self.username = username
+        self.password = password
+        self.client = (
+            client if client is not None else nso_client.get_client(username, password)
+        )
+        self.max_concurrent = max_concurrent
+        self.max_per_host = max_per_host
+        self.min_concurrent = max(1, min(min_concurrent, max_concurrent))
+        self.slow_response_seconds = slow_response_seconds
+        self.throttle_backoff = throttle_backoff
+        self.max_requeues = max_requeues
+        self.bucket = token_bucket(bandwidth) if bandwidth else None
+
+        self.limit = max_concurrent
+        self.active = 0
+        self.host_active = defaultdict(int)
+        self.successes = 0
+        self.last_decrease = 0
+        self.jobs = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.threads = [
+            threading.Thread(target=self.__worker, daemon=True)
+            for _ in range(max_concurrent)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(
+        self, link: str, path: str, priority: int = NORMAL_PRIORITY, cache=None
+    ) -> Future:
+        """
+        Queue a download.
+
+        @param link: a download link from the NSO.
+        @param path: the path to download to.
+        @param priority: a lower number is downloaded first.
+        @param cache: optional scene_cache, see nso_api.download_link.
+        @return: a future with the path of the download.
+        """
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise Exception("Download scheduler has been shut down")
+            self.jobs.append(
+                (priority, next(self.sequence), link, path, cache, future, 0, 0)
+            )
+            self.condition.notify_all()
+        return future
+
+    def __host(self, link):
+        """
+        Get the host of a link, concurrency is capped per host.
+        """
+        return urlparse(link).netloc
+
+    def __next_job(self):
+        """
+        Wait for the job with the highest priority whose host is not at its cap, and take a slot for it.
+        """
+        with self.condition:
+            while True:
+                # Running downloads can still queue a throttled download again.
+                if self.closed and len(self.jobs) == 0 and self.active == 0:
+                    return None
+
+                if self.active < self.limit:
+                    now = time.monotonic()
+                    for job in sorted(self.jobs, key=lambda job: job[:2]):
+                        host = self.__host(job[2])
+                        # Throttled downloads wait for their backoff before they are started again.
+                        if job[7] > now:
+                            continue
+                        if self.host_active[host] < self.max_per_host:
+                            self.jobs.remove(job)
+                            self.active += 1
+                            self.host_active[host] += 1
+                            return job
+
+                self.condition.wait(timeout=1)
+
+    def __release(self, link):
+        """
+        Give back the slot of a finished download.
+        """
+        with self.condition:
+            self.active -= 1
+            self.host_active[self.__host(link)] -= 1
+            self.condition.notify_all()
+
+    def __decrease(self, reason):
+        """
+        Halve the concurrency, at most once per few seconds so one burst of slow responses counts once.
+        """
+        with self.condition:
+            if time.monotonic() - self.last_decrease < 5:
+                return
+            self.last_decrease = time.monotonic()
+            self.limit = max(self.min_concurrent, self.limit // 2)
+            self.successes = 0
+        logging.info(f"Download concurrency lowered to {self.limit}: {reason}")
+        print(f"Download concurrency lowered to {self.limit}: {reason}")
+
+    def __increase(self):
+        """
+        Add one to the concurrency after a round of successful downloads.
+        """
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.max_concurrent:
+                self.limit += 1
+                self.successes = 0
+                logging.info(f"Download concurrency raised to {self.limit}")
+                self.condition.notify_all()
+
+    def __on_response(self, response):
+        """
+        Watch the response of a download for throttling and rising response times.
+        """
+        retries = getattr(response.raw, "retries", None)
+        history = retries.history if retries is not None else ()
+        if response.status_code == 429 or any(
+            attempt.status == 429 for attempt in history
+        ):
+            self.__decrease("throttled by the server")
+        elif response.elapsed.total_seconds() > self.slow_response_seconds:
+            self.__decrease(
+                f"response took {response.elapsed.total_seconds():.1f} seconds"
+            )
+
+    def __worker(self):
+        """
+        Download thread, runs jobs until the scheduler is shut down and the queue is empty.
+        """
+        while True:
+            job = self.__next_job()
+            if job is None:
+                return
+
+            priority, _, link, path, cache, future, requeues, _ = job
+            if requeues == 0 and not future.set_running_or_notify_cancel():
+                self.__release(link)
+                continue
+
+            try:
+                nso_api.download_link(
+                    link,
+                    path,
+                    self.username,
+                    self.password,
+                    cache=cache,
+                    client=self.client,
+                    on_response=self.__on_response,
+                    on_chunk=self.bucket.consume if self.bucket else None,
+                )
+            except Exception as e:
+                if is_throttled(e) and requeues < self.max_requeues:
+                    self.__decrease("throttled by the server")
+                    with self.condition:
+                        self.jobs.append(
+                            (
+                                priority,
+                                next(self.sequence),
+                                link,
+                                path,
+                                cache,
+                                future,
+                                requeues + 1,
+                                time.monotonic() + self.throttle_backoff,
+                            )
+                        )
+                        self.condition.notify_all()
+                    self.__release(link)
+                else:
+                    self.__release(link)
+                    future.set_exception(e)
+                continue
+
+            self.__release(link)
+            self.__increase()
+            future.set_result(path)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stop accepting downloads, the queued downloads are still done.
+
+        @param wait: wait until all queued downloads are done.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=True)
@@ -0,0 +1,98 @@
+import os
+import time
+
+try:
+    import fcntl
+
+    FCNTL_AVAILABLE = True
+except ImportError:
+    # Windows
+    import msvcrt
+
+    FCNTL_AVAILABLE = False
+
+"""
+    A cross process file lock, so several processes can share the same download cache.
+
+    Uses flock on Linux and macOS and msvcrt.locking on Windows. The lock is released by the operating system when a
+    process dies, so a crashed worker never leaves a stale lock behind.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+
+class file_lock:
+    """
+    An exclusive lock on a lock file, to be used as a context manager.
+    """
+
+    def __init__(self, path: str, timeout: float = None, poll_interval: float = 0.5):
+        """
+        Init of the lock.
+
+        @param path: path of the lock file, it is made when it does not exist.
+        @param timeout: seconds to wait for the lock, waits forever when None.
+        @param poll_interval: seconds between attempts to get the lock.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.file = None
+
+    def __try_lock(self):
+        """
+        Try to get the lock without waiting.
+
+        @return: True when the lock has been acquired.
+        """
+        try:
+            if FCNTL_AVAILABLE:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def acquire(self):
+        """
+        Wait until the lock is acquired.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.file = open(self.path, "a+")
+        start_time = time.time()
+
+        while not self.__try_lock():
+            if self.timeout is not None and time.time() - start_time > self.timeout:
+                self.file.close()
+                self.file = None
+                raise TimeoutError(
+                    f"Could not get lock {self.path} in {self.timeout} seconds"
+                )
+            time.sleep(self.poll_interval)
+
+        return self
+
+    def release(self):
+        """
+        Release the lock.
+        """
+        if self.file is None:
+            return
+
+        try:
+            if FCNTL_AVAILABLE:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
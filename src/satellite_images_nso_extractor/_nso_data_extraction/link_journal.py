@@ -0,0 +1,138 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+"""
+    A journal of the stages which have been completed per link, so a restarted run resumes where it stopped.
+
+    execute_link runs a link through the stages below. After every stage the journal of the link is written with the
+    path of the result of the stage, to a temporary file which is renamed over the old journal, so a crash never
+    leaves a half written journal. A restarted run looks for the last completed stage whose result still exists and
+    continues with the stage after it, instead of doing everything again or guessing from the files in the output
+    folder.
+
+    The journals are kept in a nso_journal folder in the output folder, one small .json file per link and region.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+JOURNAL_FOLDER_NAME = "nso_journal"
+
+# The stages of a link in the order in which execute_link runs them.
+STAGES = [
+    "downloaded",
+    "verified",
+    "extracted",
+    "cropped",
+    "indexed",
+    "height_added",
+    "filled",
+]
+
+
+class link_journal:
+    """
+    A folder with the journal of every link and region.
+    """
+
+    def __init__(self, folder: str):
+        """
+        Init of the journal.
+
+        @param folder: the output folder, the journals are kept in a nso_journal folder in it.
+        """
+        self.folder = os.path.join(folder, JOURNAL_FOLDER_NAME)
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_path(self, link: str, region_name: str):
+        """
+        Get the path of the journal of a link and region.
+
+        @param link: a download link from the NSO.
+        @param region_name: the name of the region.
+        @return: the path of the .json file.
+        """
+        key = hashlib.sha1(f"{link}|{region_name}".encode()).hexdigest()[:10]
+        return os.path.join(
+            self.folder, f"{link.rstrip('/').split('/')[-1]}_{region_name}_{key}.json"
+        )
+
+    def read(self, link: str, region_name: str):
+        """
+        Read the journal of a link and region.
+
+        @param link: a download link from the NSO.
+        @param region_name: the name of the region.
+        @return: a dictionary with the link, the region and per completed stage the path of its result and the time.
+        """
+        path = self.get_path(link, region_name)
+        if os.path.isfile(path):
+            try:
+                with open(path, "r") as journal_file:
+                    return json.load(journal_file)
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not read journal {path}: {e}")
+        return {"link": link, "region": region_name, "stages": {}}
+
+    def record(self, link: str, region_name: str, stage: str, path: str):
+        """
+        Record that a stage of a link has been completed.
+
+        The stages after it are removed from the journal, their results were made from a earlier result of the stage.
+
+        @param link: a download link from the NSO.
+        @param region_name: the name of the region.
+        @param stage: one of STAGES.
+        @param path: the path of the result of the stage.
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage {stage}, use {STAGES}")
+
+        journal = self.read(link, region_name)
+        journal["stages"] = {
+            done: entry
+            for done, entry in journal["stages"].items()
+            if STAGES.index(done) < STAGES.index(stage)
+        }
+        journal["stages"][stage] = {
+            "path": path,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+        journal_path = self.get_path(link, region_name)
+        temporary_path = f"{journal_path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary_path, "w") as journal_file:
+            json.dump(journal, journal_file, indent=2)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temporary_path, journal_path)
+        logging.info(f"Journal of {link}: {stage} {path}")
+
+    def resume_point(self, link: str, region_name: str, stages: list = STAGES):
+        """
+        Get the last completed stage of a link whose result still exists.
+
+        @param link: a download link from the NSO.
+        @param region_name: the name of the region.
+        @param stages: the stages of this run, stages which are not run are skipped.
+        @return: the stage and the path of its result, or None and None when no stage is completed.
+        """
+        completed = self.read(link, region_name)["stages"]
+        for stage in reversed(stages):
+            if stage in completed and os.path.exists(completed[stage]["path"]):
+                return stage, completed[stage]["path"]
+        return None, None
+
+    def clear(self, link: str, region_name: str):
+        """
+        Remove the journal of a link and region.
+
+        @param link: a download link from the NSO.
+        @param region_name: the name of the region.
+        """
+        path = self.get_path(link, region_name)
+        if os.path.isfile(path):
+            os.remove(path)
@@ -0,0 +1,401 @@
+import base64
+import io
+import json
+import logging
+import random
+import threading
+import time
+import zipfile
+import zlib
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_bounds
+from rasterio.warp import transform_bounds
+from shapely.geometry import box, shape
+
+"""
+    A local stand-in of the NSO portal for offline tests and load tests.
+
+    The portal implements the parts of the NSO api which are used by this package:
+
+    - POST /v1/search with the same request and response contract as the NSO api, it returns the synthetic scenes
+      whose date is in the date filter and whose footprint intersects the searched polygon.
+    - GET and HEAD /v1/download/<product>/<scene>, a zip archive with a synthetic GeoTIFF in rijks driehoek, a preview
+      and a metadata file, like the archives of the NSO.
+
+    Latency, bandwidth, a error rate and 429 throttling are configurable, so the download scheduler and the retries
+    of the client can be exercised without credentials or multi GB downloads. Requests need basic auth with the
+    username and password of the portal.
+
+    Example:
+
+        with local_portal(bounds=(4.41, 52.22, 4.42, 52.23)) as portal:
+            client = nso_client.nso_client(portal.username, portal.password, base_url=portal.url)
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+PNEO_PRODUCT = "30cm_RGBNED_12bit_PNEO"
+SUPERVIEW_PRODUCT = "SV_RD_11bit_RGBI_50cm"
+
+
+class local_portal:
+    """
+    A threaded http server which serves synthetic NSO scenes.
+    """
+
+    def __init__(
+        self,
+        bounds=(4.41, 52.22, 4.42, 52.23),
+        scenes: int = 10,
+        start_date: str = "2023-01-01",
+        days_between_scenes: int = 7,
+        products: list = [PNEO_PRODUCT],
+        pixel_size: float = 1.0,
+        latency: float = 0,
+        bandwidth: float = None,
+        error_rate: float = 0,
+        throttle_rate: float = 0,
+        max_concurrent_downloads: int = None,
+        retry_after: int = 1,
+        username: str = "local",
+        password: str = "local",
+        host: str = "127.0.0.1",
+        port: int = 0,
+        seed: int = 0,
+    ):
+        """
+        Init of the portal, the server is started with start or as a context manager.
+
+        @param bounds: the footprint of every scene as lon/lat bounds in WGS84, it should cover the tested regions.
+        @param scenes: the number of scenes per product.
+        @param start_date: the date of the first scene in "YYYY-MM-DD" format.
+        @param days_between_scenes: the number of days between two scenes.
+        @param products: the products which are served, PNEO_PRODUCT (6 bands) and/or SUPERVIEW_PRODUCT (4 bands).
+        @param pixel_size: the pixel size in meters of the synthetic GeoTIFFs, larger pixels give smaller archives.
+        @param latency: seconds before every response.
+        @param bandwidth: optional limit of every download in bytes per second.
+        @param error_rate: the fraction of requests which fail with a 500.
+        @param throttle_rate: the fraction of requests which are throttled with a 429.
+        @param max_concurrent_downloads: optional number of downloads at once, more are throttled with a 429.
+        @param retry_after: the Retry-After header in seconds of a 429.
+        @param username: the username of the basic auth.
+        @param password: the password of the basic auth.
+        @param host: the host to listen on.
+        @param port: the port to listen on, 0 picks a free port.
+        @param seed: the seed of the synthetic data and of the errors.
+        """
+        self.bounds = bounds
+        self.products = products
+        self.pixel_size = pixel_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.retry_after = retry_after
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.seed = seed
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.archives = {}
+        self.active_downloads = 0
+        self.stats = {
+            "searches": 0,
+            "downloads": 0,
+            "bytes_sent": 0,
+            "errors": 0,
+            "throttled": 0,
+            "unauthorized": 0,
+        }
+
+        first_date = datetime.strptime(start_date, "%Y-%m-%d").date()
+        self.scenes = {}
+        for product in products:
+            satellite = "PNEO-03_1_1" if product == PNEO_PRODUCT else "SV1-04"
+            for i in range(scenes):
+                scene_date = first_date + timedelta(days=i * days_between_scenes)
+                scene = f"{scene_date.strftime('%Y%m%d')}_104139_{satellite}"
+                self.scenes[(product, scene)] = {
+                    "date": scene_date,
+                    "cloudcover": round(self.random.uniform(0, 25), 2),
+                }
+
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        """
+        The base url of the api of the portal, for nso_client.
+        """
+        return f"http://{self.host}:{self.port}/v1"
+
+    def get_link(self, product, scene):
+        """
+        Get the download link of a scene, in the format of the NSO.
+        """
+        return f"{self.url}/download/{product}/{scene}"
+
+    def get_archive(self, product, scene):
+        """
+        Get the zip archive of a scene, made on first use.
+
+        @param product: the product of the scene.
+        @param scene: the name of the scene.
+        @return: the zip archive as bytes.
+        """
+        with self.lock:
+            if (product, scene) in self.archives:
+                return self.archives[(product, scene)]
+
+        count = 6 if product == PNEO_PRODUCT else 4
+        left, bottom, right, top = transform_bounds(
+            "EPSG:4326", "EPSG:28992", *self.bounds
+        )
+        width = max(1, int((right - left) / self.pixel_size))
+        height = max(1, int((top - bottom) / self.pixel_size))
+        rng = np.random.default_rng(
+            [self.seed, zlib.crc32(f"{product}/{scene}".encode())]
+        )
+        data = rng.integers(1, 4000, (count, height, width), dtype=np.uint16)
+
+        with rasterio.MemoryFile() as memory_file:
+            with memory_file.open(
+                driver="GTiff",
+                width=width,
+                height=height,
+                count=count,
+                dtype="uint16",
+                crs="EPSG:28992",
+                transform=from_bounds(left, bottom, right, top, width, height),
+                tiled=True,
+            ) as dataset:
+                dataset.write(data)
+            tif_bytes = memory_file.read()
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr(f"{scene}/{scene}_{product}.tif", tif_bytes)
+            zip_file.writestr(f"{scene}/{scene}_preview.tif", tif_bytes[:1024])
+            zip_file.writestr(
+                f"{scene}/{scene}_metadata.xml",
+                f"<scene><name>{scene}</name><product>{product}</product></scene>",
+            )
+
+        with self.lock:
+            self.archives[(product, scene)] = archive.getvalue()
+            return self.archives[(product, scene)]
+
+    def search(self, request):
+        """
+        Find the scenes for a search request of the NSO api.
+
+        @param request: the search request as a dictionary.
+        @return: the search response as a dictionary.
+        """
+        region = shape(request["geometry"])
+        filters = request.get("properties", {}).get("filters", {})
+        date_filter = filters.get("datefilter", {})
+        start = datetime.strptime(
+            date_filter.get("startdate", "1900-01-01"), "%Y-%m-%d"
+        ).date()
+        end = datetime.strptime(
+            date_filter.get("enddate", date.today().strftime("%Y-%m-%d")), "%Y-%m-%d"
+        ).date()
+
+        footprint = box(*self.bounds)
+        features = []
+        if footprint.intersects(region):
+            for (product, scene), properties in self.scenes.items():
+                if start <= properties["date"] <= end:
+                    features.append(
+                        {
+                            "type": "Feature",
+                            "geometry": footprint.__geo_interface__,
+                            "properties": {
+                                "name": scene,
+                                "acquired": properties["date"].strftime("%Y-%m-%d"),
+                                "cloudcover": properties["cloudcover"],
+                                "downloads": [{"href": self.get_link(product, scene)}],
+                            },
+                        }
+                    )
+
+        return {"type": "FeatureCollection", "features": features}
+
+    def start(self):
+        """
+        Start the server on a background thread.
+
+        @return: the portal.
+        """
+        self.server = ThreadingHTTPServer((self.host, self.port), _portal_handler)
+        self.server.daemon_threads = True
+        self.server.portal = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logging.info(f"Local NSO portal listening on {self.url}")
+        return self
+
+    def stop(self):
+        """
+        Stop the server.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class _portal_handler(BaseHTTPRequestHandler):
+    """
+    Request handler of the local portal.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def __send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def __precheck(self):
+        """
+        Apply the auth, latency, errors and throttling of the portal, returns False when the request is answered.
+        """
+        portal = self.server.portal
+        # The body of a request has to be read, or a kept alive connection gets out of sync.
+        length = int(self.headers.get("Content-Length", 0))
+        self.body = self.rfile.read(length) if length else b""
+
+        expected = base64.b64encode(
+            f"{portal.username}:{portal.password}".encode()
+        ).decode()
+        if self.headers.get("Authorization") != f"Basic {expected}":
+            with portal.lock:
+                portal.stats["unauthorized"] += 1
+            self.__send(401, b'{"message": "Unauthorized"}')
+            return False
+
+        if portal.latency:
+            time.sleep(portal.latency)
+
+        with portal.lock:
+            throttled = portal.random.random() < portal.throttle_rate
+            failed = not throttled and portal.random.random() < portal.error_rate
+            if throttled:
+                portal.stats["throttled"] += 1
+            elif failed:
+                portal.stats["errors"] += 1
+
+        if throttled:
+            self.__send(
+                429,
+                b'{"message": "Too Many Requests"}',
+                {"Retry-After": str(portal.retry_after)},
+            )
+            return False
+        if failed:
+            self.__send(500, b'{"message": "Internal Server Error"}')
+            return False
+        return True
+
+    def do_POST(self):
+        if not self.__precheck():
+            return
+        portal = self.server.portal
+        if urlparse(self.path).path.rstrip("/") != "/v1/search":
+            self.__send(404, b'{"message": "Not Found"}')
+            return
+
+        try:
+            response = portal.search(json.loads(self.body))
+        except Exception as e:
+            self.__send(400, json.dumps({"message": str(e)}).encode())
+            return
+
+        with portal.lock:
+            portal.stats["searches"] += 1
+        self.__send(
+            200,
+            json.dumps(response).encode(),
+            {"Content-Type": "application/json"},
+        )
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if not self.__precheck():
+            return
+        portal = self.server.portal
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if len(parts) != 4 or parts[:2] != ["v1", "download"]:
+            self.__send(404, b'{"message": "Not Found"}')
+            return
+        if (parts[2], parts[3]) not in portal.scenes:
+            self.__send(404, b'{"message": "Scene not found"}')
+            return
+
+        with portal.lock:
+            if (
+                portal.max_concurrent_downloads is not None
+                and portal.active_downloads >= portal.max_concurrent_downloads
+            ):
+                portal.stats["throttled"] += 1
+                throttled = True
+            else:
+                portal.active_downloads += 1
+                throttled = False
+        if throttled:
+            self.__send(
+                429,
+                b'{"message": "Too Many Requests"}',
+                {"Retry-After": str(portal.retry_after)},
+            )
+            return
+
+        try:
+            archive = portal.get_archive(parts[2], parts[3])
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(len(archive)))
+            self.end_headers()
+            if self.command == "HEAD":
+                return
+
+            chunk_size = 64 * 1024
+            for start in range(0, len(archive), chunk_size):
+                chunk = archive[start : start + chunk_size]
+                self.wfile.write(chunk)
+                if portal.bandwidth:
+                    time.sleep(len(chunk) / portal.bandwidth)
+            with portal.lock:
+                portal.stats["downloads"] += 1
+                portal.stats["bytes_sent"] += len(archive)
+        finally:
+            with portal.lock:
+                portal.active_downloads -= 1
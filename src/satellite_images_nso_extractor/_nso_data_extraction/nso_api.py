@@ -1,14 +1,20 @@
+import hashlib
 import json
 import logging
 import os
+import shutil
 import sys
+import time
 import zipfile
-from datetime import date
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
 
 import numpy as np
 import requests
 import shapely
-from requests.auth import HTTPBasicAuth
+
+import satellite_images_nso_extractor._nso_data_extraction.archive_extraction as archive_extraction
+import satellite_images_nso_extractor._nso_data_extraction.nso_client as nso_client
 
 """
     This class is a python wrapper with added functionality around the NSO api.
@@ -25,62 +31,216 @@ from requests.auth import HTTPBasicAuth
 """
 
 
-def download_file(url, local_filename, user_n, pass_n):
+def verify_zip(path, test_members=True):
     """
-    Method for downloading files in chunks mostly data from the NSO is too large to fit into memory with a normal
+    Verify a zip file, reads the central directory and checks that every member lies within the file.
+
+    With test_members the CRC of every member is checked as well, which decompresses the whole archive. A fresh
+    download is checked without it: its size is compared to the Content-Length and the CRC of the members which are
+    used is checked while they are extracted.
+
+    @param path: path to the zip file.
+    @param test_members: whether to check the CRC of every member.
     """
+    try:
+        with zipfile.ZipFile(path, "r") as zip_ref:
+            size = os.path.getsize(path)
+            for info in zip_ref.infolist():
+                # zipfile shifts the offsets when data is missing before the central directory.
+                if (
+                    info.header_offset < 0
+                    or info.header_offset + info.compress_size > size
+                ):
+                    raise zipfile.BadZipFile(f"{info.filename} is truncated")
+            bad_member = zip_ref.testzip() if test_members else None
+    except (zipfile.BadZipFile, OSError) as e:
+        raise Exception(f"Corrupt zip file {path}: {e}")
 
-    # NOTE the stream=True parameter below
-    with requests.get(url, auth=HTTPBasicAuth(user_n, pass_n), stream=True) as r:
-        logging.info("Downloading file: " + url)
-        print("Downloading file: " + url)
-        r.raise_for_status()
+    if bad_member is not None:
+        raise Exception(f"Corrupt zip file {path}: CRC error in {bad_member}")
 
-        with open(local_filename, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                # if chunk:
-                f.write(chunk)
-    return local_filename
 
+def get_checksum(path):
+    """
+    Calculate the sha256 checksum of a file in chunks.
 
-def retrieve_download_links(
-    georegion,
+    @param path: path to the file.
+    @return: the sha256 checksum as a hex string.
+    """
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def write_checksum_file(path, checksum):
+    """
+    Write the .sha256 file of a verified zip file with its size, checksum and modification time.
+
+    @param path: path to the zip file.
+    @param checksum: the sha256 checksum of the zip file.
+    """
+    stat = os.stat(path)
+    with open(path + ".sha256", "w") as f:
+        f.write(f"{stat.st_size} {checksum} {stat.st_mtime_ns}")
+
+
+def is_verified(path):
+    """
+    Check if a downloaded zip file has been verified, by comparing it to its .sha256 file.
+
+    The .sha256 file is trusted when the size and modification time of the zip file are the ones it was verified
+    with. A zip file which changed on disk since is hashed again, and zip files downloaded before verification existed
+    are verified once.
+
+    @param path: path to the zip file.
+    @return: True when the zip file is complete and not corrupt.
+    """
+    checksum_file = path + ".sha256"
+    if os.path.isfile(checksum_file):
+        with open(checksum_file, "r") as f:
+            fields = f.read().split()
+        size, checksum = int(fields[0]), fields[1]
+        # .sha256 files written before the modification time was kept are checked once.
+        mtime = int(fields[2]) if len(fields) > 2 else None
+
+        stat = os.stat(path)
+        if size == stat.st_size and mtime == stat.st_mtime_ns:
+            return True
+        if size != stat.st_size or checksum != get_checksum(path):
+            logging.error(f"{path} does not match its checksum file")
+            print(f"{path} does not match its checksum file")
+            return False
+        write_checksum_file(path, checksum)
+        return True
+
+    try:
+        verify_zip(path)
+    except Exception as e:
+        logging.error(str(e))
+        print(str(e))
+        return False
+
+    write_checksum_file(path, get_checksum(path))
+    return True
+
+
+def download_file(
+    url,
+    local_filename,
     user_n,
     pass_n,
-    start_date,
-    end_date,
-    max_meters,
-    strict_region,
-    max_diff,
-    cloud_coverage_whole,
+    retries=2,
+    client=None,
+    on_response=None,
+    on_chunk=None,
 ):
     """
-    This functions retrieves download links for satellite image corresponding to the region in the geojson.
+    Method for downloading files in chunks mostly data from the NSO is too large to fit into memory with a normal
 
-    @param georegion: a polygon with the georegion.
+    The file is downloaded to a .part file while its sha256 checksum is calculated. Only when the size matches the
+    Content-Length and the central directory of the zip is complete the file is renamed and a .sha256 file is written
+    next to it, so the file is only read once more when it is extracted. Incomplete or corrupt downloads and
+    connections which break halfway are downloaded again after a backoff.
+
+    @param url: the url to download.
+    @param local_filename: the path to download to.
     @param user_n: NSO username.
     @param pass_n: NSO password.
-    @param start_date: From when satelliet date needs to be looked at.
-    @param end_date: the end date of the period which needs to be looked at
-    @param max_meters: Maximum resolution which needs to be looked at.
-    @param strict_region: A filter applied to links to only fully contain the region.
-    @param max_diff: The percentage that a satellite image has to have of the selected geojson region.
-    @param cloud_coverage_whole: level percentage of clouds to filter out of the whole satellite image, so 30 means the percentage has to be less or equal to 30.
-    @return: the found download links.
+    @param retries: how many times a incomplete or corrupt download is downloaded again.
+    @param client: optional nso_client, defaults to the shared client of the account.
+    @param on_response: optional function called with the response before the download starts, i.e. to measure response times.
+    @param on_chunk: optional function called with the size of every chunk before it is written, i.e. to limit the bandwidth.
+    @return: the path of the downloaded file.
     """
+    client = client if client is not None else nso_client.get_client(user_n, pass_n)
+    part_filename = local_filename + ".part"
 
-    # FOR DEBUGGING !!!!!!!This blocks the large print output from the request.
-    # save_stdout = sys.stdout
-    # sys.stdout = open(os.devnull, 'w')
+    for attempt in range(retries + 1):
+        try:
+            checksum = hashlib.sha256()
+            written = 0
+
+            # NOTE the stream=True parameter below
+            with client.get(url, stream=True) as r:
+                logging.info("Downloading file: " + url)
+                print("Downloading file: " + url)
+                if on_response is not None:
+                    on_response(r)
+                r.raise_for_status()
+                expected = r.headers.get("Content-Length")
+
+                with open(part_filename, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        if on_chunk is not None:
+                            on_chunk(len(chunk))
+                        f.write(chunk)
+                        checksum.update(chunk)
+                        written += len(chunk)
+
+            if expected is not None and written != int(expected):
+                raise Exception(
+                    f"Incomplete download of {url}: {written} of {expected} bytes"
+                )
+
+            if url.split("?")[0].endswith(".zip") or zipfile.is_zipfile(part_filename):
+                verify_zip(part_filename, test_members=False)
+
+            os.replace(part_filename, local_filename)
+            write_checksum_file(local_filename, checksum.hexdigest())
+
+            return local_filename
+
+        except requests.exceptions.HTTPError:
+            raise
+        except Exception as e:
+            logging.error(f"Download attempt {attempt + 1} failed: {e}")
+            print(f"Download attempt {attempt + 1} failed: {e}")
+            if os.path.isfile(part_filename):
+                os.remove(part_filename)
+            if attempt == retries:
+                raise
+            time.sleep(client.backoff_factor * 2**attempt)
+
+
+def date_shards(start_date, end_date, shard_days=365):
+    """
+    Split a period into consecutive date shards which do not overlap.
+
+    @param start_date: start of the period in "YYYY-MM-DD" format.
+    @param end_date: end of the period in "YYYY-MM-DD" format.
+    @param shard_days: the number of days in a shard.
+    @return: a list of (start_date, end_date) tuples in "YYYY-MM-DD" format.
+    """
+    start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+
+    shards = []
+    while start <= end:
+        shard_end = min(start + timedelta(days=shard_days - 1), end)
+        shards.append((start.strftime("%Y-%m-%d"), shard_end.strftime("%Y-%m-%d")))
+        start = shard_end + timedelta(days=1)
+    return shards
 
-    geojson_coordinates = georegion
 
-    url = "https://api.satellietdataportaal.nl/v1/search"
+def search(georegion, user_n, pass_n, start_date, end_date, max_meters, client=None):
+    """
+    Send one search request to the NSO api.
+
+    @param georegion: a polygon with the georegion.
+    @param user_n: NSO username.
+    @param pass_n: NSO password.
+    @param start_date: start of the period in "YYYY-MM-DD" format.
+    @param end_date: end of the period in "YYYY-MM-DD" format.
+    @param max_meters: Maximum resolution which needs to be looked at.
+    @param client: optional nso_client, defaults to the shared client of the account.
+    @return: the found features.
+    """
+    client = client if client is not None else nso_client.get_client(user_n, pass_n)
     myobj = {
         "type": "Feature",
-        "geometry": {"type": "Polygon", "coordinates": geojson_coordinates},
+        "geometry": {"type": "Polygon", "coordinates": georegion},
         "properties": {
             "fields": {"geometry": "false"},
             "filters": {
@@ -91,88 +251,201 @@ def retrieve_download_links(
     }
 
     headers = {"content-type": "application/json"}
-    x = requests.post(
-        url, auth=HTTPBasicAuth(user_n, pass_n), data=json.dumps(myobj), headers=headers
-    )
-    
+    x = client.post("search", data=json.dumps(myobj), headers=headers)
+
     # Check HTTP status code first
     if x.status_code != 200:
         logging.error(f"NSO API returned status code {x.status_code}: {x.text}")
         raise Exception(f"NSO API request failed with status {x.status_code}: {x.text}")
-    
+
     # Try to parse JSON response
     try:
         reponse = json.loads(x.text)
     except json.JSONDecodeError as e:
-        logging.error(f"Failed to parse JSON response from NSO API. Response text: {x.text}")
+        logging.error(
+            f"Failed to parse JSON response from NSO API. Response text: {x.text}"
+        )
         raise Exception(f"Invalid JSON response from NSO API: {e}. Response: {x.text}")
 
-    logging.info(f"Got following request: {reponse}")
+    logging.info(
+        f"Got {len(reponse.get('features', []))} features for {start_date} to {end_date}"
+    )
     if "features" not in reponse.keys():
         print(reponse)
         logging.error("No valid response from NSO message:" + x.text)
         raise Exception("No valid response from NSO message:" + x.text)
 
+    return reponse["features"]
+
+
+def get_footprint(row):
+    """
+    Get the footprint of a feature found by the NSO api.
+
+    @param row: a feature found by the NSO api.
+    @return: a shapely polygon in WGS84 or None when the feature has no geometry.
+    """
+    try:
+        return shapely.geometry.shape(row["geometry"])
+    except Exception:
+        return None
+
+
+def filter_feature(row, georegion, strict_region, max_diff, cloud_coverage_whole):
+    """
+    Apply the cloud coverage and region filters to one feature found by the NSO api.
+
+    @param row: a feature found by the NSO api.
+    @param georegion: a polygon with the georegion.
+    @param strict_region: A filter applied to links to only fully contain the region.
+    @param max_diff: The percentage that a satellite image has to have of the selected geojson region.
+    @param cloud_coverage_whole: level percentage of clouds to filter out of the whole satellite image.
+    @return: the links of the feature which pass the filters, as [link, percentage_geojson, missing_polygon, covered_polygon, footprint, cloudcover] lists.
+    """
     links = []
-    for row in reponse["features"]:
-        try:
-            if row["properties"]["downloads"] is not None:
-                print("Cloudcover check:")
-                # Check for cloudcoverage. TODO: Use a variable for it.
-                if (
-                    row["properties"]["cloudcover"] is None
-                    or float(row["properties"]["cloudcover"]) < cloud_coverage_whole
-                ):
-                    # This checks to see if the geojson is in the full region. TODO: Make it optional and propertional
-                    print("Passed cloud check")
-                    check_region = False
-                    print("Going into region check:")
-                    try:
-                        check_region, percentage_diff, missing_part, overlap_region = (
-                            check_if_geojson_in_region(
-                                row, geojson_coordinates, max_diff
-                            )
+    try:
+        if row["properties"]["downloads"] is not None:
+            print("Cloudcover check:")
+            # Check for cloudcoverage. TODO: Use a variable for it.
+            if (
+                row["properties"]["cloudcover"] is None
+                or float(row["properties"]["cloudcover"]) < cloud_coverage_whole
+            ):
+                # This checks to see if the geojson is in the full region. TODO: Make it optional and propertional
+                print("Passed cloud check")
+                check_region = False
+                print("Going into region check:")
+                try:
+                    check_region, percentage_diff, missing_part, overlap_region = (
+                        check_if_geojson_in_region(row, georegion, max_diff)
+                    )
+                except Exception as e:
+                    print(str(e) + " This error can be normal!")
+                #   logging.error(str(e)+" This error can be normal!")
+
+                if check_region == True or strict_region == False:
+                    print("Passed region check")
+                    footprint = get_footprint(row)
+                    for download in row["properties"]["downloads"]:
+                        links.append(
+                            [
+                                download["href"],
+                                percentage_diff,
+                                missing_part,
+                                overlap_region,
+                                footprint,
+                                row["properties"]["cloudcover"],
+                            ]
                         )
-                    except Exception as e:
-                        print(str(e) + " This error can be normal!")
-                    #   logging.error(str(e)+" This error can be normal!")
-
-                    if check_region == True or strict_region == False:
-                        print("Passed region check")
-                        for download in row["properties"]["downloads"]:
-                            links.append(
-                                [
-                                    download["href"],
-                                    percentage_diff,
-                                    missing_part,
-                                    overlap_region,
-                                ]
-                            )
 
-        except Exception as e:
-            print(str(e) + " This error can be normal!")
-            logging.error(str(e) + " This error can be normal!")
+    except Exception as e:
+        print(str(e) + " This error can be normal!")
+        logging.error(str(e) + " This error can be normal!")
 
-    # sys.stdout = save_stdout
     return links
 
 
-def download_link(link, absolute_path, user_n, pass_n):
+def retrieve_download_links(
+    georegion,
+    user_n,
+    pass_n,
+    start_date,
+    end_date,
+    max_meters,
+    strict_region,
+    max_diff,
+    cloud_coverage_whole,
+    shard_days=365,
+    workers=4,
+    client=None,
+):
+    """
+    This functions retrieves download links for satellite image corresponding to the region in the geojson.
+
+    Long periods are split into date shards which are searched concurrently. The features of a shard are filtered as
+    soon as the shard arrives, while the other shards are still in flight. Links found in more than one shard are
+    only returned once.
+
+    @param georegion: a polygon with the georegion.
+    @param user_n: NSO username.
+    @param pass_n: NSO password.
+    @param start_date: From when satelliet date needs to be looked at.
+    @param end_date: the end date of the period which needs to be looked at
+    @param max_meters: Maximum resolution which needs to be looked at.
+    @param strict_region: A filter applied to links to only fully contain the region.
+    @param max_diff: The percentage that a satellite image has to have of the selected geojson region.
+    @param cloud_coverage_whole: level percentage of clouds to filter out of the whole satellite image, so 30 means the percentage has to be less or equal to 30.
+    @param shard_days: the number of days searched in one request.
+    @param workers: the number of concurrent search requests.
+    @param client: optional nso_client, defaults to the shared client of the account.
+    @return: the found download links, in order of date shard.
+    """
+    shards = date_shards(start_date, end_date, shard_days)
+    shard_links = [[] for _ in shards]
+    seen = set()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(shards)))) as executor:
+        futures = {
+            executor.submit(
+                search,
+                georegion,
+                user_n,
+                pass_n,
+                shard_start,
+                shard_end,
+                max_meters,
+                client,
+            ): i
+            for i, (shard_start, shard_end) in enumerate(shards)
+        }
+
+        for future in as_completed(futures):
+            i = futures[future]
+            for row in future.result():
+                for link in filter_feature(
+                    row, georegion, strict_region, max_diff, cloud_coverage_whole
+                ):
+                    if link[0] not in seen:
+                        seen.add(link[0])
+                        shard_links[i].append(link)
+
+    return [link for links in shard_links for link in links]
+
+
+def download_link(
+    link, absolute_path, user_n, pass_n, cache=None, client=None, **kwargs
+):
     """
     Method for downloading satelliet data from a link.
 
     @param link: a link where the satelliet data is stored.
     @param absolute_path: the filename and path where the file will get downloaded.
+    @param cache: optional scene_cache, absolute_path should then be in the cache folder. The download is done under a lock of the cache entry, so processes sharing the cache download a link only once.
+    @param client: optional nso_client, defaults to the shared client of the account.
+    @param kwargs: other parameters for download_file, like on_response and on_chunk.
     """
 
     try:
+        if cache is not None:
+            name = os.path.basename(absolute_path)
+            with cache.lock(name):
+                # Another process could have downloaded the file while waiting for the lock.
+                if cache.get(name) and is_verified(absolute_path):
+                    logging.info(f"{absolute_path} is already in the scene cache")
+                    print("File already in the scene cache: " + absolute_path)
+                else:
+                    # download_file downloads to a .part file, so an interrupted download never ends up in the cache.
+                    download_file(
+                        link, absolute_path, user_n, pass_n, client=client, **kwargs
+                    )
+                    cache.add(name)
         # Check if file is already downloaded.
-        if os.path.isfile(absolute_path) is True:
+        elif os.path.isfile(absolute_path) is True and is_verified(absolute_path):
             logging.info(f"{absolute_path} is already downloaded")
             print("File already downloaded: " + absolute_path)
         else:
             # r = requests.get(link,auth = HTTPBasicAuth(user_n, pass_n))
-            download_file(link, absolute_path, user_n, pass_n)
+            download_file(link, absolute_path, user_n, pass_n, client=client, **kwargs)
 
             # logging.info("Status code from the request: "+r.status_code)
             # print("Status code from the request: "+r.status_code)
@@ -189,23 +462,48 @@ def download_link(link, absolute_path, user_n, pass_n):
     except Exception as e:
         logging.error("Error downloading file: " + str(e))
         print("Error downloading file: " + str(e))  # This is the correct syntax
-        raise SystemExit(e)
+        raise Exception("Error downloading file: " + str(e)) from e
 
 
-def unzip_delete(path, delete):
+def unzip_delete(path, delete, bands=None, resolution=None, workers=4):
     """
     Unzip a zip file and delete the .zip file.
+
+    Only the rasters which match the bands and resolution are extracted, see archive_extraction.extract_selected.
+    A corrupt zip file is deleted, so it is downloaded again on the next run, and a exception is raised.
+
+    @param path: path to the zip file.
+    @param delete: whether to delete the zip file after extraction.
+    @param bands: optional bands of the raster to extract, i.e. "RGBNED".
+    @param resolution: optional resolution of the raster to extract, i.e. "30cm".
+    @param workers: the number of members which are extracted at once.
+    @return: the path to the extracted folder.
     """
+    # Extract to a temporary folder, so a interrupted extraction is never taken for a extracted folder.
+    temporary_folder = path.replace(".zip", "") + ".part"
+    shutil.rmtree(temporary_folder, ignore_errors=True)
     try:
-        with zipfile.ZipFile(path, "r") as zip_ref:
-            zip_ref.extractall(path.replace(".zip", ""))
-        zip_ref.close()
-    except:
-        logging.error(f"Could not extract {path}")
+        archive_extraction.extract_selected(
+            path, temporary_folder, bands, resolution, workers
+        )
+        os.replace(temporary_folder, path.replace(".zip", ""))
+    except zipfile.BadZipFile as e:
+        logging.error(f"Could not extract {path}, deleting the corrupt zip file: {e}")
+        shutil.rmtree(temporary_folder, ignore_errors=True)
+        for corrupt_file in [path, path + ".sha256"]:
+            if os.path.isfile(corrupt_file):
+                os.remove(corrupt_file)
+        raise Exception(f"Could not extract corrupt zip file {path}: {e}")
+    except Exception as e:
+        logging.error(f"Could not extract {path}: {e}")
+        shutil.rmtree(temporary_folder, ignore_errors=True)
+        raise Exception(f"Could not extract {path}: {e}")
 
     if delete:
         try:
             os.remove(path)
+            if os.path.isfile(path + ".sha256"):
+                os.remove(path + ".sha256")
             logging.info("Deleted zip file")
         except:
             logging.error("Unable to delete zip")
@@ -0,0 +1,143 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+"""
+    A pooled client for the NSO api.
+
+    Holds one requests session with keep-alive connections, so searches and downloads reuse connections instead of
+    opening a new one for every request. Requests which fail with a connection error, a 429 or a 5xx status are
+    retried with exponential backoff, honouring the Retry-After header of the NSO portal. Every request has a connect
+    and a read timeout, so a stalled connection never hangs a batch run.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+DEFAULT_BASE_URL = "https://api.satellietdataportaal.nl/v1"
+
+# Status codes which are retried with backoff.
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# One client per account for callers which do not pass a client themselves.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class nso_client:
+    """
+    A keep-alive session for the NSO api with timeouts, retries and backoff.
+    """
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        base_url: str = DEFAULT_BASE_URL,
+        connect_timeout: float = 10,
+        read_timeout: float = 300,
+        retries: int = 5,
+        backoff_factor: float = 1,
+        pool_maxsize: int = 16,
+    ):
+        """
+        Init of the client.
+
+        @param username: the username of the nso account.
+        @param password: the password of the nso account.
+        @param base_url: the base url of the NSO api, can point to a local stand-in of the portal.
+        @param connect_timeout: seconds to wait for a connection.
+        @param read_timeout: seconds to wait for data from the server.
+        @param retries: the number of retries of a failed request.
+        @param backoff_factor: the backoff between retries is backoff_factor * 2 ** retry seconds.
+        @param pool_maxsize: the number of keep-alive connections per host.
+        """
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(["GET", "HEAD", "POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            max_retries=retry, pool_connections=4, pool_maxsize=pool_maxsize
+        )
+
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(username, password)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def url(self, path: str):
+        """
+        Get the full url of a path of the api, full urls are returned as they are.
+
+        @param path: a path like "search" or a full url.
+        """
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def request(self, method: str, path: str, **kwargs):
+        """
+        Send a request with the timeouts and retries of the client.
+
+        @param method: the http method.
+        @param path: a path of the api or a full url.
+        @param kwargs: other parameters for requests, like data, headers or stream.
+        @return: the response.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.url(path)
+        logging.debug(f"{method} {url}")
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, path: str, **kwargs):
+        """
+        Send a GET request, see request.
+        """
+        return self.request("GET", path, **kwargs)
+
+    def head(self, path: str, **kwargs):
+        """
+        Send a HEAD request, see request.
+        """
+        return self.request("HEAD", path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        """
+        Send a POST request, see request.
+        """
+        return self.request("POST", path, **kwargs)
+
+    def close(self):
+        """
+        Close the keep-alive connections.
+        """
+        self.session.close()
+
+
+def get_client(username: str, password: str):
+    """
+    Get the shared client of an account, made on first use.
+
+    @param username: the username of the nso account.
+    @param password: the password of the nso account.
+    @return: a nso_client.
+    """
+    with _clients_lock:
+        if (username, password) not in _clients:
+            _clients[(username, password)] = nso_client(username, password)
+        return _clients[(username, password)]
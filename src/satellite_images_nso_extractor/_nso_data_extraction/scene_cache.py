@@ -0,0 +1,271 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+from satellite_images_nso_extractor._nso_data_extraction.file_lock import file_lock
+
+"""
+    A managed cache folder for downloaded zip archives and extracted folders with a byte budget.
+
+    Every entry in the cache is tracked in a index file with its size and last access time. When the cache grows
+    over its budget the least recently used entries are deleted, except entries which are pinned by running jobs.
+    Pins expire after pin_timeout seconds, so a crashed job can not block eviction forever.
+
+    The cache can be shared by several processes, each with their own output folder. Entries are named after a hash of
+    the download link and the index and every entry are guarded by cross process file locks, so an archive is
+    downloaded and extracted exactly once while other processes wait for it. Consumers use the paths in the cache
+    directly, never a copy.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+INDEX_FILE_NAME = "scene_cache_index.json"
+LOCK_FOLDER_NAME = ".locks"
+
+
+def get_size(path):
+    """
+    Get the size in bytes of a file or of all the files in a folder.
+
+    @param path: path to a file or folder.
+    @return: the size in bytes.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return size
+
+
+class scene_cache:
+    """
+    A cache folder with a byte budget and least recently used eviction.
+    """
+
+    def __init__(self, cache_folder: str, max_bytes: int, pin_timeout: int = 24 * 3600):
+        """
+        Init of the cache.
+
+        @param cache_folder: the folder where the zip archives and extracted folders are stored.
+        @param max_bytes: the byte budget of the cache.
+        @param pin_timeout: seconds after which a pin expires.
+        """
+        os.makedirs(cache_folder, exist_ok=True)
+        self.cache_folder = cache_folder.replace("\\", "/").rstrip("/")
+        self.max_bytes = max_bytes
+        self.pin_timeout = pin_timeout
+        self.index_path = os.path.join(self.cache_folder, INDEX_FILE_NAME)
+
+    def _read_index(self):
+        """
+        Read the index of the cache.
+        """
+        if not os.path.isfile(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, "r") as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read scene cache index, starting a new one: {e}")
+            return {}
+
+    def _write_index(self, index):
+        """
+        Write the index of the cache, through a temporary file so a crash never leaves half a index.
+        """
+        temporary_path = f"{self.index_path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary_path, "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(temporary_path, self.index_path)
+
+    @contextmanager
+    def _locked_index(self):
+        """
+        Context manager which gives the index under a cross process lock and writes it back afterwards.
+        """
+        with file_lock(self.index_path + ".lock"):
+            index = self._read_index()
+            yield index
+            self._write_index(index)
+
+    def entry_name(self, link: str, suffix: str = ".zip"):
+        """
+        Get the name of the cache entry of a download link, keyed by a hash of the link.
+
+        @param link: a download link from the NSO.
+        @param suffix: ".zip" for the archive and "" for the extracted folder.
+        @return: the file or folder name of the entry.
+        """
+        link_hash = hashlib.sha1(link.encode("utf-8")).hexdigest()[:16]
+        archive_name = f"{link.split('/')[-1]}_{link.split('/')[-2]}"
+
+        return f"{link_hash}_{archive_name}{suffix}"
+
+    def lock(self, name: str, timeout: float = None):
+        """
+        Get a cross process lock for an entry, hold it while the entry is downloaded or extracted.
+
+        @param name: the file or folder name of the entry.
+        @param timeout: seconds to wait for the lock, waits forever when None.
+        @return: a file_lock to be used as a context manager.
+        """
+        return file_lock(
+            os.path.join(self.cache_folder, LOCK_FOLDER_NAME, name + ".lock"), timeout
+        )
+
+    def path(self, name: str):
+        """
+        Get the path of an entry in the cache folder, the entry does not have to exist.
+
+        @param name: the file or folder name of the entry.
+        """
+        return f"{self.cache_folder}/{name}"
+
+    def get(self, name: str):
+        """
+        Get an entry from the cache and mark it as used.
+
+        @param name: the file or folder name of the entry.
+        @return: the path of the entry or None when it is not in the cache.
+        """
+        path = self.path(name)
+        if not os.path.exists(path):
+            return None
+
+        with self._locked_index() as index:
+            entry = index.setdefault(name, {"size": get_size(path), "pins": {}})
+            entry["last_access"] = time.time()
+
+        return path
+
+    def add(self, name: str):
+        """
+        Register an entry which has been written to the cache folder and evict old entries when over budget.
+
+        @param name: the file or folder name of the entry.
+        @return: the path of the entry.
+        """
+        path = self.path(name)
+        with self._locked_index() as index:
+            entry = index.setdefault(name, {"pins": {}})
+            entry["size"] = get_size(path)
+            entry["last_access"] = time.time()
+        logging.info(f"Added {name} to the scene cache")
+
+        self.evict()
+        return path
+
+    def pin(self, name: str):
+        """
+        Pin an entry, so it is not evicted while it is in use.
+
+        @param name: the file or folder name of the entry.
+        @return: a token to unpin the entry with.
+        """
+        token = uuid.uuid4().hex
+        with self._locked_index() as index:
+            entry = index.setdefault(name, {"size": 0, "pins": {}})
+            entry["last_access"] = time.time()
+            entry["pins"][token] = time.time() + self.pin_timeout
+
+        return token
+
+    def unpin(self, name: str, token: str):
+        """
+        Remove a pin of an entry.
+
+        @param name: the file or folder name of the entry.
+        @param token: the token returned by pin.
+        """
+        with self._locked_index() as index:
+            if name in index:
+                index[name]["pins"].pop(token, None)
+
+    @contextmanager
+    def pinned(self, *names):
+        """
+        Context manager which pins entries while a job uses them.
+
+        @param names: the file or folder names of the entries.
+        """
+        tokens = [(name, self.pin(name)) for name in names]
+        try:
+            yield [self.path(name) for name in names]
+        finally:
+            for name, token in tokens:
+                self.unpin(name, token)
+
+    def total_bytes(self):
+        """
+        Get the total size of the entries in the cache.
+        """
+        return sum(entry.get("size", 0) for entry in self._read_index().values())
+
+    def evict(self):
+        """
+        Delete the least recently used entries which are not pinned until the cache is within its budget.
+
+        @return: the names of the evicted entries.
+        """
+        with self._locked_index() as index:
+            now = time.time()
+
+            # Entries which have been deleted outside of the cache are dropped from the index.
+            for name in [name for name in index if not os.path.exists(self.path(name))]:
+                if not index[name]["pins"]:
+                    del index[name]
+
+            total = sum(entry.get("size", 0) for entry in index.values())
+            evicted = []
+
+            for name in sorted(
+                index, key=lambda name: index[name].get("last_access", 0)
+            ):
+                if total <= self.max_bytes:
+                    break
+
+                entry = index[name]
+                entry["pins"] = {
+                    token: expires
+                    for token, expires in entry["pins"].items()
+                    if expires > now
+                }
+                if entry["pins"]:
+                    continue
+
+                path = self.path(name)
+                try:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    elif os.path.isfile(path):
+                        os.remove(path)
+                        # The checksum file written next to a verified download.
+                        if os.path.isfile(path + ".sha256"):
+                            os.remove(path + ".sha256")
+                except OSError as e:
+                    logging.error(f"Could not evict {path} from the scene cache: {e}")
+                    continue
+
+                total -= entry.get("size", 0)
+                evicted.append(name)
+                del index[name]
+                logging.info(f"Evicted {name} from the scene cache")
+                print(f"Evicted {name} from the scene cache")
+
+        if total > self.max_bytes:
+            logging.warning(
+                f"Scene cache is {total} bytes, over its budget of {self.max_bytes} bytes because of pinned entries"
+            )
+
+        return evicted
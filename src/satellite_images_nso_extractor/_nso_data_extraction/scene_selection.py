@@ -0,0 +1,138 @@
+import logging
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+from shapely.strtree import STRtree
+
+"""
+    Selection of a minimal set of scenes which together cover a region.
+
+    Uses a greedy set cover on the covered polygons of the download links, with a spatial index over the candidates.
+    Candidates which add about the same area are ranked by: the same date as an already selected scene, the same
+    satellite as an already selected scene and the lowest cloud cover.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+
+def __preference(candidate, selected_dates, selected_satellites):
+    """
+    Rank key of a candidate, lower is better.
+    """
+    cloudcover = candidate.get("cloudcover")
+    return (
+        candidate["date"] not in selected_dates,
+        candidate["satellite"] not in selected_satellites,
+        float(cloudcover) if cloudcover is not None and pd.notna(cloudcover) else 100.0,
+    )
+
+
+def select_minimal_scenes(
+    links: pd.DataFrame,
+    region,
+    target_fraction: float = 0.95,
+    start_date: str = None,
+    end_date: str = None,
+    links_must_contain: list = [],
+    gain_tolerance: float = 0.05,
+) -> pd.DataFrame:
+    """
+    Select a minimal set of links whose covered polygons together cover the region above a target fraction.
+
+    @param links: pandas dataframe as returned by nso_georegion.retrieve_download_links.
+    @param region: shapely polygon of the region in WGS84.
+    @param target_fraction: the fraction of the region which has to be covered, between 0 and 1.
+    @param start_date: optional start of the date window, in "YYYY-MM-DD" format.
+    @param end_date: optional end of the date window, in "YYYY-MM-DD" format.
+    @param links_must_contain: only links which contain all these strings are candidates, i.e. ["RGBNED", "30cm"].
+    @param gain_tolerance: candidates which add at least (1 - gain_tolerance) of the best added area are ranked on date, satellite and cloud cover.
+    @return: the selected links in order of selection, with an extra 'covered_fraction' column with the total covered fraction.
+    """
+    candidates = links
+    for must_contain in links_must_contain:
+        candidates = candidates[
+            candidates["link"].str.contains(must_contain, regex=False)
+        ]
+
+    dates = pd.to_datetime(candidates["date"], format="%Y%m%d")
+    in_window = pd.Series(True, index=candidates.index)
+    if start_date:
+        in_window &= dates >= pd.Timestamp(start_date)
+    if end_date:
+        in_window &= dates <= pd.Timestamp(end_date)
+    candidates = candidates[in_window]
+
+    # Product variants of the same scene (RGB, RGBI, RGBNED) cover the same area, keep one download per scene.
+    candidates = candidates[candidates["covered_polygon"].notna()]
+    candidates = candidates.assign(
+        scene=candidates["link"].str.split("/").str[-1]
+    ).drop_duplicates("scene")
+
+    if len(candidates) == 0:
+        logging.info("No candidate scenes to select from")
+        return links.iloc[0:0].assign(covered_fraction=pd.Series(dtype=float))
+
+    # Areas are calculated in rijks driehoek, WGS84 degrees are not equal area.
+    covered = gpd.GeoSeries(
+        list(candidates["covered_polygon"]), crs="EPSG:4326"
+    ).to_crs("EPSG:28992")
+    region = gpd.GeoSeries([region], crs="EPSG:4326").to_crs("EPSG:28992").iloc[0]
+    covered = [shapely.make_valid(polygon) for polygon in covered]
+
+    region_area = region.area
+    tree = STRtree(covered)
+    uncovered = region
+    records = candidates.to_dict("records")
+
+    selected, selected_fractions = [], []
+    selected_dates, selected_satellites = set(), set()
+    covered_fraction = 0.0
+
+    while covered_fraction < target_fraction:
+        gains = {}
+        for i in tree.query(uncovered, predicate="intersects"):
+            if i in selected:
+                continue
+            gain = covered[i].intersection(uncovered).area
+            if gain > 0:
+                gains[i] = gain
+
+        if len(gains) == 0:
+            logging.info(
+                f"Scenes can not cover more than {covered_fraction:.2%} of the region"
+            )
+            print(
+                f"Scenes can not cover more than {covered_fraction:.2%} of the region"
+            )
+            break
+
+        best_gain = max(gains.values())
+        best = min(
+            [
+                i
+                for i, gain in gains.items()
+                if gain >= best_gain * (1 - gain_tolerance)
+            ],
+            key=lambda i: (
+                __preference(records[i], selected_dates, selected_satellites),
+                -gains[i],
+            ),
+        )
+
+        selected.append(best)
+        selected_dates.add(records[best]["date"])
+        selected_satellites.add(records[best]["satellite"])
+        uncovered = uncovered.difference(covered[best])
+        covered_fraction = 1 - uncovered.area / region_area
+        selected_fractions.append(covered_fraction)
+
+    print(
+        f"Selected {len(selected)} of {len(candidates)} scenes covering {covered_fraction:.2%} of the region"
+    )
+
+    return (
+        candidates.iloc[selected]
+        .drop(columns="scene")
+        .assign(covered_fraction=selected_fractions)
+    )
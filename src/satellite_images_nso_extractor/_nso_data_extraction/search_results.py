@@ -0,0 +1,93 @@
+import logging
+
+import geopandas as gpd
+import pandas as pd
+
+"""
+    Typed search results of the NSO api.
+
+    The links found by nso_api.retrieve_download_links are turned into a GeoDataFrame with the scene footprint as
+    geometry and the metadata which is in the link and the search response as typed columns:
+
+    - date (str, YYYYMMDD) and datetime (datetime64) of the acquisition.
+    - satellite and bands (category), resolution (str, i.e. "30cm") and resolution_m (float).
+    - cloudcover (float) of the whole scene.
+
+    All metadata is parsed with vectorized string operations. The results can be saved to GeoParquet with save_links.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+LINK_COLUMNS = [
+    "link",
+    "percentage_geojson",
+    "missing_polygon",
+    "covered_polygon",
+    "footprint",
+    "cloudcover",
+]
+
+# The scene name of a link starts with the date, time and satellite, i.e. 20230513_104139_PNEO-03_...
+SCENE_PATTERN = r"^(?P<date>[^_]*)(?:_(?P<time>[^_]*))?(?:_(?P<satellite>[^_]*))?"
+
+
+def to_geodataframe(links) -> gpd.GeoDataFrame:
+    """
+    Make a typed GeoDataFrame of the links found by nso_api.retrieve_download_links.
+
+    @param links: a list of [link, percentage_geojson, missing_polygon, covered_polygon, footprint, cloudcover] lists.
+    @return: a GeoDataFrame in WGS84 with the footprint as geometry.
+    """
+    links = pd.DataFrame(links, columns=LINK_COLUMNS)
+
+    scene = links["link"].astype(str).str.split("/").str[-1]
+    scene_parts = scene.str.extract(SCENE_PATTERN)
+
+    links["date"] = scene_parts["date"]
+    links["datetime"] = pd.to_datetime(
+        scene_parts["date"] + scene_parts["time"].fillna("000000").str[:6],
+        format="%Y%m%d%H%M%S",
+        errors="coerce",
+    )
+    links["satellite"] = scene_parts["satellite"].astype("category")
+    links["bands"] = (
+        links["link"].str.extract(r"(RGBNED|RGBI|RGB)", expand=False).astype("category")
+    )
+    links["resolution"] = links["link"].str.extract(r"(\d{2,3}cm)", expand=False)
+    links["resolution_m"] = (
+        links["resolution"].str.extract(r"(\d+)", expand=False).astype(float) / 100
+    )
+    links["cloudcover"] = pd.to_numeric(links["cloudcover"], errors="coerce")
+    links["percentage_geojson"] = pd.to_numeric(
+        links["percentage_geojson"], errors="coerce"
+    )
+
+    links["missing_polygon"] = gpd.GeoSeries(
+        links["missing_polygon"], index=links.index, crs="EPSG:4326"
+    )
+    links["covered_polygon"] = gpd.GeoSeries(
+        links["covered_polygon"], index=links.index, crs="EPSG:4326"
+    )
+
+    return gpd.GeoDataFrame(links, geometry="footprint", crs="EPSG:4326")
+
+
+def save_links(links: gpd.GeoDataFrame, path: str):
+    """
+    Save search results to a GeoParquet file, the polygons are stored as geometry columns.
+
+    @param links: a GeoDataFrame as returned by nso_georegion.retrieve_download_links.
+    @param path: path to the .parquet file.
+    """
+    links.to_parquet(path, index=False)
+    logging.info(f"Saved {len(links)} links to {path}")
+
+
+def load_links(path: str) -> gpd.GeoDataFrame:
+    """
+    Load search results saved with save_links.
+
+    @param path: path to the .parquet file.
+    @return: the GeoDataFrame of the links.
+    """
+    return gpd.read_parquet(path)
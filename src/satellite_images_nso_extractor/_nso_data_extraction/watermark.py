@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from satellite_images_nso_extractor._nso_data_extraction.file_lock import file_lock
+
+"""
+    Per region watermarks for incremental searches.
+
+    A watermark is the acquisition date of the newest link which has been processed for a region. A repeat search
+    then only asks the NSO for acquisitions from the watermark onwards, minus a few days of overlap for scenes which
+    are published later than they are acquired. The watermarks are stored in a small .json file next to the output,
+    guarded by a file lock so several processes can update it.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+WATERMARK_FILE_NAME = "nso_watermarks.json"
+
+
+def link_date(link):
+    """
+    Get the acquisition date of a download link.
+
+    @param link: a download link from the NSO.
+    @return: the acquisition date in "YYYY-MM-DD" format.
+    """
+    return datetime.strptime(link.split("/")[-1].split("_")[0], "%Y%m%d").strftime(
+        "%Y-%m-%d"
+    )
+
+
+class region_watermarks:
+    """
+    A .json file with the watermark of every region.
+    """
+
+    def __init__(self, path: str):
+        """
+        Init of the watermarks.
+
+        @param path: path to the .json file, a folder means the default file name in that folder.
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, WATERMARK_FILE_NAME)
+        self.path = path
+
+    def _read(self):
+        """
+        Read all the watermarks.
+        """
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as watermark_file:
+                return json.load(watermark_file)
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read watermarks {self.path}: {e}")
+            return {}
+
+    def get(self, region_key: str):
+        """
+        Get the watermark of a region.
+
+        @param region_key: the key of the region, for example the path to its geojson.
+        @return: the watermark in "YYYY-MM-DD" format or None when the region has not been processed yet.
+        """
+        return self._read().get(region_key, {}).get("watermark")
+
+    def search_start(self, region_key: str, start_date: str, overlap_days: int = 7):
+        """
+        Get the start date of an incremental search for a region.
+
+        @param region_key: the key of the region.
+        @param start_date: the start date of a full search, in "YYYY-MM-DD" format.
+        @param overlap_days: days before the watermark which are searched again, for scenes published late.
+        @return: the latest of start_date and the watermark minus overlap_days.
+        """
+        watermark = self.get(region_key)
+        if watermark is None:
+            return start_date
+
+        search_start = (
+            datetime.strptime(watermark, "%Y-%m-%d") - timedelta(days=overlap_days)
+        ).strftime("%Y-%m-%d")
+        return max(start_date, search_start)
+
+    def advance(self, region_key: str, watermark: str):
+        """
+        Move the watermark of a region forward, a watermark never moves back.
+
+        @param region_key: the key of the region.
+        @param watermark: the new watermark in "YYYY-MM-DD" format.
+        @return: the watermark of the region after the update.
+        """
+        with file_lock(self.path + ".lock"):
+            watermarks = self._read()
+            entry = watermarks.setdefault(region_key, {})
+            if entry.get("watermark") is None or watermark > entry["watermark"]:
+                entry["watermark"] = watermark
+                entry["updated"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+                temporary_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+                with open(temporary_path, "w") as watermark_file:
+                    json.dump(watermarks, watermark_file, indent=2)
+                os.replace(temporary_path, self.path)
+
+        return entry["watermark"]
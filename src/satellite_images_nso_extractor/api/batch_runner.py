@@ -0,0 +1,490 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import date
+
+import satellite_images_nso_extractor._manipulation.window_executor as window_executor
+import satellite_images_nso_extractor._nso_data_extraction.link_journal as link_journal
+import satellite_images_nso_extractor._nso_data_extraction.scene_cache as scene_cache
+import satellite_images_nso_extractor._nso_data_extraction.watermark as watermark
+import satellite_images_nso_extractor.api.nso_georegion as nso
+
+"""
+    Command line batch runner for nightly jobs.
+
+    Reads a job file (.json) which lists regions with their date ranges, link filters and execute_link options.
+    Runs the search, the selection of links and execute_link across a configurable number of worker processes.
+
+    Example of a job file:
+
+    {
+        "output_folder": "/data/nso",
+        "workers": 4,
+        "regions": [
+            {
+                "path_to_geojson": "/data/regions/coepelduynen.geojson",
+                "start_date": "2023-01-01",
+                "end_date": "2023-12-31",
+                "max_diff": 0.8,
+                "cloud_coverage_whole": 30,
+                "filters": {"links_must_contain": ["RGBNED"], "resolution": "30cm"},
+                "execute": {"add_ndvi_band": true, "delete_zip_file": false}
+            }
+        ]
+    }
+
+    Usage: nso-batch job.json --workers 8
+
+    With --incremental a region is only searched from its watermark, the acquisition date of the newest link processed
+    for it in an earlier run, minus watermark_overlap_days (7 by default) for scenes which are published late. The
+    watermarks are kept per region in nso_watermarks.json in the output folder, or in the watermark_file of a region.
+    With --watch the job file is run incrementally every --interval hours, so only new scenes are processed.
+
+    Every completed stage of a link is recorded in a journal in the output folder of its region, so a link which was
+    stopped halfway by a crash is resumed after its last completed stage by the next run.
+
+    The zip archives and extracted folders of all regions go to one scene cache of the job, by default the folder
+    nso_scene_cache in the output folder with a budget of 100 GB, set with scene_cache_folder and scene_cache_gb.
+    Regions in different worker processes which need the same scene then download and extract it once, and never
+    delete it while an other process is still cropping it. delete_zip_file and delete_source_files are ignored, the
+    scene cache deletes the least recently used scenes when it is over its budget.
+
+    The NSO credentials are read from the job file or the NSO_USERNAME and NSO_PASSWORD environment variables.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+# Keys of a region in a job file which are passed to nso_georegion.retrieve_download_links.
+SEARCH_OPTIONS = [
+    "start_date",
+    "end_date",
+    "max_meters",
+    "strict_region",
+    "max_diff",
+    "cloud_coverage_whole",
+]
+
+# The folder of the scene cache in the output folder, when the job file does not set scene_cache_folder.
+SCENE_CACHE_FOLDER_NAME = "nso_scene_cache"
+
+# The georegions are cached per worker process, so the geojson is only parsed once per process.
+_georegions = {}
+
+
+def read_job_file(path):
+    """
+    Read a job file and apply the job level defaults to every region.
+
+    @param path: path to a .json job file.
+    @return: a dictionary with the job settings and a list of regions.
+    """
+    with open(path, "r") as job_file:
+        job = json.load(job_file)
+
+    if "regions" not in job or len(job["regions"]) == 0:
+        raise ValueError(f"No regions found in job file: {path}")
+
+    job.setdefault("workers", 1)
+    job.setdefault("username", os.getenv("NSO_USERNAME", ""))
+    job.setdefault("password", os.getenv("NSO_PASSWORD", ""))
+    job.setdefault("scene_cache_gb", 100)
+
+    defaults = job.get("defaults", {})
+    for region in job["regions"]:
+        if "path_to_geojson" not in region:
+            raise ValueError("Every region in a job file needs a path_to_geojson")
+
+        for key, value in defaults.items():
+            region.setdefault(key, value)
+        region.setdefault("output_folder", job.get("output_folder"))
+        region.setdefault("filters", {})
+        # All regions share the scene cache of the job, so worker processes never download the same scene at once.
+        region.setdefault(
+            "scene_cache_folder",
+            job.get(
+                "scene_cache_folder",
+                os.path.join(str(region["output_folder"]), SCENE_CACHE_FOLDER_NAME),
+            ),
+        )
+        region.setdefault("scene_cache_gb", job["scene_cache_gb"])
+        region.setdefault(
+            "watermark_file",
+            os.path.join(str(region["output_folder"]), watermark.WATERMARK_FILE_NAME),
+        )
+        region.setdefault("execute", {})
+        # Plotting in worker processes is never wanted.
+        region["execute"].setdefault("plot", False)
+
+        if region["output_folder"] is None:
+            raise ValueError(
+                f"No output_folder for region: {region['path_to_geojson']}"
+            )
+
+    return job
+
+
+def get_georegion(region, username, password):
+    """
+    Get a nso_georegion for a region of the job file, reusing the one made earlier in this process.
+
+    @param region: a region from the job file.
+    @param username: the username of the nso account.
+    @param password: the password of the nso account.
+    @return: a nso_georegion object.
+    """
+    key = (region["path_to_geojson"], region["output_folder"])
+    if key not in _georegions:
+        os.makedirs(region["output_folder"], exist_ok=True)
+        _georegions[key] = nso.nso_georegion(
+            path_to_geojson=region["path_to_geojson"],
+            output_folder=region["output_folder"],
+            username=username,
+            password=password,
+            cloud_detection_model_path=region.get("cloud_detection_model_path"),
+            scene_cache=scene_cache.scene_cache(
+                region["scene_cache_folder"],
+                int(float(region["scene_cache_gb"]) * 1024**3),
+            ),
+            journal=link_journal.link_journal(region["output_folder"]),
+        )
+    return _georegions[key]
+
+
+def select_links(links, filters):
+    """
+    Select the links of a search result with the filters of a region.
+
+    @param links: pandas dataframe as returned by nso_georegion.retrieve_download_links.
+    @param filters: dictionary with optional keys links_must_contain, resolution, satellite and max_links.
+    @return: a list of links.
+    """
+    for must_contain in filters.get("links_must_contain", []):
+        links = links[links["link"].str.contains(must_contain, regex=False)]
+
+    if "resolution" in filters:
+        links = links[links["resolution"] == filters["resolution"]]
+
+    if "satellite" in filters:
+        links = links[links["satellite"].str.contains(filters["satellite"])]
+
+    links = links.sort_values("date")
+    if "max_links" in filters:
+        links = links.tail(int(filters["max_links"]))
+
+    return list(links["link"])
+
+
+def get_region_key(region):
+    """
+    Get the key of a region in the watermark file.
+
+    @param region: a region from the job file.
+    @return: the absolute path to the geojson of the region.
+    """
+    return os.path.abspath(region["path_to_geojson"]).replace("\\", "/")
+
+
+def search_region(region, username, password, incremental=False):
+    """
+    Search and select the links of a region, runs in a worker process.
+
+    @param region: a region from the job file.
+    @param username: the username of the nso account.
+    @param password: the password of the nso account.
+    @param incremental: only search from the watermark of the region.
+    @return: the list of selected links.
+    """
+    georegion = get_georegion(region, username, password)
+    search_options = {key: region[key] for key in SEARCH_OPTIONS if key in region}
+
+    if incremental:
+        search_options["start_date"] = watermark.region_watermarks(
+            region["watermark_file"]
+        ).search_start(
+            get_region_key(region),
+            search_options.get("start_date", "2014-01-01"),
+            int(region.get("watermark_overlap_days", 7)),
+        )
+        logging.info(
+            f"Incremental search of {region['path_to_geojson']} from {search_options['start_date']}"
+        )
+    links = georegion.retrieve_download_links(**search_options)
+
+    return select_links(links, region["filters"])
+
+
+def execute_region_link(region, link, username, password):
+    """
+    Run execute_link for a single link of a region, runs in a worker process.
+
+    @param region: a region from the job file.
+    @param link: the link to execute.
+    @return: the path of the resulting .tif file.
+    """
+    georegion = get_georegion(region, username, password)
+
+    return georegion.execute_link(link, **get_execute_options(region))
+
+
+def get_execute_options(region):
+    """
+    Get the execute_link options of a region.
+
+    @param region: a region from the job file.
+    @return: a dictionary with the options.
+    """
+    # Fill coordinates are polygons from the search, which do not fit in a job file.
+    return {
+        key: value
+        for key, value in region["execute"].items()
+        if key != "fill_coordinates"
+    }
+
+
+def is_link_done(georegion, link, execute_options={}):
+    """
+    Check if a link has already been done for a region, without downloading anything.
+
+    The journal of the region decides, a link which was stopped halfway is not done. Links without a journal, i.e.
+    from runs before the journal existed, are done when a cropped .tif file exists.
+
+    @param georegion: the nso_georegion of a region from the job file.
+    @param link: the link to check.
+    @param execute_options: the execute_link options of the region.
+    @return: True if all stages of the link are completed.
+    """
+    completed = georegion.is_link_completed(link, **execute_options)
+    if completed is not None:
+        return completed
+    return len(georegion.find_cropped_files(link)) > 0
+
+
+def advance_watermark(region, done_links, failed_links):
+    """
+    Move the watermark of a region to the newest link processed, but not past a link which failed.
+
+    @param region: a region from the job file.
+    @param done_links: the links which have been processed or were already cropped.
+    @param failed_links: the links which failed, these are searched again in the next run.
+    @return: the new watermark or None when it has not moved.
+    """
+    done_dates = [watermark.link_date(link) for link in done_links]
+    if len(failed_links) > 0:
+        first_failed = min(watermark.link_date(link) for link in failed_links)
+        done_dates = [done for done in done_dates if done < first_failed]
+
+    if len(done_dates) == 0:
+        return None
+
+    watermarks = watermark.region_watermarks(region["watermark_file"])
+    old_watermark = watermarks.get(get_region_key(region))
+    new_watermark = watermarks.advance(get_region_key(region), max(done_dates))
+
+    return new_watermark if new_watermark != old_watermark else None
+
+
+@contextmanager
+def processes_environment(workers):
+    """
+    Set the number of worker processes in the environment while a pool is running, the variable is restored after.
+
+    The window executors in the worker processes read it to divide the cores between the processes.
+
+    @param workers: the number of worker processes.
+    """
+    previous = os.environ.get(window_executor.PROCESSES_ENVIRONMENT_VARIABLE)
+    os.environ[window_executor.PROCESSES_ENVIRONMENT_VARIABLE] = str(workers)
+    try:
+        yield
+    finally:
+        if previous is None:
+            del os.environ[window_executor.PROCESSES_ENVIRONMENT_VARIABLE]
+        else:
+            os.environ[window_executor.PROCESSES_ENVIRONMENT_VARIABLE] = previous
+
+
+def run_job(job, workers=None, incremental=False):
+    """
+    Run all the regions of a job over a pool of worker processes.
+
+    @param job: a job as returned by read_job_file.
+    @param workers: the number of worker processes, overrides the number in the job file.
+    @param incremental: only search regions from their watermark and move the watermarks after the run.
+    @return: a dictionary with the throughput summary of the run.
+    """
+    workers = workers if workers else int(job["workers"])
+    username, password = job["username"], job["password"]
+    start_time = time.time()
+
+    summary = {
+        "regions": len(job["regions"]),
+        "links_found": 0,
+        "links_skipped": 0,
+        "links_processed": 0,
+        "links_failed": 0,
+        "searches_failed": 0,
+        "bytes_written": 0,
+        "watermarks_advanced": 0,
+    }
+    done_links = {i: [] for i in range(len(job["regions"]))}
+    failed_links = {i: [] for i in range(len(job["regions"]))}
+    searched = set()
+
+    with processes_environment(workers), ProcessPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        # Stage 1: search and select links for every region.
+        search_futures = {
+            executor.submit(search_region, region, username, password, incremental): i
+            for i, region in enumerate(job["regions"])
+        }
+
+        execute_futures = {}
+        for future in as_completed(search_futures):
+            i = search_futures[future]
+            region = job["regions"][i]
+            try:
+                links = future.result()
+            except Exception as e:
+                logging.error(f"Search failed for {region['path_to_geojson']}: {e}")
+                print(f"Search failed for {region['path_to_geojson']}: {e}")
+                summary["searches_failed"] += 1
+                continue
+
+            summary["links_found"] += len(links)
+            searched.add(i)
+
+            # Stage 2: execute the links which have not been done yet.
+            georegion = get_georegion(region, username, password)
+            for link in links:
+                if is_link_done(georegion, link, get_execute_options(region)):
+                    logging.info(f"Skipping already cropped link: {link}")
+                    summary["links_skipped"] += 1
+                    done_links[i].append(link)
+                    continue
+
+                execute_futures[
+                    executor.submit(
+                        execute_region_link, region, link, username, password
+                    )
+                ] = (i, link)
+
+        for future in as_completed(execute_futures):
+            i, link = execute_futures[future]
+            try:
+                cropped_path = future.result()
+                summary["links_processed"] += 1
+                done_links[i].append(link)
+                if cropped_path and os.path.isfile(cropped_path):
+                    summary["bytes_written"] += os.path.getsize(cropped_path)
+                print(f"Done: {link} -> {cropped_path}")
+            except Exception as e:
+                logging.error(f"Failed to execute {link}: {e}")
+                print(f"Failed to execute {link}: {e}")
+                summary["links_failed"] += 1
+                failed_links[i].append(link)
+
+    if incremental:
+        for i in searched:
+            new_watermark = advance_watermark(
+                job["regions"][i], done_links[i], failed_links[i]
+            )
+            if new_watermark is not None:
+                logging.info(
+                    f"Watermark of {job['regions'][i]['path_to_geojson']} is {new_watermark}"
+                )
+                summary["watermarks_advanced"] += 1
+
+    summary["seconds"] = time.time() - start_time
+    summary["links_per_hour"] = (
+        summary["links_processed"] / summary["seconds"] * 3600
+        if summary["seconds"] > 0
+        else 0
+    )
+
+    return summary
+
+
+def print_summary(summary):
+    """
+    Print the throughput summary of a run.
+
+    @param summary: a dictionary as returned by run_job.
+    """
+    print("------------------ NSO batch summary ------------------")
+    print(f"Date:              {date.today().strftime('%Y-%m-%d')}")
+    print(f"Regions:           {summary['regions']}")
+    print(f"Links found:       {summary['links_found']}")
+    print(f"Links skipped:     {summary['links_skipped']}")
+    print(f"Links processed:   {summary['links_processed']}")
+    print(f"Links failed:      {summary['links_failed']}")
+    print(f"Searches failed:   {summary['searches_failed']}")
+    print(f"Watermarks moved:  {summary['watermarks_advanced']}")
+    print(f"Written:           {summary['bytes_written'] / 1024**3:.2f} GB")
+    print(f"Elapsed:           {summary['seconds'] / 60:.1f} minutes")
+    print(f"Throughput:        {summary['links_per_hour']:.1f} links per hour")
+
+
+def main(argv=None):
+    """
+    Console entry point, see the module docstring for the job file format.
+    """
+    parser = argparse.ArgumentParser(
+        description="Run NSO search, selection and execute_link for the regions in a job file."
+    )
+    parser.add_argument("job_file", help="Path to a .json job file.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes, overrides the job file.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only search for scenes newer than the watermark of every region.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running incrementally, polling for new scenes every --interval hours.",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=24,
+        help="Hours between runs in watch mode.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.watch:
+        try:
+            while True:
+                # The job file is read every run, so regions can be added while watching.
+                try:
+                    job = read_job_file(args.job_file)
+                    print_summary(run_job(job, workers=args.workers, incremental=True))
+                except Exception as e:
+                    # A broken job file or a failed run is retried at the next poll, watching goes on.
+                    logging.error(f"Watch run of {args.job_file} failed: {e}")
+                    print(f"Watch run of {args.job_file} failed: {e}")
+                print(f"Next run in {args.interval} hours")
+                time.sleep(args.interval * 3600)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+            return 0
+
+    job = read_job_file(args.job_file)
+    summary = run_job(job, workers=args.workers, incremental=args.incremental)
+    print_summary(summary)
+
+    return 1 if summary["links_failed"] + summary["searches_failed"] > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import geopandas as gpd
+from shapely.geometry import Polygon
+
+import satellite_images_nso_extractor._nso_data_extraction.download_scheduler as download_scheduler
+import satellite_images_nso_extractor._nso_data_extraction.local_portal as local_portal
+import satellite_images_nso_extractor._nso_data_extraction.nso_client as nso_client
+import satellite_images_nso_extractor.api.nso_georegion as nso
+
+"""
+    Load test of the whole pipeline against a local stand-in of the NSO portal.
+
+    Starts a local_portal with synthetic scenes around a region, then runs the search, the downloads with the download
+    scheduler and execute_link for every link, like a batch run would, and reports the time of every stage and the
+    number of links per hour. Latency, bandwidth, errors and throttling of the portal are configurable, so the
+    behaviour of the client and the scheduler under a slow or overloaded portal can be measured without credentials.
+
+    Usage: nso-load-test /tmp/nso_load_test --scenes 50 --download-workers 4 --latency 0.2 --throttle-rate 0.1
+
+    Without --geojson a small region in the middle of the portal footprint is used.
+
+    Author: Michael de Winter, Pieter Kouyzer
+"""
+
+# The footprint of the synthetic scenes when no geojson is given, a small area near Leiden.
+DEFAULT_BOUNDS = (4.41, 52.22, 4.42, 52.23)
+
+
+def make_region(output_folder, bounds=DEFAULT_BOUNDS):
+    """
+    Write a geojson with a region in the middle of bounds.
+
+    @param output_folder: the folder to write the geojson to.
+    @param bounds: lon/lat bounds in WGS84.
+    @return: the path to the geojson.
+    """
+    left, bottom, right, top = bounds
+    width, height = right - left, top - bottom
+    # A irregular polygon, the region check of nso_api compares the coordinates of the region and the scene.
+    corners = [
+        (0.3, 0.25),
+        (0.7, 0.28),
+        (0.76, 0.55),
+        (0.62, 0.73),
+        (0.35, 0.7),
+        (0.24, 0.45),
+    ]
+    path = os.path.join(output_folder, "load_test_region.geojson")
+    gpd.GeoDataFrame(
+        geometry=[
+            Polygon([(left + x * width, bottom + y * height) for x, y in corners])
+        ],
+        crs="EPSG:4326",
+    ).to_file(path, driver="GeoJSON")
+    return path
+
+
+def get_portal_bounds(path_to_geojson, margin=0.002):
+    """
+    Get the footprint of the synthetic scenes around a region.
+
+    @param path_to_geojson: path to the geojson of the region.
+    @param margin: the margin around the region in degrees.
+    @return: lon/lat bounds in WGS84.
+    """
+    left, bottom, right, top = gpd.read_file(path_to_geojson).to_crs(4326).total_bounds
+    return (left - margin, bottom - margin, right + margin, top + margin)
+
+
+def run_load_test(
+    output_folder: str,
+    path_to_geojson: str = None,
+    scenes: int = 20,
+    download_workers: int = 4,
+    execute_workers: int = 2,
+    start_date: str = "2023-01-01",
+    end_date: str = "2023-12-31",
+    execute_options: dict = None,
+    **portal_options,
+):
+    """
+    Run the pipeline against a local portal and measure it.
+
+    @param output_folder: the folder for the downloads and cropped files.
+    @param path_to_geojson: optional region, by default a small region is made.
+    @param scenes: the number of scenes the portal serves.
+    @param download_workers: the number of concurrent downloads of the scheduler.
+    @param execute_workers: the number of links which are extracted and cropped at once.
+    @param start_date: the start date of the search.
+    @param end_date: the end date of the search.
+    @param execute_options: options for execute_link, by default only the ndvi is added.
+    @param portal_options: other options of the local_portal, like latency, bandwidth, error_rate and throttle_rate.
+    @return: a dictionary with the counts, the time of every stage, the links per hour and the portal statistics.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    if path_to_geojson is None:
+        path_to_geojson = make_region(output_folder)
+    execute_options = (
+        execute_options if execute_options is not None else {"add_ndvi_band": True}
+    )
+    execute_options.setdefault("plot", False)
+
+    report = {
+        "links_found": 0,
+        "links_downloaded": 0,
+        "links_processed": 0,
+        "links_failed": 0,
+    }
+    portal_options.setdefault("bounds", get_portal_bounds(path_to_geojson))
+
+    with local_portal.local_portal(scenes=scenes, **portal_options) as portal:
+        client = nso_client.nso_client(
+            portal.username,
+            portal.password,
+            base_url=portal.url,
+            backoff_factor=0.1,
+        )
+        georegion = nso.nso_georegion(
+            output_folder=output_folder,
+            username=portal.username,
+            password=portal.password,
+            path_to_geojson=path_to_geojson,
+            client=client,
+        )
+
+        start = time.time()
+        links = georegion.retrieve_download_links(
+            start_date=start_date, end_date=end_date, max_diff=0.5
+        )
+        report["links_found"] = len(links)
+        report["search_seconds"] = time.time() - start
+
+        download_start = time.time()
+        with download_scheduler.download_scheduler(
+            portal.username,
+            portal.password,
+            max_concurrent=download_workers,
+            max_per_host=download_workers,
+            throttle_backoff=portal.retry_after,
+            client=client,
+        ) as scheduler:
+            downloads = georegion.download_links(links, scheduler=scheduler)
+        downloaded = [
+            link for link, path in downloads.items() if not isinstance(path, Exception)
+        ]
+        report["links_downloaded"] = len(downloaded)
+        report["links_failed"] += len(downloads) - len(downloaded)
+        report["download_seconds"] = time.time() - download_start
+
+        execute_start = time.time()
+        with ThreadPoolExecutor(max_workers=execute_workers) as executor:
+            futures = {
+                executor.submit(georegion.execute_link, link, **execute_options): link
+                for link in downloaded
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    report["links_processed"] += 1
+                except Exception as e:
+                    logging.error(f"Failed to execute {futures[future]}: {e}")
+                    report["links_failed"] += 1
+        report["execute_seconds"] = time.time() - execute_start
+
+        report["seconds"] = time.time() - start
+        report["links_per_hour"] = (
+            report["links_processed"] / report["seconds"] * 3600
+            if report["seconds"] > 0
+            else 0
+        )
+        report["portal"] = dict(portal.stats)
+        client.close()
+
+    return report
+
+
+def print_report(report):
+    """
+    Print the report of a load test.
+    """
+    print("----- Load test -----")
+    print(f"Links found:       {report['links_found']}")
+    print(f"Links downloaded:  {report['links_downloaded']}")
+    print(f"Links processed:   {report['links_processed']}")
+    print(f"Links failed:      {report['links_failed']}")
+    print(f"Search:            {report['search_seconds']:.1f} seconds")
+    print(f"Downloads:         {report['download_seconds']:.1f} seconds")
+    print(f"Extract and crop:  {report['execute_seconds']:.1f} seconds")
+    print(f"Throughput:        {report['links_per_hour']:.1f} links per hour")
+    print(f"Portal:            {json.dumps(report['portal'])}")
+
+
+def main(argv=None):
+    """
+    Console entry point, see the module docstring.
+    """
+    parser = argparse.ArgumentParser(
+        description="Load test the NSO pipeline against a local stand-in of the NSO portal."
+    )
+    parser.add_argument("output_folder", help="Folder for the downloads and crops.")
+    parser.add_argument("--geojson", default=None, help="Path to a region.")
+    parser.add_argument("--scenes", type=int, default=20)
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--execute-workers", type=int, default=2)
+    parser.add_argument(
+        "--pixel-size",
+        type=float,
+        default=1.0,
+        help="Pixel size in meters of the synthetic scenes.",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds before every response."
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=None,
+        help="Bytes per second of every download.",
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="Fraction of requests with a 500."
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0,
+        help="Fraction of requests with a 429.",
+    )
+    parser.add_argument(
+        "--max-concurrent-downloads",
+        type=int,
+        default=None,
+        help="Downloads the portal serves at once, more are throttled.",
+    )
+    args = parser.parse_args(argv)
+
+    report = run_load_test(
+        args.output_folder,
+        path_to_geojson=args.geojson,
+        scenes=args.scenes,
+        download_workers=args.download_workers,
+        execute_workers=args.execute_workers,
+        pixel_size=args.pixel_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        max_concurrent_downloads=args.max_concurrent_downloads,
+    )
+    print_report(report)
+
+    return 1 if report["links_failed"] > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
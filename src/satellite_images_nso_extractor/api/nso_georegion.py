@@ -1,8 +1,8 @@
+import contextlib
 import glob
 import json
 import logging
 import os
-import pickle
 import re
 import shutil
 import warnings
@@ -10,20 +10,24 @@ from datetime import date, datetime
 
 import geopandas as gpd
 import numpy as np
-import pandas as pd
 import rasterio
 import shapely
-
-try:
-    from cloud_recognition.api import detect_clouds
-    CLOUD_DETECTION_AVAILABLE = True
-except ImportError:
-    CLOUD_DETECTION_AVAILABLE = False
-from rasterio.merge import merge
 from shapely.ops import unary_union
 
+import satellite_images_nso_extractor._manipulation.cloud_detection as cloud_detection
+import satellite_images_nso_extractor._manipulation.mask_cache as mask_cache
+import satellite_images_nso_extractor._manipulation.mosaic as mosaic
 import satellite_images_nso_extractor._manipulation.nso_manipulator as nso_manipulator
+import satellite_images_nso_extractor._manipulation.window_executor as window_executor
+import satellite_images_nso_extractor._nso_data_extraction.archive_extraction as archive_extraction
+import satellite_images_nso_extractor._nso_data_extraction.download_planner as download_planner
+import satellite_images_nso_extractor._nso_data_extraction.download_scheduler as download_scheduler
+import satellite_images_nso_extractor._nso_data_extraction.link_journal as link_journal
 import satellite_images_nso_extractor._nso_data_extraction.nso_api as nso_api
+import satellite_images_nso_extractor._nso_data_extraction.nso_client as nso_client
+import satellite_images_nso_extractor._nso_data_extraction.scene_cache as scene_cache
+import satellite_images_nso_extractor._nso_data_extraction.scene_selection as scene_selection
+import satellite_images_nso_extractor._nso_data_extraction.search_results as search_results
 
 # TODO: Make a decision about the logging.
 logging.basicConfig(
@@ -53,40 +57,89 @@ def correct_file_path(path):
     return path
 
 
-def merge_tifs(input_files, output_file):
+def merge_tifs(input_files, output_file, executor=None):
     """
     Merge two different 2 tif files together into one.
 
+    Where the files overlap the first file is kept. The merge is done block by block in the CRS of the files.
+
     @param input_files: a python array with files paths to .tif files in it.
     @param output_files: The name of the resulting output based on the merged tif files.
+    @param executor: optional window_executor, defaults to one thread per core.
     """
 
     print("Merging: " + input_files[0] + " and " + input_files[1])
 
-    with rasterio.open(input_files[0]) as src1, rasterio.open(input_files[1]) as src2:
-        # Check CRS
-        assert src1.crs == src2.crs, "CRS mismatch"
-
-    raster_to_mosiac = [rasterio.open(p) for p in input_files]
-    mosaic, output = merge(raster_to_mosiac)
-
-    output_meta = raster_to_mosiac[0].profile
-    output_meta.update(
-        {
-            "driver": "GTiff",
-            "interleave": "band",
-            "tiled": True,
-            "height": mosaic.shape[1],
-            "width": mosaic.shape[2],
-            "transform": output,
-        }
+    with rasterio.open(input_files[0]) as src:
+        resolution = src.res[0]
+
+    mosaic.build_mosaic(
+        input_files,
+        output_file,
+        rule="first",
+        resolution=resolution,
+        executor=(
+            executor if executor is not None else window_executor.window_executor()
+        ),
     )
 
-    for file in raster_to_mosiac:
-        file.close()
 
-    with rasterio.open(output_file, "w", **output_meta) as m:
-        m.write(mosaic)
+def find_raster(path):
+    """
+    Find the satellite image in a extracted folder.
+
+    @param path: path to a .tif file or a extracted folder.
+    @return: the path to the .tif file.
+    """
+    true_path = path
+    if ".tif" not in true_path:
+        # The manifest written while extracting says which .tif is the satellite image.
+        manifest_raster = archive_extraction.get_raster_path(path)
+        if manifest_raster is not None:
+            true_path = manifest_raster
+        else:
+            for x in glob.glob(path + "/**/*.tif", recursive=True):
+                true_path = x
+
+    if ".tif" not in true_path:
+        logging.error(true_path + " Error:  .tif not found")
+        raise Exception(".tif not found")
+
+    return true_path
+
+
+def crop_georegions(path, georegions, executor=None):
+    """
+    Crop one satellite image to several georegions in a single pass.
+
+    The satellite image is read once for all georegions, instead of once per georegion with nso_georegion.crop.
+
+    @param path: Path to a .tif file or a extracted folder.
+    @param georegions: a list of nso_georegion objects with different region names.
+    @param executor: optional window_executor, defaults to the executor of the first georegion.
+    @return: a dictionary of region names to the paths of the cropped files.
+    """
+    true_path = find_raster(path)
+    regions = {}
+    output_folders = {}
+    for georegion in georegions:
+        if georegion.region_name in regions:
+            raise ValueError(f"Region name {georegion.region_name} is used twice")
+        regions[georegion.region_name] = unary_union(georegion.get_crop_geometry())
+        output_folders[georegion.region_name] = georegion.output_folder
+
+    cropped_paths = nso_manipulator.crop_many(
+        true_path,
+        regions,
+        output_folders,
+        crs="EPSG:28992",
+        executor=executor if executor is not None else georegions[0].executor,
+        masks=georegions[0].crop_mask_cache,
+    )
+    for region_name, cropped_path in cropped_paths.items():
+        logging.info(f"Cropped file of {region_name} is found at: {cropped_path}")
+
+    return cropped_paths
 
 
 class nso_georegion:
@@ -105,6 +158,12 @@ class nso_georegion:
         coordinates: str = None,
         previous_link: str = None,
         cloud_detection_model_path: str = None,
+        scene_cache: scene_cache.scene_cache = None,
+        client: nso_client.nso_client = None,
+        executor: window_executor.window_executor = None,
+        crop_mask_cache: mask_cache.mask_cache = None,
+        cloud_detector: cloud_detection.cloud_detector = None,
+        journal: link_journal.link_journal = None,
     ):
         """
         Init of the class.
@@ -115,7 +174,13 @@ class nso_georegion:
         @param path_to_geojson: path where the geojson is located with the selected region.
         @param coordinates: instead of geojson also a polygon with coordinates can be given.
         @param previous_link: If we need to fill a region a with new satellite data, we need to know the previous since we have to find the closed link to this one.
-        @cloud_detection_model_path: optional location of a .sav of a cloud detection model
+        @cloud_detection_model_path: optional location of a .sav of a cloud detection model, the model is loaded once per process.
+        @param scene_cache: optional scene_cache with a byte budget where zip archives and extracted folders are kept, instead of the output folder.
+        @param client: optional nso_client, by default georegions of the same account share one pooled client.
+        @param executor: optional window_executor which crops and adds bands window by window, defaults to one thread per core.
+        @param crop_mask_cache: optional mask_cache with a cache folder for the crop masks, defaults to a shared in memory cache.
+        @param cloud_detector: optional cloud_detector, i.e. with a overview factor or the batched "pixels" method, instead of cloud_detection_model_path.
+        @param journal: optional link_journal, execute_link then records every completed stage of a link and resumes after the last one.
         """
         if path_to_geojson:
             self.path_to_geojson = correct_file_path(path_to_geojson)
@@ -156,10 +221,30 @@ class nso_georegion:
 
         self.username = username
         self.password = password
-        if cloud_detection_model_path:
-            self.cloud_detection_model = pickle.load(
-                open(cloud_detection_model_path, "rb")
+        self.scene_cache = scene_cache
+        # Pins of the scene cache entries downloaded by download_links, released when execute_link takes over.
+        self.prefetch_pins = {}
+        self.client = (
+            client if client is not None else nso_client.get_client(username, password)
+        )
+        self.executor = (
+            executor if executor is not None else window_executor.window_executor()
+        )
+        self.crop_mask_cache = (
+            crop_mask_cache
+            if crop_mask_cache is not None
+            else mask_cache.get_default_cache()
+        )
+        # The polygons to crop on in rijks driehoek, made on first use.
+        self.crop_geometry = None
+        self.journal = journal
+        self.cloud_detector = cloud_detector
+        if self.cloud_detector is None and cloud_detection_model_path:
+            self.cloud_detector = cloud_detection.get_cloud_detector(
+                cloud_detection_model_path
             )
+        if self.cloud_detector is not None:
+            self.cloud_detection_model = self.cloud_detector.model
 
         if previous_link:
             self.previous_link_date = datetime.strptime(
@@ -246,6 +331,8 @@ class nso_georegion:
         max_diff=0.8,
         cloud_coverage_whole=30,
         find_nearest_to_previous_link: bool = False,
+        shard_days: int = 365,
+        search_workers: int = 4,
     ):
         """
         This functions retrieves download links for area chosen in the geojson for the nso.
@@ -257,7 +344,9 @@ class nso_georegion:
         @param max_diff: The percentage that a satellite image has to have of the selected geojson region.
         @param cloud_coverage_whole: level percentage of clouds to filter out of the whole satellite image, so 30 means the percentage has to be less or equal to 30.
         @param find_nearest_to_previous_link: When this parameters is enabled it tries to find a link which is closed to the previous link in time.
-        @return: the found download links.
+        @param shard_days: the period is searched in shards of this many days.
+        @param search_workers: the number of shards which are searched concurrently.
+        @return: the found download links as a GeoDataFrame with the scene footprint as geometry and typed metadata columns, see search_results.to_geodataframe.
         """
 
         links = nso_api.retrieve_download_links(
@@ -270,6 +359,9 @@ class nso_georegion:
             strict_region,
             max_diff,
             cloud_coverage_whole,
+            shard_days=shard_days,
+            workers=search_workers,
+            client=self.client,
         )
 
         if find_nearest_to_previous_link is True:
@@ -299,33 +391,107 @@ class nso_georegion:
                 ]
             ]
 
-        return_links = pd.DataFrame(
-            links,
-            columns=[
-                "link",
-                "percentage_geojson",
-                "missing_polygon",
-                "covered_polygon",
-            ],
+        return_links = search_results.to_geodataframe(links)
+
+        return return_links
+
+    def save_links(self, links, path=None):
+        """
+        Save the links found by retrieve_download_links to a GeoParquet file, for fast filtering and joins later on.
+
+        @param links: the GeoDataFrame as returned by retrieve_download_links.
+        @param path: path to the .parquet file, defaults to the region name in the output folder.
+        @return: the path to the .parquet file.
+        """
+        if path is None:
+            path = f"{self.output_folder}/{self.region_name}_links.parquet"
+        search_results.save_links(links, path)
+
+        return path
+
+    def select_minimal_scenes(
+        self,
+        links,
+        target_fraction=0.95,
+        start_date=None,
+        end_date=None,
+        links_must_contain=[],
+    ):
+        """
+        Select a minimal set of links which together cover the region, to prevent downloading overlapping scenes.
+
+        @param links: pandas dataframe as returned by retrieve_download_links.
+        @param target_fraction: the fraction of the region which has to be covered, between 0 and 1.
+        @param start_date: optional start of the date window, in "YYYY-MM-DD" format.
+        @param end_date: optional end of the date window, in "YYYY-MM-DD" format.
+        @param links_must_contain: only links which contain all these strings are selected, i.e. ["RGBNED", "30cm"].
+        @return: the selected links with the total covered fraction of the region.
+        """
+        region = shapely.geometry.Polygon(
+            self.georegion_to_download[0], self.georegion_to_download[1:]
         )
 
-        return_links["date"] = (
-            return_links["link"].str.split("/").str[-1].str.split("_").str[0]
+        return scene_selection.select_minimal_scenes(
+            links,
+            region,
+            target_fraction=target_fraction,
+            start_date=start_date,
+            end_date=end_date,
+            links_must_contain=links_must_contain,
         )
-        return_links["satellite"] = (
-            return_links["link"].str.split("/").str[-1].str.split("_").str[2]
+
+    def plan_downloads(self, links, deduplicate=True, delete_zip_file=False, **kwargs):
+        """
+        Dry run of execute_link for links, reports the download volume, peak disk usage and runtime before downloading.
+
+        @param links: pandas dataframe as returned by retrieve_download_links.
+        @param deduplicate: keep only one product variant (RGB, RGBI, RGBNED) per scene.
+        @param delete_zip_file: whether zip files will be deleted, as in execute_link, ignored with a scene cache.
+        @param kwargs: other parameters for download_planner.plan_downloads, like download_speed.
+        @return: a dataframe with the plan per link and a dictionary with the totals.
+        """
+        geometry_type = "MultiPolygon" if self.buffered_polygon else "Polygon"
+        region_area = (
+            gpd.GeoSeries(
+                [
+                    shapely.geometry.shape(
+                        {"type": geometry_type, "coordinates": self.georegion_to_crop}
+                    )
+                ],
+                crs="EPSG:4326",
+            )
+            .to_crs("EPSG:28992")
+            .area.iloc[0]
         )
 
-        return_links["resolution"] = return_links.apply(
-            lambda x: (
-                re.search(r"(\d{2,3}cm)", str(x["link"]))[0]
-                if re.search(r"(\d{2,3}cm)", str(x["link"]))
-                else None
-            ),
-            axis=1,
+        plan, totals = download_planner.plan_downloads(
+            links,
+            self.output_folder,
+            self.region_name,
+            region_area,
+            self.username,
+            self.password,
+            deduplicate=deduplicate,
+            delete_zip_file=delete_zip_file,
+            client=self.client,
+            cache=self.scene_cache,
+            **kwargs,
         )
+        download_planner.print_plan(totals)
 
-        return return_links
+        return plan, totals
+
+    def get_crop_geometry(self):
+        """
+        Get the polygons to crop on in rijks driehoek, reprojected once per georegion.
+
+        @return: a list of shapely polygons in EPSG:28992.
+        """
+        if self.crop_geometry is None:
+            self.crop_geometry = nso_manipulator.get_crop_geometry(
+                self.georegion_to_crop, self.buffered_polygon
+            )
+        return self.crop_geometry
 
     def crop(self, path, plot):
         """
@@ -335,28 +501,23 @@ class nso_georegion:
         @oaram path: Path to a .tif file.
 
         """
-        true_path = path
-        if ".tif" not in true_path:
-            for x in glob.glob(path + "/**/*.tif", recursive=True):
-                true_path = x
-
-        if ".tif" not in true_path:
-            logging.error(true_path + " Error:  .tif not found")
-            raise Exception(".tif not found")
-        else:
-            cropped_path = nso_manipulator.run(
-                true_path,
-                self.georegion_to_crop,
-                self.region_name,
-                self.output_folder,
-                self.buffered_polygon,
-                plot,
-            )
-            logging.info(f"Cropped file is found at: {cropped_path}")
+        true_path = find_raster(path)
+        cropped_path = nso_manipulator.run(
+            true_path,
+            self.georegion_to_crop,
+            self.region_name,
+            self.output_folder,
+            self.buffered_polygon,
+            plot,
+            executor=self.executor,
+            area_to_crop=self.get_crop_geometry(),
+            masks=self.crop_mask_cache,
+        )
+        logging.info(f"Cropped file is found at: {cropped_path}")
 
-            print("Cropped file is found at: " + str(cropped_path))
+        print("Cropped file is found at: " + str(cropped_path))
 
-            return cropped_path
+        return cropped_path
 
     def delete_extracted(self, extracted_folder):
         """
@@ -374,6 +535,226 @@ class nso_georegion:
             )
             print("Failed to delete extracted folder: " + str(e))
 
+    def find_cropped_files(self, link: str):
+        """
+        Find the cropped .tif files which already exist in the output folder for a link.
+
+        @param link: Link to a file from the NSO.
+        @return: a list of cropped .tif files for this link and region.
+        """
+        start_archive_name = link.split("/")[len(link.split("/")) - 1]
+
+        # Check if file is already cropped
+        if hasattr(self, "resolution"):
+            # Bands could be on muliple locations and we should sure for multiple glob locations.
+            cropped_path_one = os.path.join(
+                self.output_folder,
+                f"{start_archive_name}*"
+                + self.bands
+                + "*"
+                + self.resolution
+                + "*"
+                + self.region_name
+                + "*cropped*.tif",
+            )
+
+            cropped_path_two = os.path.join(
+                self.output_folder,
+                f"{start_archive_name}*"
+                + self.resolution
+                + "*"
+                + self.bands
+                + "*"
+                + self.region_name
+                + "*cropped*.tif",
+            )
+            print("Searching for: " + str(cropped_path_one))
+            logging.info("Searching for: " + str(cropped_path_one))
+            return [
+                file
+                for file in glob.glob(cropped_path_one) + glob.glob(cropped_path_two)
+            ]
+
+        cropped_path = os.path.join(
+            self.output_folder,
+            f"{start_archive_name}*" + "*" + self.region_name + "*cropped*.tif",
+        )
+        print("Searching for: " + str(cropped_path))
+        logging.info("Searching for: " + str(cropped_path))
+        return [file for file in glob.glob(cropped_path)]
+
+    def get_archive_path(self, link: str):
+        """
+        Get the path where the zip file of a link is downloaded to.
+
+        @param link: Link to a file from the NSO.
+        @return: the path of the zip file in the output folder or in the scene cache.
+        """
+        if self.scene_cache is not None:
+            # Cache entries are keyed by the link, so georegions sharing a cache share the same downloads.
+            return self.scene_cache.path(self.scene_cache.entry_name(link))
+
+        start_archive_name = link.split("/")[len(link.split("/")) - 1]
+        end_archive_name = link.split("/")[len(link.split("/")) - 2]
+        return f"{self.output_folder}/{start_archive_name}_{end_archive_name}.zip"
+
+    def download_links(
+        self,
+        links,
+        scheduler: download_scheduler.download_scheduler = None,
+        priority: int = download_scheduler.NORMAL_PRIORITY,
+    ):
+        """
+        Download the zip files of many links at once, so execute_link only has to extract and crop them.
+
+        Links which are already cropped are skipped. With a scene cache the zip files are pinned from the start of their
+        download, so they are not evicted before execute_link uses them. The pins expire after the pin_timeout of the
+        cache, also when execute_link is never called for a link.
+
+        @param links: a list of links or the dataframe as returned by retrieve_download_links.
+        @param scheduler: optional download_scheduler to share with other georegions, by default a scheduler with its default caps is used.
+        @param priority: the priority of these downloads in the scheduler, a lower number is downloaded first.
+        @return: a dictionary with the zip file per link, failed downloads have the exception instead.
+        """
+        if not isinstance(links, list):
+            links = list(links["link"])
+        links = [link for link in links if len(self.find_cropped_files(link)) == 0]
+
+        own_scheduler = scheduler is None
+        if own_scheduler:
+            scheduler = download_scheduler.download_scheduler(
+                self.username, self.password, client=self.client
+            )
+
+        if self.scene_cache is not None:
+            for link in links:
+                name = os.path.basename(self.get_archive_path(link))
+                if name not in self.prefetch_pins:
+                    self.prefetch_pins[name] = self.scene_cache.pin(name)
+
+        try:
+            futures = {
+                link: scheduler.submit(
+                    link,
+                    self.get_archive_path(link),
+                    priority=priority,
+                    cache=self.scene_cache,
+                )
+                for link in links
+            }
+
+            downloads = {}
+            for link, future in futures.items():
+                try:
+                    downloads[link] = future.result()
+                except Exception as e:
+                    logging.error(f"Failed to download {link}: {e}")
+                    downloads[link] = e
+                    self.release_prefetch_pin(link)
+        finally:
+            if own_scheduler:
+                scheduler.shutdown()
+
+        return downloads
+
+    def release_prefetch_pin(self, link: str):
+        """
+        Release the pin which download_links put on the zip file of a link in the scene cache.
+
+        @param link: Link to a file from the NSO.
+        """
+        name = os.path.basename(self.get_archive_path(link))
+        token = self.prefetch_pins.pop(name, None)
+        if token is not None:
+            self.scene_cache.unpin(name, token)
+
+    def __extract(self, link, download_archive_name, delete_zip_file):
+        """
+        Extract a downloaded archive, unless it has already been extracted.
+
+        Only the raster with the bands and resolution of the link is extracted.
+
+        @param link: Link to a file from the NSO.
+        @param download_archive_name: path to the .zip file.
+        @param delete_zip_file: whether to delete the .zip file after extraction, ignored with a scene cache.
+        @return: the path to the extracted folder.
+        """
+        extracted_folder = download_archive_name.replace(".zip", "")
+        if os.path.exists(extracted_folder):
+            if self.scene_cache is not None:
+                self.scene_cache.get(os.path.basename(extracted_folder))
+            logging.info(
+                "Extracted folder already exists, assuming .zip file has already been extracted!"
+            )
+            print(
+                "Extracted folder already exists, assuming .zip file has already been extracted!"
+            )
+        else:
+            logging.info("Extracting files")
+            print("Extracting files")
+            # With a scene cache the cache decides when archives are deleted.
+            bands = re.search(r"(RGBNED|RGBI|RGB)", link)
+            resolution = re.search(r"(\d{2,3}cm)", link)
+            extracted_folder = nso_api.unzip_delete(
+                download_archive_name,
+                delete_zip_file and self.scene_cache is None,
+                bands=bands[0] if bands else None,
+                resolution=resolution[0] if resolution else None,
+            )
+            if self.scene_cache is not None:
+                self.scene_cache.add(os.path.basename(extracted_folder))
+
+        return extracted_folder
+
+    def get_journal_stages(
+        self,
+        add_ndvi_band: bool = False,
+        add_height_band: str = None,
+        add_red_edge_ndvi_band: bool = False,
+        add_ndwi_band: bool = False,
+        fill_coordinates: [] = [],
+        add_index_bands: list = [],
+        **kwargs,
+    ):
+        """
+        Get the stages which execute_link runs for a link with these options, see link_journal.STAGES.
+
+        @param kwargs: the other options of execute_link, which do not change the stages.
+        @return: a list of stages in the order in which they are run.
+        """
+        stages = ["downloaded", "verified", "extracted", "cropped"]
+        if add_ndvi_band or add_red_edge_ndvi_band or add_ndwi_band or add_index_bands:
+            stages += ["indexed"]
+        if add_height_band:
+            stages += ["height_added"]
+        if fill_coordinates != []:
+            stages += ["filled"]
+        return stages
+
+    def is_link_completed(self, link: str, **execute_options):
+        """
+        Check in the journal if all the stages of a link have been completed.
+
+        @param link: Link to a file from the NSO.
+        @param execute_options: the options of execute_link.
+        @return: True when the last stage is completed and its result exists, None without a journal or when the journal has no stages of the link.
+        """
+        if self.journal is None:
+            return None
+
+        stages = self.get_journal_stages(**execute_options)
+        stage, _ = self.journal.resume_point(link, self.region_name, stages)
+        if stage is None:
+            return None
+        return stage == stages[-1]
+
+    def __record(self, link, stage, path):
+        """
+        Record a completed stage of a link in the journal, when the georegion has one.
+        """
+        if self.journal is not None:
+            self.journal.record(link, self.region_name, stage, path)
+
     def execute_link(
         self,
         link: str,
@@ -387,71 +768,60 @@ class nso_georegion:
         add_ndwi_band: bool = False,
         cloud_detection_warning: bool = False,
         fill_coordinates: [] = [],
+        add_index_bands: list = [],
     ):
         """
         Executes the download, crops and the calculates the NVDI for a specific link.
 
+        With a journal every completed stage is recorded, and a link which was stopped halfway is resumed after its
+        last completed stage.
+
         @param link: Link to a file from the NSO.
-        @param delete_zip_file: This determines whether to retain the original .zip file. By default, the .zip file is kept to prevent unnecessary re-downloading.
-        @param delete_source_files: This decides whether to keep the extracted files. By default, the source files are deleted after extraction.
+        @param delete_zip_file: This determines whether to retain the original .zip file. By default, the .zip file is kept to prevent unnecessary re-downloading. Ignored when the georegion has a scene cache.
+        @param delete_source_files: This decides whether to keep the extracted files. By default, the source files are deleted after extraction. Ignored when the georegion has a scene cache.
         @param plot: Rather or not to plot the resulting image from cropping.
         @param in_image_cloud_percentage: Calculate the cloud percentage in a picture.
         @param add_ndvi_band: Whether or not to add the ndvi as a new band.
-        @param add_height_band: Whether or not to height as new bands, input should be a file location to the height file.
+        @param add_height_band: Whether or not to height as new bands, input should be a file location to the height file, a folder of AHN tiles or a ahn_height_source.
         @param add_red_edge_ndvi_band: Whether or not to add the re_ndvi as a new band.
         @param add_ndwi_band: Whether or not to add the ndwi as a new band.
-        @param cloud_detection_warning: Whether to give warning when clouds have been detected.
+        @param cloud_detection_warning: Whether to give warning when clouds have been detected. Only the crop of this link is classified, to classify the crops of many links in one batch use detect_clouds instead.
         @param fill_coordinates: If the satellite image is missing a region, this parameters control if it has to filled up with satellite data from the nearest image with coordinates of the missing region to look for.
+        @param add_index_bands: Names of other registered index channels to add as new bands, i.e. ["ndre", "evi"], see calculate_index_channels.register_index_channel.
         """
         cropped_path = ""
 
-        try:
-            start_archive_name = link.split("/")[len(link.split("/")) - 1]
-            end_archive_name = link.split("/")[len(link.split("/")) - 2]
-            download_archive_name = (
-                f"{self.output_folder}/{start_archive_name}_{end_archive_name}.zip"
-            )
+        # The stages of this run, with a journal the run resumes after the last completed one.
+        journal_stages = self.get_journal_stages(
+            add_ndvi_band=add_ndvi_band,
+            add_height_band=add_height_band,
+            add_red_edge_ndvi_band=add_red_edge_ndvi_band,
+            add_ndwi_band=add_ndwi_band,
+            fill_coordinates=fill_coordinates,
+            add_index_bands=add_index_bands,
+        )
 
-            # Check if file is already cropped
-            if hasattr(self, "resolution"):
-                # Bands could be on muliple locations and we should sure for multiple glob locations.
-                cropped_path_one = os.path.join(
-                    self.output_folder,
-                    f"{start_archive_name}*"
-                    + self.bands
-                    + "*"
-                    + self.resolution
-                    + "*"
-                    + self.region_name
-                    + "*cropped*.tif",
-                )
+        resumed_stage, resumed_path = (
+            self.journal.resume_point(link, self.region_name, journal_stages)
+            if self.journal is not None
+            else (None, None)
+        )
+        completed = (
+            journal_stages[: journal_stages.index(resumed_stage) + 1]
+            if resumed_stage is not None
+            else []
+        )
+        if resumed_stage is not None:
+            logging.info(f"Resuming {link} after {resumed_stage}: {resumed_path}")
+            print(f"Resuming {link} after {resumed_stage}")
 
-                cropped_path_two = os.path.join(
-                    self.output_folder,
-                    f"{start_archive_name}*"
-                    + self.resolution
-                    + "*"
-                    + self.bands
-                    + "*"
-                    + self.region_name
-                    + "*cropped*.tif",
-                )
-            else:
-                cropped_path = os.path.join(
-                    self.output_folder,
-                    f"{start_archive_name}*" + "*" + self.region_name + "*cropped*.tif",
-                )
+        try:
+            download_archive_name = self.get_archive_path(link)
 
-            print("Searching for: " + str(cropped_path))
-            logging.info("Searching for: " + str(cropped_path))
-            if hasattr(self, "resolution"):
-                found_files = [
-                    file
-                    for file in glob.glob(cropped_path_one)
-                    + glob.glob(cropped_path_two)
-                ]
+            if "cropped" in completed:
+                found_files = [resumed_path]
             else:
-                found_files = [file for file in glob.glob(cropped_path)]
+                found_files = self.find_cropped_files(link)
             skip_cropping = False
 
             if len(found_files) > 0:
@@ -472,57 +842,114 @@ class nso_georegion:
                 # if x == "no":
                 #     return "File already cropped"
             if skip_cropping is False:
-                # Check if download has already been done.
-                if os.path.isfile(download_archive_name):
-                    logging.info("Zip file already found, skipping download")
-                    print("Zip file found skipping download")
-                else:
-                    logging.info("Starting download to: " + download_archive_name)
-                    print("Starting download to: " + download_archive_name)
-                    nso_api.download_link(
-                        link, download_archive_name, self.username, self.password
-                    )
-                    logging.info("Downloaded: " + download_archive_name)
-
-                # See if the .zip file has already been extracted.
-                extracted_folder = download_archive_name.replace(".zip", "")
-                if os.path.exists(extracted_folder):
-                    logging.info(
-                        "Extracted folder already exists, assuming .zip file has already been extracted!"
-                    )
-                    print(
-                        "Extracted folder already exists, assuming .zip file has already been extracted!"
+                # With a scene cache the archive and extracted folder are pinned, so they are not evicted while in use.
+                pin_context = (
+                    self.scene_cache.pinned(
+                        os.path.basename(download_archive_name),
+                        os.path.basename(download_archive_name).replace(".zip", ""),
                     )
-                else:
-                    logging.info("Extracting files")
-                    print("Extracting files")
-                    extracted_folder = nso_api.unzip_delete(
-                        download_archive_name, delete_zip_file
+                    if self.scene_cache is not None
+                    else contextlib.nullcontext()
+                )
+                with pin_context:
+                    # The pin of execute_link takes over from the pin of download_links.
+                    if self.scene_cache is not None:
+                        self.release_prefetch_pin(link)
+
+                    # Check if download has already been done.
+                    if "downloaded" in completed:
+                        logging.info(
+                            "Download already completed according to the journal"
+                        )
+                    elif self.scene_cache is not None:
+                        # download_link waits for other processes downloading the same link.
+                        nso_api.download_link(
+                            link,
+                            download_archive_name,
+                            self.username,
+                            self.password,
+                            cache=self.scene_cache,
+                            client=self.client,
+                        )
+                    elif os.path.isfile(download_archive_name) and nso_api.is_verified(
+                        download_archive_name
+                    ):
+                        logging.info("Zip file already found, skipping download")
+                        print("Zip file found skipping download")
+                    else:
+                        # A zip file which is not complete or corrupt is downloaded again.
+                        for path in [
+                            download_archive_name,
+                            download_archive_name + ".sha256",
+                        ]:
+                            if os.path.isfile(path):
+                                os.remove(path)
+                        logging.info("Starting download to: " + download_archive_name)
+                        print("Starting download to: " + download_archive_name)
+                        nso_api.download_link(
+                            link,
+                            download_archive_name,
+                            self.username,
+                            self.password,
+                            client=self.client,
+                        )
+                        logging.info("Downloaded: " + download_archive_name)
+                    if "downloaded" not in completed:
+                        self.__record(link, "downloaded", download_archive_name)
+
+                    if self.journal is not None and "verified" not in completed:
+                        if not nso_api.is_verified(download_archive_name):
+                            # The next run downloads it again.
+                            for path in [
+                                download_archive_name,
+                                download_archive_name + ".sha256",
+                            ]:
+                                if os.path.isfile(path):
+                                    os.remove(path)
+                            raise Exception(
+                                f"{download_archive_name} is not complete or corrupt"
+                            )
+                        self.__record(link, "verified", download_archive_name)
+
+                    # See if the .zip file has already been extracted.
+                    extracted_folder = download_archive_name.replace(".zip", "")
+                    # With a scene cache only one process extracts an archive, the others wait for it.
+                    extract_lock = (
+                        self.scene_cache.lock(os.path.basename(extracted_folder))
+                        if self.scene_cache is not None
+                        else contextlib.nullcontext()
                     )
-                logging.info("Extracted folder is: " + extracted_folder)
-                print("Extracted folder is: " + extracted_folder)
-
-                logging.info("Cropping")
-                cropped_path = self.crop(extracted_folder, plot)
-                logging.info("Done with cropping")
-
-                # TODO: Function still needed to calculate clouds in a image.
-                if in_image_cloud_percentage:
-                    with rasterio.open(cropped_path, "r") as tif_file:
-                        data = tif_file.read()
-                        cloud_percentage = self.percentage_cloud(data)
-
-                        if cloud_percentage <= 0.10:
-                            logging.info("Image contains less than 10% clouds")
-                            print("Image contains less than 10% clouds")
-
-                        tif_file.close()
-
-                logging.info("Succesfully cropped .tif file")
-                print("Succesfully cropped .tif file")
-
-                if delete_source_files:
-                    self.delete_extracted(extracted_folder)
+                    with extract_lock:
+                        extracted_folder = self.__extract(
+                            link, download_archive_name, delete_zip_file
+                        )
+                    logging.info("Extracted folder is: " + extracted_folder)
+                    if "extracted" not in completed:
+                        self.__record(link, "extracted", extracted_folder)
+                    print("Extracted folder is: " + extracted_folder)
+
+                    logging.info("Cropping")
+                    cropped_path = self.crop(extracted_folder, plot)
+                    logging.info("Done with cropping")
+                    self.__record(link, "cropped", cropped_path)
+
+                    # TODO: Function still needed to calculate clouds in a image.
+                    if in_image_cloud_percentage:
+                        with rasterio.open(cropped_path, "r") as tif_file:
+                            data = tif_file.read()
+                            cloud_percentage = self.percentage_cloud(data)
+
+                            if cloud_percentage <= 0.10:
+                                logging.info("Image contains less than 10% clouds")
+                                print("Image contains less than 10% clouds")
+
+                            tif_file.close()
+
+                    logging.info("Succesfully cropped .tif file")
+                    print("Succesfully cropped .tif file")
+
+                    if delete_source_files and self.scene_cache is None:
+                        self.delete_extracted(extracted_folder)
 
         except Exception as e:
             logging.error("Error in downloading and/or cropping: " + str(e))
@@ -533,21 +960,22 @@ class nso_georegion:
         logging.info(str(cropped_path) + " is Ready")
 
         if cloud_detection_warning:
-            if not CLOUD_DETECTION_AVAILABLE:
+            if self.cloud_detector is None:
+                warnings.warn(
+                    "Cloud detection requested but no cloud detection model is given. Skipping cloud detection."
+                )
+            elif (
+                self.cloud_detector.method == "detect_clouds"
+                and not cloud_detection.CLOUD_DETECTION_AVAILABLE
+            ):
                 warnings.warn(
                     "Cloud detection requested but cloud_recognition module is not available. Skipping cloud detection."
                 )
-            else:
-                clouds = detect_clouds(
-                    model=self.cloud_detection_model,
-                    filepath=cropped_path,
+            elif self.detect_clouds([cropped_path])[cropped_path]:
+                warnings.warn(
+                    f"WARNING: Clouds have been detected in {cropped_path}. Inspect image visually before continuing to segmentation."
                 )
 
-                if clouds:
-                    warnings.warn(
-                        f"WARNING: Clouds have been detected in {cropped_path}. Inspect image visually before continuing to segmentation."
-                    )
-
         # Add extra channels.
         index_channels_to_add = []
         if add_ndvi_band:
@@ -567,19 +995,38 @@ class nso_georegion:
                 print("NDWI is already in it's path")
             else:
                 index_channels_to_add += ["ndwi"]
-        cropped_path = nso_manipulator.add_index_channels(
-            cropped_path, channel_types=index_channels_to_add
-        )
+
+        for channel_type in add_index_bands:
+            if f"_{channel_type}" in cropped_path:
+                print(f"{channel_type} is already in it's path")
+            elif channel_type not in index_channels_to_add:
+                index_channels_to_add += [channel_type]
+        if "indexed" not in completed:
+            # With a journal the input is only deleted after the stage is recorded.
+            indexed_path = nso_manipulator.add_index_channels(
+                cropped_path,
+                channel_types=index_channels_to_add,
+                executor=self.executor,
+                delete_input=self.journal is None,
+            )
+            if "indexed" in journal_stages:
+                self.__record(link, "indexed", indexed_path)
+            if self.journal is not None and indexed_path != cropped_path:
+                os.remove(cropped_path)
+            cropped_path = indexed_path
 
         # Add height from a source AHN .tif file.
-        if add_height_band:
+        if add_height_band and "height_added" not in completed:
             if "height" in cropped_path:
                 print("Height is already in it's path")
             else:
-                cropped_path = nso_manipulator.add_height(cropped_path, add_height_band)
+                cropped_path = nso_manipulator.add_height(
+                    cropped_path, add_height_band, executor=self.executor
+                )
+            self.__record(link, "height_added", cropped_path)
 
         # Fill the image with data from a other satellite image.
-        if fill_coordinates != []:
+        if fill_coordinates != [] and "filled" not in completed:
             print(
                 "-----Filling satellite image with data from the nearest  other satellite in time----"
             )
@@ -593,6 +1040,12 @@ class nso_georegion:
                 output_folder=self.output_folder,
                 username=self.username,
                 password=self.password,
+                scene_cache=self.scene_cache,
+                client=self.client,
+                executor=self.executor,
+                crop_mask_cache=self.crop_mask_cache,
+                cloud_detector=self.cloud_detector,
+                journal=self.journal,
             )
 
             # Ensure that the region is a whole as possible
@@ -614,12 +1067,28 @@ class nso_georegion:
             merge_tifs(
                 [cropped_path, cropped_path_fill],
                 cropped_path_filled,
+                executor=self.executor,
             )
 
             cropped_path = cropped_path_filled
+            self.__record(link, "filled", cropped_path)
 
         return cropped_path
 
+    def detect_clouds(self, cropped_paths: list):
+        """
+        Detect clouds in cropped files in batches, the verdict of a file is cached next to it.
+
+        This is the batch entry point, execute_link with cloud_detection_warning classifies only its own crop.
+
+        @param cropped_paths: paths to cropped .tif files, i.e. returned by execute_link.
+        @return: a dictionary with for every file path True when it has clouds.
+        """
+        if self.cloud_detector is None:
+            raise ValueError("No cloud detection model given for this georegion")
+
+        return self.cloud_detector.detect(cropped_paths)
+
     def check_already_downloaded_links(self):
         """
         Check which links have already been downloaded.
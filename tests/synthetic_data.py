@@ -0,0 +1,44 @@
+# Small synthetic rasters for the offline tests, in rijks driehoek like the cropped satellite images.
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+
+def make_tif(
+    path,
+    data,
+    x0=90000,
+    y0=460000,
+    res=0.5,
+    crs="EPSG:28992",
+    nodata=None,
+    block_size=None,
+):
+    """
+    Write a .tif file with data (bands, rows, columns) and return its path.
+    """
+    data = np.asarray(data)
+    profile = dict(
+        driver="GTiff",
+        height=data.shape[1],
+        width=data.shape[2],
+        count=data.shape[0],
+        dtype=data.dtype,
+        crs=crs,
+        transform=from_origin(x0, y0, res, res),
+        nodata=nodata,
+    )
+    if block_size:
+        profile.update(tiled=True, blockxsize=block_size, blockysize=block_size)
+    with rasterio.open(str(path), "w", **profile) as dst:
+        dst.write(data)
+    return str(path)
+
+
+def random_bands(count=4, height=64, width=64, seed=0, low=1, high=4000):
+    """
+    Random uint16 bands without nodata.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(low, high, (count, height, width)).astype(np.uint16)
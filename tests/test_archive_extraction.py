@@ -0,0 +1,93 @@
+# Offline tests of the selective extraction of NSO archives.
+#
+# The following functionalities are tested:
+# 1. Only the raster of the requested bands and resolution and its sidecar files are extracted.
+# 2. The manifest points to the main raster.
+# 3. Unknown naming schemes, archives without a raster and members outside of the extracted folder.
+# 4. unzip_delete extracts through a temporary folder and deletes the zip file.
+
+
+import os
+import zipfile
+
+import pytest
+
+import satellite_images_nso_extractor._nso_data_extraction.archive_extraction as archive_extraction
+import satellite_images_nso_extractor._nso_data_extraction.nso_api as nso_api
+
+SCENE = "20230513_104139_PNEO-03_1_1"
+
+
+def make_archive(path, members):
+    with zipfile.ZipFile(path, "w") as zip_ref:
+        for name, size in members.items():
+            zip_ref.writestr(name, b"0" * size)
+    return str(path)
+
+
+def make_nso_archive(path):
+    return make_archive(
+        path,
+        {
+            f"{SCENE}/{SCENE}_30cm_RGBNED_12bit_PNEO.tif": 3000,
+            f"{SCENE}/{SCENE}_30cm_RGBNED_12bit_PNEO.tfw": 10,
+            f"{SCENE}/{SCENE}_30cm_RGB_12bit_PNEO.tif": 2000,
+            f"{SCENE}/{SCENE}_30cm_RGBNED_12bit_PNEO_preview.tif": 100,
+            f"{SCENE}/{SCENE}_metadata.xml": 10,
+        },
+    )
+
+
+def test_extract_selected(tmp_path):
+    path = make_nso_archive(tmp_path / "scene.zip")
+    folder = str(tmp_path / "scene")
+    manifest = archive_extraction.extract_selected(
+        path, folder, bands="RGBNED", resolution="30cm"
+    )
+
+    raster = f"{SCENE}/{SCENE}_30cm_RGBNED_12bit_PNEO.tif"
+    assert manifest["raster"] == raster
+    assert sorted(manifest["members"]) == sorted(
+        [raster, raster.replace(".tif", ".tfw")]
+    )
+    assert sorted(os.listdir(os.path.join(folder, SCENE))) == [
+        os.path.basename(raster.replace(".tif", ".tfw")),
+        os.path.basename(raster),
+    ]
+    assert archive_extraction.get_raster_path(folder) == f"{folder}/{raster}"
+
+    # RGB does not match RGBNED.
+    manifest = archive_extraction.extract_selected(
+        path, str(tmp_path / "rgb"), bands="RGB"
+    )
+    assert manifest["raster"] == f"{SCENE}/{SCENE}_30cm_RGB_12bit_PNEO.tif"
+
+
+def test_unknown_names_and_missing_rasters(tmp_path):
+    path = make_archive(tmp_path / "other.zip", {"a.tif": 10, "b.tif": 20})
+    manifest = archive_extraction.extract_selected(
+        path, str(tmp_path / "other"), bands="RGBNED"
+    )
+    assert sorted(manifest["members"]) == ["a.tif", "b.tif"]
+    assert manifest["raster"] == "b.tif"
+    assert archive_extraction.get_raster_path(str(tmp_path)) is None
+
+    path = make_archive(tmp_path / "empty.zip", {"metadata.xml": 10})
+    with pytest.raises(Exception, match="No .tif found"):
+        archive_extraction.extract_selected(path, str(tmp_path / "empty"))
+
+    path = make_archive(tmp_path / "unsafe.zip", {"../outside.tif": 10})
+    with pytest.raises(Exception, match="outside of the extracted folder"):
+        archive_extraction.extract_selected(path, str(tmp_path / "unsafe"))
+    assert not (tmp_path / "outside.tif").exists()
+
+
+def test_unzip_delete(tmp_path):
+    path = make_nso_archive(tmp_path / "scene.zip")
+    open(path + ".sha256", "w").close()
+    folder = nso_api.unzip_delete(path, True, bands="RGBNED", resolution="30cm")
+
+    assert folder == str(tmp_path / "scene")
+    assert archive_extraction.read_manifest(folder)["bands"] == "RGBNED"
+    assert not os.path.exists(path) and not os.path.exists(path + ".sha256")
+    assert not os.path.exists(folder + ".part")
@@ -0,0 +1,262 @@
+# Offline tests of the nso-batch runner, against the local stand-in of the NSO portal.
+#
+# The following functionalities are tested:
+# 1. Reading a job file with its defaults and rejecting incomplete job files.
+# 2. Selecting links with the filters of a region.
+# 3. A watermark does not move past a failed link.
+# 4. Regions which share a output folder and a scene are run at once by several worker processes.
+# 5. The exit code of the console entry point.
+# 6. Watch mode keeps polling after a broken job file or a failed run.
+
+
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+import pandas as pd
+import pytest
+
+import satellite_images_nso_extractor._manipulation.window_executor as window_executor
+import satellite_images_nso_extractor._nso_data_extraction.local_portal as local_portal
+import satellite_images_nso_extractor._nso_data_extraction.nso_client as nso_client
+import satellite_images_nso_extractor.api.batch_runner as batch_runner
+import satellite_images_nso_extractor.api.load_test as load_test
+
+LINK = "https://api.satellietdataportaal.nl/v1/download/{}/{}_104139_PNEO-03_1_1"
+
+
+def write_job(path, job):
+    with open(path, "w") as job_file:
+        json.dump(job, job_file)
+    return str(path)
+
+
+def make_regions(folder, names):
+    """
+    Write a geojson per name with the same region inside the bounds of the local portal.
+    """
+    region = load_test.make_region(str(folder))
+    paths = []
+    for name in names:
+        path = str(folder / f"{name}.geojson")
+        shutil.copy(region, path)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def portal(monkeypatch):
+    with local_portal.local_portal(scenes=2, days_between_scenes=30) as portal:
+        # The worker processes are forked, so they use the client of the local portal too.
+        monkeypatch.setattr(
+            nso_client,
+            "get_client",
+            lambda username, password: nso_client.nso_client(
+                username, password, base_url=portal.url, backoff_factor=0.01
+            ),
+        )
+        monkeypatch.setattr(batch_runner, "_georegions", {})
+        monkeypatch.delenv(window_executor.PROCESSES_ENVIRONMENT_VARIABLE, False)
+        yield portal
+
+
+def test_read_job_file(tmp_path):
+    path = write_job(
+        tmp_path / "job.json",
+        {
+            "output_folder": str(tmp_path),
+            "defaults": {"max_diff": 0.5},
+            "regions": [
+                {"path_to_geojson": "a.geojson"},
+                {"path_to_geojson": "b.geojson", "max_diff": 0.9},
+            ],
+        },
+    )
+    job = batch_runner.read_job_file(path)
+
+    assert job["workers"] == 1
+    a, b = job["regions"]
+    assert a["max_diff"] == 0.5 and b["max_diff"] == 0.9
+    assert a["output_folder"] == str(tmp_path)
+    assert a["execute"] == {"plot": False}
+    assert a["scene_cache_folder"] == b["scene_cache_folder"]
+    assert a["scene_cache_folder"] == os.path.join(
+        str(tmp_path), batch_runner.SCENE_CACHE_FOLDER_NAME
+    )
+
+
+@pytest.mark.parametrize(
+    "job, message",
+    [
+        ({"regions": []}, "No regions"),
+        ({"output_folder": "out", "regions": [{}]}, "path_to_geojson"),
+        ({"regions": [{"path_to_geojson": "a.geojson"}]}, "No output_folder"),
+    ],
+)
+def test_read_incomplete_job_file(tmp_path, job, message):
+    with pytest.raises(ValueError, match=message):
+        batch_runner.read_job_file(write_job(tmp_path / "job.json", job))
+
+
+def test_select_links():
+    links = pd.DataFrame(
+        {
+            "link": [
+                LINK.format("30cm_RGBNED_12bit_PNEO", "20230301"),
+                LINK.format("30cm_RGBNED_12bit_PNEO", "20230101"),
+                LINK.format("50cm_RGBI_8bit_SV", "20230201"),
+                LINK.format("30cm_RGBNED_12bit_PNEO", "20230401"),
+            ],
+            "resolution": ["30cm", "30cm", "50cm", "30cm"],
+            "satellite": ["PNEO", "PNEO", "SV", "PNEO"],
+            "date": ["2023-03-01", "2023-01-01", "2023-02-01", "2023-04-01"],
+        }
+    )
+
+    assert len(batch_runner.select_links(links, {})) == 4
+    assert batch_runner.select_links(links, {"resolution": "30cm", "max_links": 2}) == [
+        links["link"][0],
+        links["link"][3],
+    ]
+    assert batch_runner.select_links(
+        links, {"links_must_contain": ["RGBI"], "satellite": "SV"}
+    ) == [links["link"][2]]
+
+
+def test_advance_watermark(tmp_path):
+    region = {
+        "path_to_geojson": "utrecht.geojson",
+        "watermark_file": str(tmp_path / "nso_watermarks.json"),
+    }
+    done = [
+        LINK.format("30cm_RGBNED_12bit_PNEO", date)
+        for date in ["20230101", "20230201", "20230401"]
+    ]
+    failed = [LINK.format("30cm_RGBNED_12bit_PNEO", "20230301")]
+
+    assert batch_runner.advance_watermark(region, done, failed) == "2023-02-01"
+    assert batch_runner.advance_watermark(region, done[:1], []) is None
+    assert batch_runner.advance_watermark(region, done, []) == "2023-04-01"
+    assert batch_runner.advance_watermark(region, [], failed) is None
+
+
+def test_processes_environment(monkeypatch):
+    variable = window_executor.PROCESSES_ENVIRONMENT_VARIABLE
+    monkeypatch.setenv(variable, "3")
+    with batch_runner.processes_environment(8):
+        assert os.environ[variable] == "8"
+    assert os.environ[variable] == "3"
+
+    monkeypatch.delenv(variable)
+    with batch_runner.processes_environment(8):
+        assert os.environ[variable] == "8"
+    assert variable not in os.environ
+
+
+@pytest.mark.skipif(
+    multiprocessing.get_start_method() != "fork",
+    reason="The worker processes need the client of the local portal",
+)
+def test_run_job(tmp_path, portal):
+    output_folder = tmp_path / "output"
+    output_folder.mkdir()
+    regions = make_regions(tmp_path, ["region_a", "region_b"])
+    job = batch_runner.read_job_file(
+        write_job(
+            tmp_path / "job.json",
+            {
+                "output_folder": str(output_folder),
+                "username": portal.username,
+                "password": portal.password,
+                "workers": 2,
+                "defaults": {"start_date": "2023-01-01", "end_date": "2023-12-31"},
+                "regions": [{"path_to_geojson": path} for path in regions],
+            },
+        )
+    )
+
+    summary = batch_runner.run_job(job, incremental=True)
+
+    # Both regions need both scenes, every scene is downloaded once for the two regions.
+    assert summary["links_found"] == 4 and summary["links_processed"] == 4
+    assert summary["links_failed"] == 0 and summary["watermarks_advanced"] == 2
+    assert portal.stats["downloads"] == 2
+    assert window_executor.PROCESSES_ENVIRONMENT_VARIABLE not in os.environ
+    cropped = [file for file in os.listdir(output_folder) if file.endswith(".tif")]
+    assert len(cropped) == 4
+
+    # A second run skips the links which are already cropped.
+    summary = batch_runner.run_job(job)
+    assert summary["links_skipped"] == 4 and summary["links_processed"] == 0
+    assert portal.stats["downloads"] == 2
+
+
+@pytest.mark.skipif(
+    multiprocessing.get_start_method() != "fork",
+    reason="The worker processes need the client of the local portal",
+)
+def test_main(tmp_path, portal):
+    output_folder = tmp_path / "output"
+    output_folder.mkdir()
+    (region,) = make_regions(tmp_path, ["region_a"])
+    job = {
+        "output_folder": str(output_folder),
+        "username": portal.username,
+        "password": portal.password,
+        "defaults": {"start_date": "2023-01-01", "end_date": "2023-12-31"},
+        "regions": [{"path_to_geojson": region}],
+    }
+
+    assert (
+        batch_runner.main([write_job(tmp_path / "job.json", job), "--workers", "1"])
+        == 0
+    )
+
+    # The search of a region with a missing geojson fails.
+    job["regions"] += [{"path_to_geojson": str(tmp_path / "missing.geojson")}]
+    assert batch_runner.main([write_job(tmp_path / "job.json", job)]) == 1
+
+
+def test_watch_keeps_polling(tmp_path, monkeypatch):
+    path = str(tmp_path / "job.json")
+    runs = []
+
+    def read_job_file(job_file):
+        if len(runs) == 0:
+            runs.append("broken")
+            raise ValueError("No regions found in job file")
+        return {"regions": []}
+
+    def run_job(job, workers=None, incremental=False):
+        runs.append("run")
+        if len(runs) == 2:
+            raise Exception("Portal is down")
+        return summary
+
+    def sleep(seconds):
+        if len(runs) == 3:
+            raise KeyboardInterrupt()
+
+    summary = {
+        key: 0
+        for key in [
+            "regions",
+            "links_found",
+            "links_skipped",
+            "links_processed",
+            "links_failed",
+            "searches_failed",
+            "watermarks_advanced",
+            "bytes_written",
+            "seconds",
+            "links_per_hour",
+        ]
+    }
+    monkeypatch.setattr(batch_runner, "read_job_file", read_job_file)
+    monkeypatch.setattr(batch_runner, "run_job", run_job)
+    monkeypatch.setattr(time, "sleep", sleep)
+
+    assert batch_runner.main([path, "--watch", "--interval", "1"]) == 0
+    assert runs == ["broken", "run", "run"]
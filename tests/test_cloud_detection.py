@@ -0,0 +1,75 @@
+# Tests of the batched cloud detection with a small stand-in of a pixel model, no NSO credentials are needed.
+#
+# The following functionalities are tested:
+# 1. The model of a path is loaded once per process.
+# 2. The pixels of many files are classified in one predict call, also on a overview.
+# 3. The verdict of a file is cached next to it.
+
+
+import pickle
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import satellite_images_nso_extractor._manipulation.cloud_detection as cloud_detection
+
+
+class bright_pixel_model:
+    """
+    Classifies a pixel as cloud when the mean of its bands is above a threshold.
+    """
+
+    def __init__(self, threshold=1000):
+        self.threshold = threshold
+        self.calls = 0
+
+    def predict(self, pixels):
+        self.calls += 1
+        return (pixels.mean(axis=1) > self.threshold).astype(int)
+
+
+def make_tif(path, value):
+    data = np.full((4, 64, 64), 500, dtype=np.uint16)
+    data[:, :16, :16] = value
+    # A corner outside of the crop.
+    data[:, -8:, -8:] = 0
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=64,
+        width=64,
+        count=4,
+        dtype="uint16",
+        crs="EPSG:28992",
+        transform=from_origin(90000, 460000, 0.5, 0.5),
+        nodata=0,
+    ) as dst:
+        dst.write(data)
+    return str(path)
+
+
+def test_cloud_detector(tmp_path):
+    model_path = str(tmp_path / "model.sav")
+    with open(model_path, "wb") as model_file:
+        pickle.dump(bright_pixel_model(), model_file)
+
+    detector = cloud_detection.get_cloud_detector(
+        model_path, method="pixels", overview_factor=2
+    )
+    assert detector is cloud_detection.get_cloud_detector(
+        model_path, method="pixels", overview_factor=2
+    )
+    assert cloud_detection.get_cloud_model(model_path) is detector.model
+
+    cloudy = make_tif(tmp_path / "cloudy.tif", 2000)
+    clear = make_tif(tmp_path / "clear.tif", 600)
+
+    assert detector.detect([cloudy, clear]) == {cloudy: True, clear: False}
+    assert detector.model.calls == 1, "Expected one predict call for the batch"
+
+    # A repeated run uses the cached verdicts.
+    assert detector.detect([clear, cloudy]) == {clear: False, cloudy: True}
+    assert detector.model.calls == 1
+    assert detector.get_cached_verdict(cloudy) is True
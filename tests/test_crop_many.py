@@ -0,0 +1,71 @@
+# Offline tests of cropping one satellite image to many regions in a single pass.
+#
+# The following functionalities are tested:
+# 1. Every crop equals rasterio.mask.mask of its region, also for overlapping regions and several blocks.
+# 2. The crops get the band descriptions and no .part files are left.
+# 3. A region which does not overlap the satellite image.
+
+
+import os
+
+import numpy as np
+import pytest
+import rasterio
+import rasterio.mask
+from shapely.geometry import Point, box
+from synthetic_data import make_tif, random_bands
+
+import satellite_images_nso_extractor._manipulation.mask_cache as mask_cache
+import satellite_images_nso_extractor._manipulation.nso_manipulator as nso_manipulator
+from satellite_images_nso_extractor._manipulation.window_executor import (
+    window_executor,
+)
+
+REGIONS = {
+    "field": box(90003.3, 459960.7, 90030.2, 459990.1),
+    "pond": Point(90025.4, 459975.6).buffer(9.3),
+    "corner": box(89990, 459960, 90002.2, 459970.4),
+}
+
+
+def test_crop_many(tmp_path):
+    raster_path = make_tif(
+        tmp_path / "scene.tif",
+        random_bands(count=6, height=100, width=100),
+        block_size=16,
+    )
+    output_folder = str(tmp_path / "crops")
+    os.makedirs(output_folder)
+
+    cropped_paths = nso_manipulator.crop_many(
+        raster_path,
+        REGIONS,
+        output_folder,
+        crs="EPSG:28992",
+        executor=window_executor(workers=3, block_size=16),
+        masks=mask_cache.mask_cache(),
+    )
+
+    assert sorted(os.listdir(output_folder)) == sorted(
+        f"scene_{name}_cropped.tif" for name in REGIONS
+    )
+    with rasterio.open(raster_path) as src:
+        for name, geometry in REGIONS.items():
+            expected, transform = rasterio.mask.mask(src, [geometry], crop=True)
+            with rasterio.open(cropped_paths[name]) as cropped:
+                np.testing.assert_array_equal(cropped.read(), expected)
+                assert cropped.transform == transform
+                assert cropped.descriptions == ("r", "g", "b", "n", "e", "d")
+
+
+def test_region_outside_of_the_image(tmp_path):
+    raster_path = make_tif(tmp_path / "scene.tif", random_bands(count=4))
+    with pytest.raises(ValueError, match="do not overlap raster"):
+        nso_manipulator.crop_many(
+            raster_path,
+            {"far": box(100000, 400000, 100010, 400010)},
+            str(tmp_path),
+            crs="EPSG:28992",
+            executor=window_executor(workers=1),
+        )
+    assert sorted(os.listdir(tmp_path)) == ["scene.tif"]
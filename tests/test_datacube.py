@@ -0,0 +1,64 @@
+# Offline tests of the time series datacube on small synthetic rasters.
+#
+# The following functionalities are tested:
+# 1. Building, appending and reopening a datacube.
+# 2. A interrupted append is trimmed and overwritten by the next append.
+# 3. A crop which extends past the grid raises a error instead of being clipped.
+
+
+import numpy as np
+import pytest
+from synthetic_data import make_tif
+
+import satellite_images_nso_extractor._manipulation.datacube as datacube
+
+pytest.importorskip("zarr")
+
+
+def make_crop(tmp_path, date, value, x0=90000):
+    data = np.full((2, 20, 20), value, np.uint16)
+    return make_tif(tmp_path / f"{date}_104139_PNEO-03_region_cropped.tif", data, x0=x0)
+
+
+def test_append_and_reopen(tmp_path):
+    path = str(tmp_path / "cube.zarr")
+    cube = datacube.build_datacube(
+        [make_crop(tmp_path, "20230301", 3), make_crop(tmp_path, "20230101", 1)],
+        path,
+    )
+    assert cube.array.shape == (2, 2, 20, 20)
+
+    # Appending to a reopened datacube, a file which is already in it is skipped.
+    cube = datacube.region_datacube(path)
+    assert cube.append(make_crop(tmp_path, "20230201", 2)) == 2
+    assert cube.append(make_crop(tmp_path, "20230101", 1)) == 0
+
+    dates, data = datacube.region_datacube(path).read_timeseries(5, 5)
+    assert [date.month for date in dates] == [1, 2, 3]
+    assert data[:, 0, 0, 0].tolist() == [1, 2, 3]
+
+
+def test_interrupted_append(tmp_path):
+    path = str(tmp_path / "cube.zarr")
+    cube = datacube.build_datacube([make_crop(tmp_path, "20230101", 1)], path)
+
+    # A append which grew the time axis and wrote data, but did not add its date.
+    cube.array.resize((2, 2, 20, 20))
+    cube.array[1] = 9
+
+    cube = datacube.region_datacube(path)
+    assert cube.array.shape[0] == 1
+    cube.append(make_tif(tmp_path / "20230201_x.tif", np.zeros((2, 20, 20), np.uint16)))
+
+    dates, data = cube.read_timeseries(0, 0, height=20, width=20)
+    assert len(dates) == 2
+    assert np.all(data[1] == 0), "Data of the interrupted append is left"
+
+
+def test_crop_past_the_grid(tmp_path):
+    path = str(tmp_path / "cube.zarr")
+    cube = datacube.build_datacube([make_crop(tmp_path, "20230101", 1)], path)
+
+    with pytest.raises(ValueError, match="extends past the grid"):
+        cube.append(make_crop(tmp_path, "20230201", 2, x0=90005))
+    assert cube.array.shape[0] == 1
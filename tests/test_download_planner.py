@@ -0,0 +1,114 @@
+# Offline tests of the dry run download planner, the HEAD requests are replaced by known sizes.
+#
+# The following functionalities are tested:
+# 1. One product variant per scene is kept, in order of the preferred bands.
+# 2. The plan skips cropped and cached links and uses the size of the HEAD request for the others.
+# 3. Links without a known size are estimated with the median size of their product.
+# 4. With a scene cache the zip files and extracted folders are looked up in the cache.
+
+
+import os
+
+import pandas as pd
+
+import satellite_images_nso_extractor._nso_data_extraction.download_planner as download_planner
+import satellite_images_nso_extractor._nso_data_extraction.scene_cache as scene_cache
+
+PRODUCT = "30cm_RGBNED_12bit_PNEO"
+SCENES = [f"2023010{day}_104139_PNEO-03_1_1" for day in range(1, 5)]
+
+
+def make_links():
+    return pd.DataFrame(
+        {
+            "link": [
+                f"https://api.satellietdataportaal.nl/v1/download/{PRODUCT}/{scene}"
+                for scene in SCENES
+            ]
+        }
+    )
+
+
+def test_deduplicate_product_variants():
+    links = pd.DataFrame(
+        {
+            "link": [
+                "https://api.satellietdataportaal.nl/v1/download/SV_RD_11bit_RGB_50cm/20230101_SV1-01",
+                "https://api.satellietdataportaal.nl/v1/download/SV_RD_11bit_RGBI_50cm/20230101_SV1-01",
+                "https://api.satellietdataportaal.nl/v1/download/SV_RD_11bit_RGB_50cm/20230102_SV1-01",
+            ]
+        }
+    )
+    result = download_planner.deduplicate_product_variants(links)
+    assert list(result.index) == [1, 2]
+
+    result = download_planner.deduplicate_product_variants(links, ["RGB", "RGBI"])
+    assert list(result.index) == [0, 2]
+
+
+def test_plan_downloads(tmp_path, monkeypatch):
+    output_folder = str(tmp_path)
+    links = make_links()
+    # The size of the last scene is not reported by the server.
+    sizes = dict(zip(links["link"], [5000, 6000, 7000, None]))
+    requested = []
+
+    def get_download_size(link, *args, **kwargs):
+        requested.append(link)
+        return sizes[link]
+
+    monkeypatch.setattr(download_planner, "get_download_size", get_download_size)
+
+    # The first scene is already cropped, the zip file of the second scene is already downloaded.
+    open(os.path.join(output_folder, f"{SCENES[0]}_utrecht_cropped.tif"), "w").close()
+    with open(os.path.join(output_folder, f"{SCENES[1]}_{PRODUCT}.zip"), "wb") as f:
+        f.write(b"0" * 1000)
+
+    plan, totals = download_planner.plan_downloads(
+        links, output_folder, "utrecht", region_area=10000, user_n="", pass_n=""
+    )
+
+    assert requested == list(links["link"][2:]), "Only links to download are requested"
+    assert list(plan["cropped"]) == [True, False, False, False]
+    assert list(plan["zip_cached"]) == [False, True, False, False]
+    assert list(plan["archive_bytes"]) == [4000, 1000, 7000, 4000]
+    assert list(plan["download_bytes"]) == [0, 0, 7000, 4000]
+    assert plan["crop_pixels"].iloc[0] == round(10000 / 0.3**2)
+
+    assert totals["links"] == 4
+    assert totals["links_to_process"] == 3
+    assert totals["links_already_cropped"] == 1
+    assert totals["download_bytes"] == 11000
+
+
+def test_plan_downloads_with_scene_cache(tmp_path, monkeypatch):
+    output_folder = str(tmp_path / "output")
+    os.makedirs(output_folder)
+    cache = scene_cache.scene_cache(str(tmp_path / "cache"), max_bytes=10**9)
+    links = make_links()
+    monkeypatch.setattr(
+        download_planner, "get_download_size", lambda link, *args, **kwargs: 5000
+    )
+
+    # A zip file with the name of the output folder is not used with a scene cache.
+    with open(os.path.join(output_folder, f"{SCENES[0]}_{PRODUCT}.zip"), "wb") as f:
+        f.write(b"0" * 1000)
+    # The zip file of the second scene and the extracted folder of the third are in the cache.
+    with open(cache.path(cache.entry_name(links["link"][1])), "wb") as f:
+        f.write(b"0" * 2000)
+    os.makedirs(cache.path(cache.entry_name(links["link"][2], suffix="")))
+
+    plan, totals = download_planner.plan_downloads(
+        links,
+        output_folder,
+        "utrecht",
+        region_area=10000,
+        user_n="",
+        pass_n="",
+        cache=cache,
+    )
+
+    assert list(plan["zip_cached"]) == [False, True, False, False]
+    assert list(plan["extracted_cached"]) == [False, False, True, False]
+    assert list(plan["download_bytes"]) == [5000, 0, 0, 5000]
+    assert totals["download_bytes"] == 10000
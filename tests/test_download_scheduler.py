@@ -0,0 +1,136 @@
+# Offline tests of the download scheduler, downloads are replaced by a fake download_link.
+#
+# The following functionalities are tested:
+# 1. The token bucket limits the bytes per second.
+# 2. All queued downloads are done, with at most the maximum number at once.
+# 3. A download with a high priority overtakes queued backfills.
+# 4. Throttled downloads are queued again and the concurrency is lowered.
+
+
+import logging
+import threading
+import time
+
+import pytest
+import requests
+
+import satellite_images_nso_extractor._nso_data_extraction.download_scheduler as download_scheduler
+import satellite_images_nso_extractor._nso_data_extraction.nso_api as nso_api
+
+LINK = "https://portal/download/{}"
+
+
+class fake_download:
+    """
+    Stands in for nso_api.download_link, answers with a 429 when more than max_active downloads run at once.
+    """
+
+    def __init__(self, seconds=0.05, max_active=None):
+        self.seconds = seconds
+        self.max_active = max_active
+        self.active = 0
+        self.peak = 0
+        self.throttled = 0
+        self.done = []
+        self.lock = threading.Lock()
+
+    def __call__(self, link, path, username, password, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            throttled = self.max_active is not None and self.active > self.max_active
+            if throttled:
+                self.throttled += 1
+        try:
+            if throttled:
+                response = requests.Response()
+                response.status_code = 429
+                raise requests.exceptions.HTTPError("429", response=response)
+            time.sleep(self.seconds)
+            with open(path, "w") as file:
+                file.write(link)
+            with self.lock:
+                self.done.append(link)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+@pytest.fixture
+def download(monkeypatch):
+    def install(**kwargs):
+        fake = fake_download(**kwargs)
+        monkeypatch.setattr(nso_api, "download_link", fake)
+        return fake
+
+    return install
+
+
+def make_scheduler(**kwargs):
+    return download_scheduler.download_scheduler("user", "password", **kwargs)
+
+
+def test_token_bucket():
+    bucket = download_scheduler.token_bucket(rate=1000)
+    start = time.monotonic()
+    bucket.consume(1000)
+    assert time.monotonic() - start < 0.1, "The burst is used without waiting"
+    bucket.consume(500)
+    assert 0.4 < time.monotonic() - start < 1
+
+
+def test_downloads(tmp_path, download):
+    fake = download()
+    with make_scheduler(max_concurrent=3, max_per_host=3) as scheduler:
+        futures = [
+            scheduler.submit(LINK.format(i), str(tmp_path / f"{i}.zip"))
+            for i in range(6)
+        ]
+    paths = [future.result() for future in futures]
+
+    assert len(fake.done) == 6 and fake.peak <= 3
+    assert paths == [str(tmp_path / f"{i}.zip") for i in range(6)]
+    assert all((tmp_path / f"{i}.zip").exists() for i in range(6))
+
+
+def test_priority(tmp_path, download):
+    download(seconds=0.1)
+    finished = []
+
+    def submit(scheduler, i, priority):
+        future = scheduler.submit(
+            LINK.format(i), str(tmp_path / f"{i}.zip"), priority=priority
+        )
+        future.add_done_callback(lambda _: finished.append(i))
+        return future
+
+    with make_scheduler(max_concurrent=1) as scheduler:
+        futures = [
+            submit(scheduler, i, download_scheduler.BACKFILL_PRIORITY) for i in range(3)
+        ]
+        while not futures[0].running():
+            time.sleep(0.01)
+        submit(scheduler, 3, download_scheduler.HIGH_PRIORITY)
+
+    # The first backfill is already running when the urgent download is queued.
+    assert finished == [0, 3, 1, 2]
+
+
+def test_throttling(tmp_path, download, caplog):
+    caplog.set_level(logging.INFO)
+    fake = download(max_active=1)
+    with make_scheduler(
+        max_concurrent=3,
+        max_per_host=3,
+        throttle_backoff=0.05,
+        max_requeues=100,
+    ) as scheduler:
+        futures = [
+            scheduler.submit(LINK.format(i), str(tmp_path / f"{i}.zip"))
+            for i in range(6)
+        ]
+        results = [future.result() for future in futures]
+
+    assert len(results) == 6 and len(fake.done) == 6
+    assert fake.throttled > 0
+    assert "Download concurrency lowered" in caplog.text
@@ -0,0 +1,127 @@
+# Offline tests of the verification of downloaded zip files.
+#
+# The following functionalities are tested:
+# 1. verify_zip of a complete, a truncated and a corrupt zip file.
+# 2. is_verified with and without a .sha256 file, also for a file changed on disk with the same size.
+# 3. A .sha256 file is trusted without hashing the zip file again while the zip file is unchanged.
+# 4. execute_link downloads a corrupt zip file in the output folder again.
+
+
+import os
+import zipfile
+
+import pytest
+
+import satellite_images_nso_extractor._nso_data_extraction.local_portal as local_portal
+import satellite_images_nso_extractor._nso_data_extraction.nso_api as nso_api
+import satellite_images_nso_extractor._nso_data_extraction.nso_client as nso_client
+import satellite_images_nso_extractor.api.load_test as load_test
+import satellite_images_nso_extractor.api.nso_georegion as nso
+
+
+def make_zip(path):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as zip_ref:
+        zip_ref.writestr("scene/image.tif", b"satellite data" * 1000)
+    return str(path)
+
+
+def flip_byte(path, offset=200):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+
+def test_verify_zip(tmp_path):
+    path = make_zip(tmp_path / "scene.zip")
+    nso_api.verify_zip(path)
+
+    # Without test_members only the structure is checked, the CRC is checked when extracting.
+    flip_byte(path)
+    nso_api.verify_zip(path, test_members=False)
+    with pytest.raises(Exception, match="CRC error"):
+        nso_api.verify_zip(path)
+
+    path = make_zip(tmp_path / "truncated.zip")
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:100] + data[-200:])
+    with pytest.raises(Exception, match="Corrupt zip file"):
+        nso_api.verify_zip(path, test_members=False)
+
+    (tmp_path / "broken.zip").write_bytes(b"not a zip file")
+    with pytest.raises(Exception, match="Corrupt zip file"):
+        nso_api.verify_zip(str(tmp_path / "broken.zip"))
+
+
+def test_is_verified(tmp_path):
+    path = make_zip(tmp_path / "scene.zip")
+    assert nso_api.is_verified(path), "A complete zip file is verified"
+    assert (tmp_path / "scene.zip.sha256").is_file()
+    assert nso_api.is_verified(path), "The checksum file is trusted"
+
+    # The same size, but a other checksum.
+    flip_byte(path)
+    assert not nso_api.is_verified(path)
+
+
+def test_is_verified_without_checksum_file(tmp_path):
+    path = make_zip(tmp_path / "scene.zip")
+    flip_byte(path)
+    assert not nso_api.is_verified(path)
+    assert not (tmp_path / "scene.zip.sha256").exists()
+
+
+def test_checksum_file_is_trusted(tmp_path, monkeypatch):
+    path = make_zip(tmp_path / "scene.zip")
+    assert nso_api.is_verified(path)
+
+    hashed = []
+    get_checksum = nso_api.get_checksum
+    monkeypatch.setattr(
+        nso_api, "get_checksum", lambda path: hashed.append(path) or get_checksum(path)
+    )
+    assert nso_api.is_verified(path) and nso_api.is_verified(path)
+    assert hashed == [], "An unchanged zip file is not hashed again"
+
+    # A other modification time with the same content is hashed once and the .sha256 file is updated.
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert nso_api.is_verified(path) and nso_api.is_verified(path)
+    assert len(hashed) == 1
+
+    # A .sha256 file without modification time is checked once.
+    checksum = get_checksum(path)
+    with open(path + ".sha256", "w") as f:
+        f.write(f"{os.path.getsize(path)} {checksum}")
+    assert nso_api.is_verified(path) and nso_api.is_verified(path)
+    assert len(hashed) == 2
+
+    with open(path + ".sha256", "w") as f:
+        f.write(f"{os.path.getsize(path) + 1} {checksum} {os.stat(path).st_mtime_ns}")
+    assert not nso_api.is_verified(path), "A other size is never trusted"
+
+
+def test_execute_link_downloads_corrupt_zip_again(tmp_path):
+    with local_portal.local_portal(scenes=1) as portal:
+        georegion = nso.nso_georegion(
+            output_folder=str(tmp_path),
+            username=portal.username,
+            password=portal.password,
+            path_to_geojson=load_test.make_region(str(tmp_path)),
+            client=nso_client.nso_client(
+                portal.username, portal.password, base_url=portal.url
+            ),
+        )
+        link = portal.get_link(*next(iter(portal.scenes)))
+        path = georegion.get_archive_path(link)
+        with open(path, "wb") as f:
+            f.write(b"not a zip file")
+
+        cropped_path = georegion.execute_link(link, plot=False)
+
+    assert portal.stats["downloads"] == 1
+    assert os.path.isfile(cropped_path)
+    assert nso_api.is_verified(path)
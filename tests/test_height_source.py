@@ -0,0 +1,63 @@
+# Offline tests of the height source over a folder of synthetic AHN tiles.
+#
+# The following functionalities are tested:
+# 1. The height of a grid over two tiles, the tile index and the tiles of bounds.
+# 2. The height grids in memory are bounded by bytes.
+# 3. Height grids in the cache folder are memory mapped.
+
+
+import os
+
+import numpy as np
+from rasterio.transform import from_origin
+from synthetic_data import make_tif
+
+import satellite_images_nso_extractor._manipulation.height_source as height_source
+
+
+def make_tiles(tmp_path):
+    # Two tiles of 50 by 50 m with a height of 1 and 2 m, next to each other.
+    folder = tmp_path / "ahn"
+    folder.mkdir()
+    for i, value in enumerate([1, 2]):
+        make_tif(
+            folder / f"tile_{i}.tif",
+            np.full((1, 100, 100), value, np.float32),
+            x0=90000 + 50 * i,
+            y0=460000,
+        )
+    return str(folder)
+
+
+def test_get_height(tmp_path):
+    source = height_source.ahn_height_source(make_tiles(tmp_path))
+    assert os.path.isfile(os.path.join(source.tile_folder, "ahn_tile_index.json"))
+    assert len(source.get_tiles((90010, 459990, 90020, 460000))) == 1
+
+    # A 1 m grid from x 90040 to 90060, which covers both tiles.
+    grid = source.get_height(
+        "EPSG:28992", from_origin(90040, 460000, 1, 1), width=20, height=10
+    )
+    assert np.all(grid[:, :10] == 1) and np.all(grid[:, 10:] == 2)
+    assert not grid.flags.writeable
+
+
+def test_cache_is_bounded_by_bytes(tmp_path):
+    # Room for two grids of 10 by 10 float32 pixels.
+    source = height_source.ahn_height_source(make_tiles(tmp_path), max_bytes=800)
+    for i in range(4):
+        source.get_height(
+            "EPSG:28992", from_origin(90000 + i, 460000, 1, 1), width=10, height=10
+        )
+    assert len(source.grids) == 2 and source.nbytes == 800
+
+
+def test_cache_folder(tmp_path):
+    source = height_source.ahn_height_source(
+        make_tiles(tmp_path), cache_folder=str(tmp_path / "cache")
+    )
+    grid = source.get_height(
+        "EPSG:28992", from_origin(90000, 460000, 1, 1), width=10, height=10
+    )
+    assert isinstance(grid, np.memmap) and source.nbytes == 0
+    assert len(os.listdir(tmp_path / "cache")) == 1
@@ -0,0 +1,85 @@
+# Offline tests of the registry of index channels on small synthetic rasters.
+#
+# The following functionalities are tested:
+# 1. ndvi, re_ndvi and ndwi give the same uint16 bands as the calculations before the registry.
+# 2. Registering a index channel and rejecting unsafe expressions.
+# 3. Index values outside of the range of the band dtype are clipped instead of wrapping around.
+
+
+import numpy as np
+import pytest
+import rasterio
+from synthetic_data import make_tif, random_bands
+
+import satellite_images_nso_extractor._index_channels.calculate_index_channels as calculate_index_channels
+import satellite_images_nso_extractor._manipulation.nso_manipulator as nso_manipulator
+import satellite_images_nso_extractor._manipulation.window_executor as window_executor
+
+
+def test_same_as_before_the_registry(tmp_path):
+    data = random_bands(count=6, height=300, width=300, low=0)
+    input_file = make_tif(tmp_path / "crop.tif", data, block_size=64)
+
+    output_file = nso_manipulator.add_index_channels(
+        input_file,
+        ["ndvi", "re_ndvi", "ndwi"],
+        executor=window_executor.window_executor(workers=2, block_size=64),
+    )
+
+    with rasterio.open(output_file) as src:
+        result = src.read()
+
+    red, green, near_infra_red, red_edge = (
+        data[0].astype(int),
+        data[1].astype(int),
+        data[3].astype(int),
+        data[4].astype(int),
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = [
+            (near_infra_red - red) / (near_infra_red + red) * 100 + 100,
+            (red_edge - red) / (red_edge + red) * 100 + 100,
+            (green - near_infra_red) / (near_infra_red + green) * 100 + 100,
+        ]
+    for band, index in zip(result[6:], expected):
+        assert np.array_equal(band, np.nan_to_num(index, 0).astype(np.uint16))
+
+
+def test_register_index_channel():
+    channel = calculate_index_channels.register_index_channel(
+        "test_ratio", "n / (r + 1)"
+    )
+    data = np.stack(
+        [np.full((2, 2), 3), np.ones((2, 2)), np.ones((2, 2)), np.full((2, 2), 8)]
+    )
+    assert np.allclose(channel(data), 2)
+    assert calculate_index_channels.get_index_channel("test_ratio") is channel
+
+    with pytest.raises(ValueError):
+        calculate_index_channels.index_channel("bad", "__import__('os')")
+    with pytest.raises(ValueError):
+        calculate_index_channels.index_channel("bad", "n.real")
+
+
+def test_clip_to_band_dtype(tmp_path):
+    calculate_index_channels.register_index_channel("test_large", "n * 100")
+    # evi is negative for these reflectances: 2.5 * 1000 / -37.5 * 100 + 100 = -6566.7.
+    pixel = np.array([4000, 4500, 5205, 5000, 4800, 100], dtype=np.uint16)
+    data = np.broadcast_to(pixel[:, None, None], (6, 16, 16)).copy()
+    input_file = make_tif(tmp_path / "crop.tif", data)
+
+    output_file = nso_manipulator.add_index_channels(
+        input_file,
+        ["evi", "test_large", "ndvi"],
+        executor=window_executor.window_executor(workers=1, block_size=16),
+    )
+
+    with rasterio.open(output_file) as src:
+        result = src.read()
+    assert np.all(result[6] == 0), "A negative evi is clipped to 0, not 58970"
+    assert np.all(result[7] == np.iinfo(np.uint16).max)
+    assert np.all(result[8] == int(1000 / 9000 * 100 + 100))
+
+    clipped = nso_manipulator.clip_to_dtype(np.array([-1.5, 2.5, 70000]), np.int16)
+    assert clipped.tolist() == [-1, 2, 32767]
+    assert nso_manipulator.clip_to_dtype(np.array([-1.5]), np.float32)[0] == -1.5
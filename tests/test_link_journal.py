@@ -0,0 +1,76 @@
+# Tests of the journal of completed stages per link, against the local stand-in of the NSO portal.
+#
+# The following functionalities are tested:
+# 1. Recording a stage removes the stages after it.
+# 2. A link which crashed while adding the index channels resumes after cropping, without downloading again.
+
+
+import os
+
+import pytest
+
+import satellite_images_nso_extractor._manipulation.nso_manipulator as nso_manipulator
+import satellite_images_nso_extractor._nso_data_extraction.link_journal as link_journal
+import satellite_images_nso_extractor._nso_data_extraction.local_portal as local_portal
+import satellite_images_nso_extractor._nso_data_extraction.nso_client as nso_client
+import satellite_images_nso_extractor.api.load_test as load_test
+import satellite_images_nso_extractor.api.nso_georegion as nso
+
+
+def test_record_and_resume_point(tmp_path):
+    journal = link_journal.link_journal(str(tmp_path))
+    link = "https://api.satellietdataportaal.nl/v1/download/product/20230101_scene"
+    cropped = tmp_path / "cropped.tif"
+    cropped.write_bytes(b"")
+
+    journal.record(link, "region", "downloaded", str(tmp_path / "missing.zip"))
+    journal.record(link, "region", "cropped", str(cropped))
+    journal.record(link, "region", "indexed", str(tmp_path / "missing_ndvi.tif"))
+    assert journal.resume_point(link, "region") == ("cropped", str(cropped))
+
+    # Doing a earlier stage again removes the stages after it.
+    journal.record(link, "region", "downloaded", str(cropped))
+    assert list(journal.read(link, "region")["stages"]) == ["downloaded"]
+    assert journal.resume_point(link, "other_region") == (None, None)
+
+    with pytest.raises(ValueError):
+        journal.record(link, "region", "unknown", str(cropped))
+
+
+def test_resume_after_crash(tmp_path, monkeypatch):
+    with local_portal.local_portal(scenes=1) as portal:
+        client = nso_client.nso_client(
+            portal.username, portal.password, base_url=portal.url
+        )
+        georegion = nso.nso_georegion(
+            output_folder=str(tmp_path),
+            username=portal.username,
+            password=portal.password,
+            path_to_geojson=load_test.make_region(str(tmp_path)),
+            client=client,
+            journal=link_journal.link_journal(str(tmp_path)),
+        )
+        link = portal.get_link(*next(iter(portal.scenes)))
+
+        add_index_channels = nso_manipulator.add_index_channels
+
+        def crash(*args, **kwargs):
+            raise RuntimeError("Crash while adding index channels")
+
+        monkeypatch.setattr(nso_manipulator, "add_index_channels", crash)
+        with pytest.raises(RuntimeError):
+            georegion.execute_link(link, plot=False, add_ndvi_band=True)
+
+        stage, cropped_path = georegion.journal.resume_point(
+            link, georegion.region_name
+        )
+        assert stage == "cropped"
+        assert georegion.is_link_completed(link, add_ndvi_band=True) is False
+
+        monkeypatch.setattr(nso_manipulator, "add_index_channels", add_index_channels)
+        filepath = georegion.execute_link(link, plot=False, add_ndvi_band=True)
+
+    assert portal.stats["downloads"] == 1, "The link is downloaded again"
+    assert filepath == cropped_path.replace(".tif", "_ndvi.tif")
+    assert os.path.isfile(filepath) and not os.path.isfile(cropped_path)
+    assert georegion.is_link_completed(link, add_ndvi_band=True) is True
@@ -0,0 +1,97 @@
+# Offline tests of the pipeline against the local stand-in of the NSO portal, no NSO credentials are needed.
+#
+# The following functionalities are tested:
+# 1. Searching for links with the /v1/search contract.
+# 2. Downloading through throttling (429) and server errors.
+# 3. execute_link: download, extract, crop and adding the ndvi band.
+# 4. Zip files downloaded by download_links stay in a full scene cache until execute_link has used them.
+
+
+import os
+
+import rasterio
+
+import satellite_images_nso_extractor._nso_data_extraction.local_portal as local_portal
+import satellite_images_nso_extractor._nso_data_extraction.nso_api as nso_api
+import satellite_images_nso_extractor._nso_data_extraction.nso_client as nso_client
+import satellite_images_nso_extractor._nso_data_extraction.scene_cache as scene_cache
+import satellite_images_nso_extractor.api.load_test as load_test
+import satellite_images_nso_extractor.api.nso_georegion as nso
+
+
+def make_georegion(portal, output_folder, cache=None):
+    client = nso_client.nso_client(
+        portal.username, portal.password, base_url=portal.url, backoff_factor=0.01
+    )
+    return nso.nso_georegion(
+        output_folder=str(output_folder),
+        username=portal.username,
+        password=portal.password,
+        path_to_geojson=load_test.make_region(str(output_folder)),
+        client=client,
+        scene_cache=cache,
+    )
+
+
+def test_retrieve_download_links(tmp_path):
+    with local_portal.local_portal(scenes=5, days_between_scenes=30) as portal:
+        georegion = make_georegion(portal, tmp_path)
+        links = georegion.retrieve_download_links(
+            start_date="2023-01-01", end_date="2023-03-31", max_diff=0.5
+        )
+
+    assert len(links) == 3, "Expected the scenes of January to March"
+    assert set(links["resolution"]) == {"30cm"}
+    assert set(links["bands"]) == {"RGBNED"}
+
+
+def test_download_with_throttling(tmp_path):
+    with local_portal.local_portal(
+        scenes=1, throttle_rate=0.5, error_rate=0.2, retry_after=0, seed=2
+    ) as portal:
+        client = nso_client.nso_client(
+            portal.username,
+            portal.password,
+            base_url=portal.url,
+            retries=10,
+            backoff_factor=0.01,
+        )
+        link = portal.get_link(*next(iter(portal.scenes)))
+        path = str(tmp_path / "scene.zip")
+        nso_api.download_link(link, path, "", "", client=client)
+
+    assert nso_api.is_verified(path), "Download is not complete"
+    assert portal.stats["throttled"] > 0 and portal.stats["errors"] > 0
+
+
+def test_execute_link(tmp_path):
+    with local_portal.local_portal(scenes=1) as portal:
+        georegion = make_georegion(portal, tmp_path)
+        link = portal.get_link(*next(iter(portal.scenes)))
+        filepath = georegion.execute_link(link, plot=False, add_ndvi_band=True)
+
+    assert os.path.isfile(filepath), "No cropped file found"
+    with rasterio.open(filepath) as src:
+        assert src.count == 7, "Expected 6 bands and the ndvi"
+        assert src.descriptions[-1] == "ndvi"
+
+
+def test_download_links_pins_scene_cache(tmp_path):
+    # Every entry is over the budget of the cache, only pins keep them.
+    cache = scene_cache.scene_cache(str(tmp_path / "cache"), max_bytes=1)
+    with local_portal.local_portal(scenes=2, days_between_scenes=30) as portal:
+        georegion = make_georegion(portal, tmp_path, cache=cache)
+        links = [portal.get_link(product, scene) for product, scene in portal.scenes]
+
+        downloads = georegion.download_links(links)
+        assert all(os.path.isfile(downloads[link]) for link in links)
+        assert len(georegion.prefetch_pins) == 2
+
+        georegion.execute_link(links[0], plot=False)
+        assert os.path.isfile(downloads[links[1]]), "Still pinned by download_links"
+        georegion.execute_link(links[1], plot=False)
+
+    assert georegion.prefetch_pins == {}
+    assert portal.stats["downloads"] == 2
+    # The entries of the first link are no longer pinned and were evicted when the second was extracted.
+    assert not os.path.exists(downloads[links[0]])
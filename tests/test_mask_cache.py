@@ -0,0 +1,84 @@
+# Offline tests of the cache of crop windows and masks per grid.
+#
+# The following functionalities are tested:
+# 1. The unpacked mask of a window equals the rasterized geometry.
+# 2. Masks are shared by images on the same grid and not by images on another grid.
+# 3. The masks in memory are bounded by bytes, masks on disk are used by a new cache.
+
+
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+from shapely.geometry import Point, box
+from synthetic_data import make_tif, random_bands
+
+import satellite_images_nso_extractor._manipulation.mask_cache as mask_cache
+
+REGION = Point(90020.3, 459980.2).buffer(12.1)
+
+
+def make_scenes(tmp_path):
+    # Two dates on the same grid and one on a shifted grid.
+    return [
+        make_tif(tmp_path / "first.tif", random_bands(seed=0)),
+        make_tif(tmp_path / "second.tif", random_bands(seed=1)),
+        make_tif(tmp_path / "shifted.tif", random_bands(seed=2), x0=90000.25),
+    ]
+
+
+def test_mask(tmp_path):
+    masks = mask_cache.mask_cache()
+    with rasterio.open(make_scenes(tmp_path)[0]) as src:
+        mask = masks.get(src, [REGION])
+        expected = geometry_mask(
+            [REGION],
+            out_shape=(int(mask.window.height), int(mask.window.width)),
+            transform=src.window_transform(mask.window),
+        )
+
+    np.testing.assert_array_equal(
+        mask.outside(Window(0, 0, mask.window.width, mask.window.height)), expected
+    )
+    np.testing.assert_array_equal(
+        mask.outside(Window(5, 3, 10, 20)), expected[3:23, 5:15]
+    )
+    assert mask.nbytes < expected.size / 4, "Expected a bit packed mask"
+
+
+def test_shared_by_grid(tmp_path):
+    masks = mask_cache.mask_cache()
+    first, second, shifted = make_scenes(tmp_path)
+    with rasterio.open(first) as a, rasterio.open(second) as b, rasterio.open(
+        shifted
+    ) as c:
+        assert masks.get(a, [REGION]) is masks.get(b, [REGION])
+        assert masks.get(a, [REGION]) is not masks.get(c, [REGION])
+        assert masks.get(a, [REGION]) is not masks.get(a, [REGION.buffer(1)])
+
+        with pytest.raises(ValueError, match="do not overlap raster"):
+            masks.get(a, [box(0, 0, 10, 10)])
+
+
+def test_byte_budget_and_cache_folder(tmp_path):
+    cache_folder = str(tmp_path / "masks")
+    first = make_scenes(tmp_path)[0]
+    shapes = [[REGION.buffer(-i)] for i in range(4)]
+
+    with rasterio.open(first) as src:
+        masks = mask_cache.mask_cache(cache_folder, max_bytes=1)
+        for shape in shapes:
+            masks.get(src, shape)
+        assert len(masks.masks) == 1
+        assert len(os.listdir(cache_folder)) == 4
+
+        # A new cache, for example of another run, reads the masks from disk.
+        other = mask_cache.mask_cache(cache_folder)
+        for shape in shapes:
+            cached = other.get(src, shape)
+            computed = mask_cache.mask_cache().get(src, shape)
+            assert cached.window == computed.window
+            np.testing.assert_array_equal(cached.packed, computed.packed)
@@ -0,0 +1,53 @@
+# Offline tests of the block wise mosaic builder on small synthetic rasters.
+#
+# The following functionalities are tested:
+# 1. The overlap rules first, last and min_cloud.
+# 2. merge_tif_files keeps the CRS of the inputs.
+
+
+import numpy as np
+import pytest
+import rasterio
+from synthetic_data import make_tif
+
+import satellite_images_nso_extractor._manipulation.mosaic as mosaic
+from miscellaneous.miscellaneous import merge_tif_files
+
+
+def make_inputs(tmp_path):
+    # Two 40 by 40 pixel images of 0.5 m which overlap 20 pixels in x.
+    first = make_tif(tmp_path / "first.tif", np.full((2, 40, 40), 1, np.uint16))
+    second = make_tif(
+        tmp_path / "second.tif", np.full((2, 40, 40), 2, np.uint16), x0=90010
+    )
+    return [first, second]
+
+
+@pytest.mark.parametrize(
+    "rule, cloud_cover, expected",
+    [("first", None, 1), ("last", None, 2), ("min_cloud", [50, 10], 2)],
+)
+def test_overlap_rules(tmp_path, rule, cloud_cover, expected):
+    output = mosaic.build_mosaic(
+        make_inputs(tmp_path),
+        str(tmp_path / "mosaic.tif"),
+        rule=rule,
+        cloud_cover=cloud_cover,
+        block_size=16,
+    )
+
+    with rasterio.open(output) as src:
+        data = src.read()
+        assert src.crs.to_epsg() == 28992
+        assert data.shape == (2, 40, 60)
+    assert np.all(data[:, :, :20] == 1)
+    assert np.all(data[:, :, 20:40] == expected)
+    assert np.all(data[:, :, 40:] == 2)
+
+
+def test_merge_tif_files_keeps_crs(tmp_path):
+    output = merge_tif_files(make_inputs(tmp_path), str(tmp_path / "merged.tif"))
+
+    with rasterio.open(output) as src:
+        assert src.crs.to_epsg() == 28992
+        assert np.all(src.read()[:, :, 20:40] == 1)
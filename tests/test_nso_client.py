@@ -0,0 +1,114 @@
+# Offline tests of the pooled NSO client, also against the local stand-in of the NSO portal.
+#
+# The following functionalities are tested:
+# 1. Urls of paths of the api and full urls.
+# 2. The retry and backoff configuration of the connection pool.
+# 3. Every request gets the timeouts of the client.
+# 4. One shared client per account.
+# 5. Requests are retried through throttling (429) and server errors (500).
+# 6. A failing server, a stalled server and a wrong password.
+
+
+import json
+
+import pytest
+import requests
+
+import satellite_images_nso_extractor._nso_data_extraction.local_portal as local_portal
+import satellite_images_nso_extractor._nso_data_extraction.nso_client as nso_client
+
+SEARCH = json.dumps(
+    {"type": "Feature", "geometry": {"type": "Point", "coordinates": [4.415, 52.225]}}
+)
+
+
+def make_client(portal, **kwargs):
+    return nso_client.nso_client(
+        portal.username, portal.password, base_url=portal.url + "/", **kwargs
+    )
+
+
+def test_url():
+    client = nso_client.nso_client("user", "password", base_url="http://portal/v1/")
+    assert client.url("search") == "http://portal/v1/search"
+    assert client.url("/search") == "http://portal/v1/search"
+    assert client.url("https://other/download/x") == "https://other/download/x"
+
+
+def test_retry_config():
+    client = nso_client.nso_client(
+        "user", "password", retries=3, backoff_factor=0.5, pool_maxsize=2
+    )
+    adapter = client.session.get_adapter("https://portal/")
+    retry = adapter.max_retries
+
+    assert retry.total == 3 and retry.connect == 3 and retry.status == 3
+    assert retry.backoff_factor == 0.5
+    assert 429 in retry.status_forcelist and 500 in retry.status_forcelist
+    assert "POST" in retry.allowed_methods
+    assert retry.respect_retry_after_header
+    assert client.session.get_adapter("http://portal/") is adapter
+
+
+def test_timeouts(monkeypatch):
+    client = nso_client.nso_client(
+        "user", "password", connect_timeout=2, read_timeout=7
+    )
+    calls = []
+    monkeypatch.setattr(
+        client.session,
+        "request",
+        lambda method, url, **kwargs: calls.append((method, url, kwargs)),
+    )
+
+    client.post("search", data="{}")
+    client.get("https://other/download/x", timeout=1)
+
+    assert calls[0][0] == "POST" and calls[0][2]["timeout"] == (2, 7)
+    assert calls[1][1] == "https://other/download/x" and calls[1][2]["timeout"] == 1
+
+
+def test_get_client():
+    client = nso_client.get_client("user", "password")
+    assert nso_client.get_client("user", "password") is client
+    assert nso_client.get_client("user", "other") is not client
+    assert client.base_url == nso_client.DEFAULT_BASE_URL
+
+
+def test_retries():
+    with local_portal.local_portal(
+        scenes=2, throttle_rate=0.3, error_rate=0.3, retry_after=0, seed=1
+    ) as portal:
+        client = make_client(portal, retries=20, backoff_factor=0.001)
+        for _ in range(10):
+            response = client.post("search", data=SEARCH)
+            assert response.status_code == 200
+            assert len(response.json()["features"]) == 2
+        client.close()
+
+    assert portal.stats["throttled"] > 0 and portal.stats["errors"] > 0
+    assert portal.stats["searches"] == 10
+
+
+def test_failing_server():
+    with local_portal.local_portal(scenes=1, error_rate=1) as portal:
+        client = make_client(portal, retries=2, backoff_factor=0.001)
+        response = client.post("search", data=SEARCH)
+
+    assert response.status_code == 500
+    assert portal.stats["errors"] == 3, "Expected the request and 2 retries"
+
+
+def test_read_timeout():
+    with local_portal.local_portal(scenes=1, latency=1) as portal:
+        client = make_client(portal, retries=0, read_timeout=0.1)
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.post("search", data=SEARCH)
+
+
+def test_unauthorized():
+    with local_portal.local_portal(scenes=1) as portal:
+        client = nso_client.nso_client(
+            portal.username, "wrong", base_url=portal.url, retries=0
+        )
+        assert client.post("search", data=SEARCH).status_code == 401
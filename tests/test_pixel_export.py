@@ -0,0 +1,83 @@
+# Offline tests of the export of the pixels of a cropped .tif file to parquet.
+#
+# The following functionalities are tested:
+# 1. Every pixel inside of the crop is exported once, with its band values and index channels.
+# 2. Pixels which are 0 in every band are dropped and x and y coordinates are the pixel centers.
+# 3. Exporting again to the same folder replaces the parquet files of the earlier export.
+
+
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from synthetic_data import make_tif, random_bands
+
+import satellite_images_nso_extractor._manipulation.pixel_export as pixel_export
+from satellite_images_nso_extractor._index_channels.calculate_index_channels import (
+    generate_index_channel_from_array,
+)
+
+pytestmark = pytest.mark.skipif(
+    not pixel_export.PYARROW_AVAILABLE, reason="pyarrow is not installed"
+)
+
+
+def make_raster(tmp_path):
+    data = random_bands(count=6, height=50, width=30, seed=3)
+    data[:, :5, :] = 0
+    return make_tif(tmp_path / "cropped.tif", data), data
+
+
+def test_export_rowcol(tmp_path):
+    raster_path, data = make_raster(tmp_path)
+    output_folder = str(tmp_path / "pixels")
+    written = pixel_export.export_pixels_to_parquet(
+        raster_path, output_folder, index_channels=["ndvi"], rows_per_partition=8
+    )
+
+    assert written == 45 * 30
+    assert len(glob.glob(os.path.join(output_folder, "part-*.parquet"))) == 7
+    pixels = pd.read_parquet(output_folder).sort_values(["row", "col"])
+    assert len(pixels) == written
+    assert pixels["row"].min() == 5
+
+    for band in range(6):
+        np.testing.assert_array_equal(
+            pixels[f"band_{band + 1}"].values, data[band, 5:].ravel()
+        )
+    assert pixels["ndvi"].dtype == np.float32
+    np.testing.assert_array_equal(
+        pixels["ndvi"].values,
+        generate_index_channel_from_array("ndvi", data)[5:].ravel().astype(np.float32),
+    )
+
+
+def test_export_xy(tmp_path):
+    raster_path, _ = make_raster(tmp_path)
+    output_folder = str(tmp_path / "pixels")
+    pixel_export.export_pixels_to_parquet(raster_path, output_folder, coordinates="xy")
+
+    pixels = pd.read_parquet(output_folder)
+    assert pixels["x"].min() == 90000.25 and pixels["y"].max() == 460000 - 5.5 * 0.5
+    assert os.path.isfile(os.path.join(output_folder, "_metadata.json"))
+
+    with pytest.raises(ValueError):
+        pixel_export.export_pixels_to_parquet(
+            raster_path, output_folder, coordinates="latlon"
+        )
+
+
+def test_export_again(tmp_path):
+    raster_path, _ = make_raster(tmp_path)
+    output_folder = str(tmp_path / "pixels")
+    pixel_export.export_pixels_to_parquet(
+        raster_path, output_folder, rows_per_partition=8
+    )
+    written = pixel_export.export_pixels_to_parquet(
+        raster_path, output_folder, rows_per_partition=32
+    )
+
+    assert len(glob.glob(os.path.join(output_folder, "part-*.parquet"))) == 2
+    assert len(pd.read_parquet(output_folder)) == written
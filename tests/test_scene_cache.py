@@ -0,0 +1,76 @@
+# Offline tests of the size bounded scene cache.
+#
+# The following functionalities are tested:
+# 1. The least recently used entries are evicted when the cache is over its budget.
+# 2. Pinned entries are not evicted, until the pin expires.
+# 3. The sizes of extracted folders and entries deleted outside of the cache.
+
+
+import os
+import time
+
+import satellite_images_nso_extractor._nso_data_extraction.scene_cache as scene_cache
+
+
+def add_file(cache, name, size=100):
+    with open(cache.path(name), "wb") as f:
+        f.write(b"0" * size)
+    # The last access time has to differ between entries.
+    time.sleep(0.01)
+    return cache.add(name)
+
+
+def test_least_recently_used(tmp_path):
+    cache = scene_cache.scene_cache(str(tmp_path), max_bytes=250)
+    add_file(cache, "a.zip")
+    add_file(cache, "b.zip")
+    time.sleep(0.01)
+    assert cache.get("a.zip")
+
+    # Adding a third entry evicts b.zip, which is used least recently.
+    add_file(cache, "c.zip")
+    assert cache.get("b.zip") is None
+    assert cache.get("a.zip") and cache.get("c.zip")
+    assert cache.total_bytes() == 200
+
+
+def test_pinned_entries(tmp_path):
+    cache = scene_cache.scene_cache(str(tmp_path), max_bytes=150)
+    add_file(cache, "a.zip")
+    with open(cache.path("a.zip.sha256"), "w") as f:
+        f.write("100 checksum")
+
+    with cache.pinned("a.zip") as paths:
+        assert paths == [cache.path("a.zip")]
+        add_file(cache, "b.zip")
+        # a.zip is pinned, so the newer b.zip is evicted instead.
+        assert os.path.isfile(cache.path("a.zip"))
+        assert not os.path.isfile(cache.path("b.zip"))
+
+    add_file(cache, "b.zip")
+    assert not os.path.isfile(cache.path("a.zip"))
+    assert not os.path.isfile(cache.path("a.zip.sha256"))
+
+
+def test_expired_pin(tmp_path):
+    cache = scene_cache.scene_cache(str(tmp_path), max_bytes=150, pin_timeout=0)
+    add_file(cache, "a.zip")
+    cache.pin("a.zip")
+    add_file(cache, "b.zip")
+    assert cache.get("a.zip") is None
+
+
+def test_folders_and_deleted_entries(tmp_path):
+    cache = scene_cache.scene_cache(str(tmp_path), max_bytes=10**6)
+    folder = cache.path("scene")
+    os.makedirs(os.path.join(folder, "bands"))
+    for name in ["bands/a.tif", "b.tif"]:
+        with open(os.path.join(folder, name), "wb") as f:
+            f.write(b"0" * 300)
+    cache.add("scene")
+    assert cache.total_bytes() == 600
+
+    add_file(cache, "a.zip")
+    os.remove(cache.path("a.zip"))
+    cache.evict()
+    assert cache.total_bytes() == 600
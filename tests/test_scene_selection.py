@@ -0,0 +1,96 @@
+# Offline tests of the greedy set cover selection of scenes.
+#
+# The following functionalities are tested:
+# 1. A minimal set of scenes is selected which covers the target fraction.
+# 2. Scenes which cover about the same area are ranked on cloud cover.
+# 3. The date window, links_must_contain and product variants of one scene.
+
+
+import pandas as pd
+from shapely.geometry import box
+
+import satellite_images_nso_extractor._nso_data_extraction.scene_selection as scene_selection
+
+# A region of about 7 by 11 km near Utrecht.
+REGION = box(5.0, 52.0, 5.1, 52.1)
+
+
+def make_links(scenes):
+    return pd.DataFrame(
+        [
+            {
+                "link": f"https://api.satellietdataportaal.nl/v1/download/{satellite}/{date}_{satellite}_{product}.zip",
+                "date": date,
+                "satellite": satellite,
+                "cloudcover": cloudcover,
+                "covered_polygon": polygon,
+            }
+            for date, satellite, product, cloudcover, polygon in scenes
+        ]
+    )
+
+
+def selected_dates(selection):
+    return list(selection["date"])
+
+
+def test_minimal_cover():
+    links = make_links(
+        [
+            ("20230101", "SV1-01", "RGBNED", 0, box(4.99, 51.99, 5.05, 52.11)),
+            ("20230102", "SV1-02", "RGBNED", 0, box(5.05, 51.99, 5.11, 52.11)),
+            ("20230103", "SV1-03", "RGBNED", 0, box(5.0, 52.0, 5.02, 52.02)),
+            ("20230104", "SV1-04", "RGBNED", 0, box(5.04, 51.99, 5.07, 52.11)),
+        ]
+    )
+    selection = scene_selection.select_minimal_scenes(
+        links, REGION, target_fraction=0.99
+    )
+
+    assert sorted(selected_dates(selection)) == ["20230101", "20230102"]
+    assert selection["covered_fraction"].iloc[-1] > 0.99
+    assert selection["covered_fraction"].is_monotonic_increasing
+
+
+def test_rank_on_cloud_cover():
+    links = make_links(
+        [
+            ("20230101", "SV1-01", "RGBNED", 40, box(4.9, 51.9, 5.2, 52.2)),
+            ("20230102", "SV1-01", "RGBNED", 5, box(4.9, 51.9, 5.2, 52.2)),
+            ("20230103", "SV1-01", "RGBNED", 20, box(4.9, 51.9, 5.2, 52.2)),
+        ]
+    )
+    selection = scene_selection.select_minimal_scenes(links, REGION)
+    assert selected_dates(selection) == ["20230102"]
+
+
+def test_filters_and_variants():
+    whole = box(4.9, 51.9, 5.2, 52.2)
+    links = make_links(
+        [
+            ("20220601", "SV1-01", "RGBNED", 0, whole),
+            ("20230601", "SV1-02", "RGB", 0, whole),
+            ("20230601", "SV1-02", "RGBNED", 0, whole),
+            ("20230701", "SV1-03", "RGBNED", None, box(5.0, 52.0, 5.05, 52.1)),
+        ]
+    )
+    selection = scene_selection.select_minimal_scenes(
+        links,
+        REGION,
+        start_date="2023-01-01",
+        links_must_contain=["RGBNED"],
+    )
+    assert selected_dates(selection) == ["20230601"]
+    assert selection["link"].str.endswith("RGBNED.zip").all()
+
+    # Only half of the region can be covered.
+    selection = scene_selection.select_minimal_scenes(
+        links, REGION, start_date="2023-07-01"
+    )
+    assert selected_dates(selection) == ["20230701"]
+    assert 0.4 < selection["covered_fraction"].iloc[-1] < 0.6
+
+    assert (
+        len(scene_selection.select_minimal_scenes(links, REGION, end_date="2020-01-01"))
+        == 0
+    )
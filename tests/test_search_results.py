@@ -0,0 +1,68 @@
+# Offline tests of the typed GeoDataFrame of search results.
+#
+# The following functionalities are tested:
+# 1. The metadata of the links is parsed into typed columns.
+# 2. Search results are saved to GeoParquet and loaded back.
+
+
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+import satellite_images_nso_extractor._nso_data_extraction.search_results as search_results
+
+
+def make_links():
+    footprint = box(4.4, 52.2, 4.5, 52.3)
+    return [
+        [
+            "https://api.satellietdataportaal.nl/v1/download/30cm_RGBNED_12bit_PNEO/20230513_104139_PNEO-03_1_1",
+            0.0,
+            None,
+            box(4.41, 52.22, 4.42, 52.23),
+            footprint,
+            "12.5",
+        ],
+        [
+            "https://api.satellietdataportaal.nl/v1/download/SV_RD_11bit_RGBI_50cm/20220301_110645_SV1-04",
+            0.25,
+            box(4.41, 52.22, 4.415, 52.23),
+            box(4.415, 52.22, 4.42, 52.23),
+            footprint,
+            None,
+        ],
+    ]
+
+
+def test_to_geodataframe():
+    links = search_results.to_geodataframe(make_links())
+
+    assert links.crs.to_epsg() == 4326
+    assert links.geometry.name == "footprint"
+    assert list(links["date"]) == ["20230513", "20220301"]
+    assert links["datetime"].iloc[0] == pd.Timestamp("2023-05-13 10:41:39")
+    assert links["datetime"].iloc[1] == pd.Timestamp("2022-03-01 11:06:45")
+    assert list(links["satellite"]) == ["PNEO-03", "SV1-04"]
+    assert list(links["bands"]) == ["RGBNED", "RGBI"]
+    assert list(links["resolution"]) == ["30cm", "50cm"]
+    assert list(links["resolution_m"]) == [0.3, 0.5]
+    assert links["cloudcover"].iloc[0] == 12.5 and pd.isna(links["cloudcover"].iloc[1])
+    assert isinstance(links["bands"].dtype, pd.CategoricalDtype)
+    assert links["missing_polygon"].iloc[0] is None
+
+
+def test_empty_links():
+    links = search_results.to_geodataframe([])
+    assert len(links) == 0 and "resolution_m" in links.columns
+
+
+def test_save_and_load(tmp_path):
+    pytest.importorskip("pyarrow")
+    links = search_results.to_geodataframe(make_links())
+    path = str(tmp_path / "links.parquet")
+    search_results.save_links(links, path)
+
+    loaded = search_results.load_links(path)
+    assert list(loaded["link"]) == list(links["link"])
+    assert loaded.crs.to_epsg() == 4326
+    assert loaded["covered_polygon"].iloc[1].equals(links["covered_polygon"].iloc[1])
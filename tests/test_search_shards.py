@@ -0,0 +1,95 @@
+# Offline tests of searching long periods in date shards, the NSO api is replaced by a search over known scenes.
+#
+# The following functionalities are tested:
+# 1. Date shards cover the period without overlap.
+# 2. A sharded search finds the same links as one search, in order of date.
+# 3. Links found in more than one shard are returned once.
+
+
+import threading
+from datetime import date, timedelta
+
+from shapely.geometry import box
+
+import satellite_images_nso_extractor._nso_data_extraction.nso_api as nso_api
+
+FOOTPRINT = box(4.41, 52.22, 4.42, 52.23)
+# A small region inside of the footprint of the scenes.
+REGION = [list(box(4.412, 52.222, 4.418, 52.228).exterior.coords)]
+# A scene every 15 days in 2023.
+SCENE_DATES = [date(2023, 1, 1) + timedelta(days=15 * i) for i in range(20)]
+
+
+def make_feature(scene_date):
+    scene = f"{scene_date.strftime('%Y%m%d')}_104139_PNEO-03_1_1"
+    return {
+        "type": "Feature",
+        "geometry": FOOTPRINT.__geo_interface__,
+        "properties": {
+            "cloudcover": 10,
+            "downloads": [
+                {
+                    "href": f"https://api.satellietdataportaal.nl/v1/download/30cm_RGBNED_12bit_PNEO/{scene}"
+                }
+            ],
+        },
+    }
+
+
+def make_search(searches, dates=SCENE_DATES):
+    lock = threading.Lock()
+
+    def search(georegion, user_n, pass_n, start_date, end_date, *args, **kwargs):
+        with lock:
+            searches.append((start_date, end_date))
+        start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+        return [make_feature(day) for day in dates if start <= day <= end]
+
+    return search
+
+
+def retrieve(shard_days):
+    return nso_api.retrieve_download_links(
+        REGION,
+        "",
+        "",
+        "2023-01-01",
+        "2023-12-31",
+        0.5,
+        strict_region=False,
+        max_diff=0.5,
+        cloud_coverage_whole=60,
+        shard_days=shard_days,
+    )
+
+
+def test_date_shards():
+    shards = nso_api.date_shards("2020-02-01", "2022-06-30", shard_days=365)
+    assert shards[0] == ("2020-02-01", "2021-01-30")
+    assert shards[-1][1] == "2022-06-30"
+    for (_, end), (start, _) in zip(shards, shards[1:]):
+        assert date.fromisoformat(start) == date.fromisoformat(end) + timedelta(days=1)
+
+    assert nso_api.date_shards("2023-01-01", "2023-01-01") == [
+        ("2023-01-01", "2023-01-01")
+    ]
+    assert nso_api.date_shards("2023-01-02", "2023-01-01") == []
+
+
+def test_sharded_search(monkeypatch):
+    searches = []
+    monkeypatch.setattr(nso_api, "search", make_search(searches))
+    sharded = [link[0] for link in retrieve(shard_days=30)]
+    assert len(searches) == len(nso_api.date_shards("2023-01-01", "2023-12-31", 30))
+
+    single = [link[0] for link in retrieve(shard_days=365)]
+    assert len(sharded) == 20
+    assert sharded == single, "Expected the same links in order of date"
+
+
+def test_links_in_several_shards_are_returned_once(monkeypatch):
+    # The api returns the same scene for every shard.
+    monkeypatch.setattr(
+        nso_api, "search", lambda *args, **kwargs: [make_feature(SCENE_DATES[0])]
+    )
+    assert len(retrieve(shard_days=30)) == 1
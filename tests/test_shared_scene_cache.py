@@ -0,0 +1,76 @@
+# Offline tests of a scene cache which is shared by several processes.
+#
+# The following functionalities are tested:
+# 1. A file lock which is held can not be acquired, also not by another process.
+# 2. Entries are keyed by a hash of the download link.
+# 3. Processes which download the same link into a shared cache download it once.
+
+
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import satellite_images_nso_extractor._nso_data_extraction.nso_api as nso_api
+import satellite_images_nso_extractor._nso_data_extraction.scene_cache as scene_cache
+from satellite_images_nso_extractor._nso_data_extraction.file_lock import file_lock
+
+LINK = "https://api.satellietdataportaal.nl/v1/download/30cm_RGBNED_12bit_PNEO/20230101_104139_PNEO-03_1_1"
+
+
+def try_lock(path):
+    try:
+        with file_lock(path, timeout=0, poll_interval=0.01):
+            return True
+    except TimeoutError:
+        return False
+
+
+def download(cache_folder, link):
+    cache = scene_cache.scene_cache(cache_folder, max_bytes=10**9)
+    path = cache.path(cache.entry_name(link))
+    nso_api.download_link(link, path, "", "", cache=cache)
+    return path
+
+
+def test_file_lock(tmp_path):
+    path = str(tmp_path / "locks" / "entry.lock")
+    with file_lock(path):
+        with pytest.raises(TimeoutError):
+            file_lock(path, timeout=0.05, poll_interval=0.01).acquire()
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            assert not executor.submit(try_lock, path).result()
+    assert try_lock(path)
+
+
+def test_entry_name(tmp_path):
+    cache = scene_cache.scene_cache(str(tmp_path), max_bytes=10**9)
+    assert cache.entry_name(LINK) == cache.entry_name(LINK)
+    assert cache.entry_name(LINK).endswith("_30cm_RGBNED_12bit_PNEO.zip")
+    assert cache.entry_name(LINK) != cache.entry_name(LINK.replace("01_", "02_"))
+    assert cache.entry_name(LINK, "") == cache.entry_name(LINK)[: -len(".zip")]
+
+
+def test_shared_download(tmp_path, monkeypatch):
+    downloads = tmp_path / "downloads.txt"
+
+    def download_file(url, local_filename, *args, **kwargs):
+        # A slow download, so the other processes wait for the lock.
+        time.sleep(0.2)
+        with zipfile.ZipFile(local_filename, "w") as zip_ref:
+            zip_ref.writestr("scene/image.tif", b"satellite data")
+        with open(downloads, "a") as f:
+            f.write(url + "\n")
+        return local_filename
+
+    # The worker processes are forked, so they use the replaced download_file.
+    monkeypatch.setattr(nso_api, "download_file", download_file)
+    cache_folder = str(tmp_path / "cache")
+    with ProcessPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(download, cache_folder, LINK) for _ in range(3)]
+        paths = {future.result() for future in futures}
+
+    assert len(paths) == 1 and os.path.isfile(paths.pop())
+    assert downloads.read_text().splitlines() == [LINK], "Expected one download"
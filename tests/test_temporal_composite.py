@@ -0,0 +1,92 @@
+# Offline tests of temporal compositing on small synthetic scenes of one region.
+#
+# The following functionalities are tested:
+# 1. The median, max_ndvi and least_cloudy methods, pixels without data are left out.
+# 2. A composite which fails halfway does not replace the existing output file.
+
+
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from synthetic_data import make_tif, random_bands
+
+import satellite_images_nso_extractor._manipulation.temporal_composite as temporal_composite
+
+
+def make_scenes(tmp_path):
+    scenes = [
+        random_bands(count=6, height=40, width=40, seed=seed) for seed in range(3)
+    ]
+    # The first scene has no data in the top rows.
+    scenes[0][:, :10] = 0
+    paths = [
+        make_tif(tmp_path / f"scene_{i}.tif", scene) for i, scene in enumerate(scenes)
+    ]
+    return paths, np.stack(scenes)
+
+
+def read(path):
+    with rasterio.open(path) as src:
+        return src.read()
+
+
+def test_median(tmp_path):
+    paths, scenes = make_scenes(tmp_path)
+    output = temporal_composite.temporal_composite(
+        paths, str(tmp_path / "median.tif"), block_size=16
+    )
+
+    values = np.where(scenes == 0, np.nan, scenes.astype(np.float32))
+    expected = np.nanmedian(values, axis=0).astype(np.uint16)
+    np.testing.assert_array_equal(read(output), expected)
+    assert not os.path.exists(output + ".part")
+
+
+def test_least_cloudy(tmp_path):
+    paths, scenes = make_scenes(tmp_path)
+    output = temporal_composite.temporal_composite(
+        paths,
+        str(tmp_path / "least_cloudy.tif"),
+        method="least_cloudy",
+        cloud_cover=[5, 50, 20],
+        block_size=16,
+    )
+
+    data = read(output)
+    np.testing.assert_array_equal(data[:, 10:], scenes[0][:, 10:])
+    np.testing.assert_array_equal(data[:, :10], scenes[2][:, :10])
+
+
+def test_max_ndvi(tmp_path):
+    paths, scenes = make_scenes(tmp_path)
+    output = temporal_composite.temporal_composite(
+        paths, str(tmp_path / "max_ndvi.tif"), method="max_ndvi", block_size=16
+    )
+
+    data = read(output)
+    red, nir = scenes[:, 0].astype(np.float64), scenes[:, 3].astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ndvi = np.where(scenes[:, 0] > 0, (nir - red) / (nir + red), -np.inf)
+    best = np.argmax(ndvi, axis=0)
+    expected = np.take_along_axis(scenes, best[None, None], axis=0)[0]
+    np.testing.assert_array_equal(data, expected)
+
+
+def test_failed_composite_keeps_output(tmp_path, monkeypatch):
+    paths, _ = make_scenes(tmp_path)
+    output = str(tmp_path / "composite.tif")
+    temporal_composite.temporal_composite(paths, output, block_size=16)
+    before = read(output)
+
+    def fail(channel_type, data):
+        raise Exception("Failed index channel")
+
+    monkeypatch.setattr(temporal_composite, "generate_index_channel_from_array", fail)
+    with pytest.raises(Exception, match="Failed index channel"):
+        temporal_composite.temporal_composite(
+            paths, output, method="max_ndvi", block_size=16
+        )
+
+    np.testing.assert_array_equal(read(output), before)
@@ -0,0 +1,50 @@
+# Offline tests of the per region watermarks of incremental searches.
+#
+# The following functionalities are tested:
+# 1. The acquisition date of a download link.
+# 2. A watermark only moves forward and is kept per region.
+# 3. The start date of an incremental search, with overlap.
+
+
+import satellite_images_nso_extractor._nso_data_extraction.watermark as watermark
+
+
+def test_link_date():
+    link = "https://api.satellietdataportaal.nl/v1/download/30cm_RGBNED_12bit_PNEO/20230405_104139_PNEO-03_1_1"
+    assert watermark.link_date(link) == "2023-04-05"
+
+
+def test_advance(tmp_path):
+    watermarks = watermark.region_watermarks(str(tmp_path))
+    assert watermarks.path == str(tmp_path / watermark.WATERMARK_FILE_NAME)
+    assert watermarks.get("utrecht") is None
+
+    assert watermarks.advance("utrecht", "2023-03-01") == "2023-03-01"
+    assert watermarks.advance("utrecht", "2023-02-01") == "2023-03-01"
+    assert watermarks.advance("utrecht", "2023-04-01") == "2023-04-01"
+    watermarks.advance("amsterdam", "2022-01-01")
+
+    # A new object reads the watermarks back from the file.
+    watermarks = watermark.region_watermarks(str(tmp_path))
+    assert watermarks.get("utrecht") == "2023-04-01"
+    assert watermarks.get("amsterdam") == "2022-01-01"
+
+
+def test_search_start(tmp_path):
+    watermarks = watermark.region_watermarks(str(tmp_path / "watermarks.json"))
+    assert watermarks.search_start("utrecht", "2020-01-01") == "2020-01-01"
+
+    watermarks.advance("utrecht", "2023-04-10")
+    assert watermarks.search_start("utrecht", "2020-01-01") == "2023-04-03"
+    assert watermarks.search_start("utrecht", "2020-01-01", overlap_days=0) == (
+        "2023-04-10"
+    )
+    assert watermarks.search_start("utrecht", "2023-06-01") == "2023-06-01"
+
+
+def test_corrupt_file(tmp_path):
+    path = tmp_path / "watermarks.json"
+    path.write_text("{not json")
+    watermarks = watermark.region_watermarks(str(path))
+    assert watermarks.get("utrecht") is None
+    assert watermarks.advance("utrecht", "2023-01-01") == "2023-01-01"
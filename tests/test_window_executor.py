@@ -0,0 +1,81 @@
+# Offline tests of the thread parallel window executor on small synthetic rasters.
+#
+# The following functionalities are tested:
+# 1. process gives the same result as computing the whole raster at once.
+# 2. The error of a window stops the run, is raised with the window and leaves no output file.
+# 3. Runs which share one executor at the same time do not close each other's datasets.
+# 4. The default number of threads is divided over the processes.
+
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import rasterio
+from synthetic_data import make_tif, random_bands
+
+import satellite_images_nso_extractor._manipulation.window_executor as window_executor
+
+
+def test_process(tmp_path):
+    data = random_bands(count=2, height=100, width=70)
+    input_file = make_tif(tmp_path / "input.tif", data, block_size=16)
+    executor = window_executor.window_executor(workers=3, block_size=32)
+
+    output_file = executor.process(
+        input_file,
+        str(tmp_path / "output.tif"),
+        lambda window_data, window: window_data[:1] + window_data[1:],
+        profile={"count": 1},
+        descriptions=("sum",),
+    )
+
+    with rasterio.open(output_file) as src:
+        assert np.array_equal(src.read(1), data[0] + data[1])
+        assert src.descriptions == ("sum",)
+
+
+def test_error_propagation(tmp_path):
+    input_file = make_tif(tmp_path / "input.tif", random_bands(), block_size=16)
+    executor = window_executor.window_executor(workers=2, block_size=16)
+
+    def compute(window_data, window):
+        if window.col_off == 16 and window.row_off == 32:
+            raise ValueError("bad window")
+        return window_data
+
+    output_file = str(tmp_path / "output.tif")
+    with pytest.raises(Exception, match="Failed to process window.*bad window"):
+        executor.process(input_file, output_file, compute)
+    assert not os.path.exists(output_file)
+    assert not os.path.exists(output_file + ".part"), "The .part file is removed"
+
+
+def test_shared_executor(tmp_path):
+    executor = window_executor.window_executor(workers=2, block_size=16)
+    inputs = [
+        make_tif(tmp_path / f"input_{i}.tif", random_bands(seed=i), block_size=16)
+        for i in range(4)
+    ]
+
+    def process(input_file):
+        return executor.process(
+            input_file,
+            input_file.replace(".tif", "_copy.tif"),
+            lambda window_data, window: window_data,
+        )
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        outputs = list(pool.map(process, inputs))
+
+    for i, output_file in enumerate(outputs):
+        with rasterio.open(output_file) as src:
+            assert np.array_equal(src.read(), random_bands(seed=i))
+
+
+def test_default_workers(monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    monkeypatch.setenv(window_executor.PROCESSES_ENVIRONMENT_VARIABLE, "4")
+    assert window_executor.get_default_workers() == 2
+    assert window_executor.window_executor().gdal_threads == 1
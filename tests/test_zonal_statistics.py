@@ -0,0 +1,115 @@
+# Offline tests of the raster native zonal statistics against a brute force calculation with pandas.
+#
+# The following functionalities are tested:
+# 1. The mean, std, min, max and count per zone and band, also of a index channel, over several blocks.
+# 2. Pixels which are 0 in every band are left out.
+# 3. The std of a zone with one pixel is NaN, like pandas.
+
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import Point, box
+from synthetic_data import make_tif, random_bands
+
+import satellite_images_nso_extractor._manipulation.zonal_statistics as zonal_statistics
+from satellite_images_nso_extractor._index_channels.calculate_index_channels import (
+    generate_index_channel_from_array,
+)
+
+
+def make_raster(tmp_path):
+    # 6 bands of 64 by 64 pixels of 0.5 m, the top left corner is outside of the cropped region.
+    data = random_bands(count=6, seed=1)
+    data[:, :20, :20] = 0
+    return make_tif(tmp_path / "cropped.tif", data), data
+
+
+def make_zones():
+    # The polygon edges are not on pixel centers, so rasterizing matches a point in polygon test of the centers.
+    return gpd.GeoDataFrame(
+        {"habitat": ["heath", "dune"]},
+        geometry=[
+            box(90001.1, 459981.1, 90017.1, 459999.1),
+            Point(90024.1, 459990.1).buffer(6.1),
+        ],
+        crs="EPSG:28992",
+    )
+
+
+def brute_force(data, zones):
+    rows, columns = np.mgrid[0 : data.shape[1], 0 : data.shape[2]]
+    centers = gpd.GeoSeries(
+        gpd.points_from_xy(
+            90000 + (columns.ravel() + 0.5) * 0.5,
+            460000 - (rows.ravel() + 0.5) * 0.5,
+        ),
+        crs="EPSG:28992",
+    )
+    pixels = pd.DataFrame(
+        {f"band_{band + 1}": data[band].ravel() for band in range(data.shape[0])}
+    )
+    pixels["ndvi"] = generate_index_channel_from_array("ndvi", data).ravel()
+    pixels = pixels[np.any(data.reshape(data.shape[0], -1) != 0, axis=0)]
+
+    frames = []
+    for habitat, geometry in zip(zones["habitat"], zones.geometry):
+        zone_pixels = pixels[centers[pixels.index].within(geometry).values]
+        for column in pixels.columns:
+            values = zone_pixels[column].astype(np.float64)
+            frames.append(
+                {
+                    "zone": habitat,
+                    "band": column,
+                    "mean": values.mean(),
+                    "std": values.std(),
+                    "min": values.min(),
+                    "max": values.max(),
+                    "count": len(values),
+                }
+            )
+    return pd.DataFrame(frames)
+
+
+def test_zonal_statistics_brute_force(tmp_path):
+    raster_path, data = make_raster(tmp_path)
+    zones = make_zones()
+
+    result = zonal_statistics.zonal_statistics(
+        raster_path,
+        zones,
+        zone_column="habitat",
+        index_channels=["ndvi"],
+        block_size=16,
+    )
+    expected = brute_force(data, zones)
+
+    result = result.astype({"band": str}).sort_values(["zone", "band"])
+    expected = expected.sort_values(["zone", "band"])
+    assert list(result["count"]) == list(expected["count"])
+    assert result["count"].min() > 1, "Expected several pixels per zone"
+    for column in ["mean", "std", "min", "max"]:
+        np.testing.assert_allclose(
+            result[column].values, expected[column].values, rtol=1e-5
+        )
+
+
+def test_zero_pixels_are_left_out(tmp_path):
+    raster_path, _ = make_raster(tmp_path)
+    # A zone in the corner which is 0 in every band.
+    zones = gpd.GeoDataFrame(
+        geometry=[box(90001.1, 459994.1, 90008.1, 459999.1)], crs="EPSG:28992"
+    )
+    result = zonal_statistics.zonal_statistics(raster_path, zones)
+    assert len(result) == 0
+
+
+def test_std_of_one_pixel(tmp_path):
+    raster_path, _ = make_raster(tmp_path)
+    zones = gpd.GeoDataFrame(
+        geometry=[box(90030.1, 459970.1, 90030.4, 459970.4)], crs="EPSG:28992"
+    )
+    result = zonal_statistics.zonal_statistics(raster_path, zones, bands=[1])
+    assert list(result["count"]) == [1]
+    assert np.isnan(result["std"].iloc[0])
+    assert result["mean"].iloc[0] == result["min"].iloc[0] == result["max"].iloc[0]